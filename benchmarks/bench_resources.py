@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Memory footprint of the resources loaded from a large resources.yaml.
+
+Builds a :class:`ResourceContainer` of generated ``url`` and ``pypi``
+resources, as in a generated mirror manifest, looks every one of them
+up, and reports the memory still allocated per resource, including
+what is kept of the definitions they were created from.
+
+Usage::
+
+    python benchmarks/bench_resources.py [--count 10000 --count 100000]
+"""
+from __future__ import print_function
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from jujuresources.backend import ResourceContainer  # noqa
+
+
+def definitions(count):
+    for i in range(count):
+        if i % 2:
+            yield 'wheel-{}'.format(i), {
+                'url': 'https://files.example.com/packages/wheel-{0}/wheel-{0}-1.0-py3-none-any.whl'.format(i),
+                'hash': '{:064x}'.format(i),
+                'hash_type': ''.join(['sha', '256']),  # a new string, as a YAML parser would make
+            }
+        else:
+            yield 'package-{}'.format(i), {
+                'pypi': 'package-{}>=1.0'.format(i),
+                'hash': '{:064x}'.format(i),
+                'hash_type': ''.join(['sha', '256']),
+            }
+
+
+def measure(count):
+    gc.collect()
+    tracemalloc.start()
+    resources = ResourceContainer('resources')
+    for name, definition in definitions(count):
+        resources.add_optional(name, definition)
+    resources.all()
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, action='append',
+                        help='Number of resources (may be repeated; default: 10000 and 100000)')
+    opts = parser.parse_args()
+    for count in opts.count or [10000, 100000]:
+        size = measure(count)
+        print('resources: {:>7}  total: {:6.1f} MB  per resource: {:5.0f} bytes'.format(
+            count, size / 1024.0 / 1024, float(size) / count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Load test for the ``juju-resources serve`` mirror server.
+
+Starts a mirror server on loopback serving a generated file, then drives
+it with many parallel clients, reporting aggregate throughput and latency.
+One deliberately slow client is included to show that it does not stall
+the others.
+
+Usage::
+
+    python benchmarks/bench_serve.py [--clients 50] [--requests 20] [--size-mb 4]
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import socket
+import sys
+import threading
+import time
+from contextlib import closing
+from tempfile import mkdtemp
+
+try:
+    from urllib.request import urlopen  # Python 3
+except ImportError:
+    from urllib2 import urlopen  # Python 2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from jujuresources.server import MirrorServer, MirrorRequestHandler  # noqa
+
+
+class QuietHandler(MirrorRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def slow_client(address, path, stop):
+    with closing(socket.create_connection(address)) as sock:
+        sock.sendall('GET /{} HTTP/1.0\r\n\r\n'.format(path).encode('ascii'))
+        while not stop.is_set():
+            if not sock.recv(1024):
+                break
+            time.sleep(0.05)
+
+
+def client(url, count, latencies, errors):
+    for i in range(count):
+        start = time.time()
+        try:
+            with closing(urlopen(url, timeout=60)) as fp:
+                while fp.read(64 * 1024):
+                    pass
+        except Exception:
+            errors.append(1)
+            continue
+        latencies.append(time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=20, help='Requests per client')
+    parser.add_argument('--size-mb', type=int, default=4, help='Size of the served file')
+    parser.add_argument('--max-connections', type=int, default=100)
+    opts = parser.parse_args()
+
+    cwd = os.getcwd()
+    tmpdir = mkdtemp()
+    with open(os.path.join(tmpdir, 'resource.bin'), 'wb') as fp:
+        fp.write(os.urandom(opts.size_mb * 1024 * 1024))
+    os.chdir(tmpdir)
+    httpd = MirrorServer(('127.0.0.1', 0), QuietHandler, max_connections=opts.max_connections)
+    server_thread = threading.Thread(target=httpd.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    url = 'http://127.0.0.1:{}/resource.bin'.format(httpd.server_address[1])
+
+    stop = threading.Event()
+    slow = threading.Thread(target=slow_client, args=(httpd.server_address, 'resource.bin', stop))
+    slow.daemon = True
+    slow.start()
+
+    latencies, errors = [], []
+    threads = [threading.Thread(target=client, args=(url, opts.requests, latencies, errors))
+               for i in range(opts.clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    stop.set()
+    httpd.shutdown()
+    httpd.server_close()
+    os.chdir(cwd)
+    shutil.rmtree(tmpdir)
+
+    latencies.sort()
+    total_mb = len(latencies) * opts.size_mb
+    print('clients: {}  requests: {}  errors: {}'.format(opts.clients, len(latencies), len(errors)))
+    print('elapsed: {:.2f}s  throughput: {:.1f} MB/s  {:.1f} req/s'.format(
+        elapsed, total_mb / elapsed, len(latencies) / elapsed))
+    if latencies:
+        print('latency p50: {:.3f}s  p95: {:.3f}s  max: {:.3f}s'.format(
+            latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.95)],
+            latencies[-1]))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Startup time of the ``juju-resources`` CLI.
+
+Measures the time to import :mod:`jujuresources.cli`, as reported by
+``python -X importtime``, and the wall time of ``resource_path`` calls
+such as charms make in shell loops, with and without a ``daemon``
+running.  Exits non-zero if the import takes longer than the budget.
+
+Usage::
+
+    python benchmarks/bench_startup.py [--budget-ms 150] [--runs 20]
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+from tempfile import mkdtemp
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+RESOURCES_YAML = """\
+resources:
+  foo:
+    url: http://example.com/foo.tgz
+    hash: deadbeef
+    hash_type: sha256
+"""
+
+
+def run(tmpdir, args, **kwargs):
+    env = dict(os.environ, PYTHONPATH=ROOT, XDG_CACHE_HOME=os.path.join(tmpdir, 'cache'))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    # keep the bytecode out of the tree, but do use it, as installed copies would
+    return subprocess.check_output(
+        [sys.executable, '-X', 'pycache_prefix=' + os.path.join(tmpdir, 'pyc')] + args,
+        cwd=tmpdir, env=env, stderr=subprocess.STDOUT, **kwargs)
+
+
+def import_time(tmpdir):
+    """
+    Return the cumulative import time of jujuresources.cli, in seconds.
+    """
+    output = run(tmpdir, ['-X', 'importtime', '-c', 'import jujuresources.cli']).decode('utf-8')
+    for line in output.splitlines():
+        if line.rstrip().endswith('| jujuresources.cli'):
+            return int(line.split('|')[1]) / 1e6
+    raise ValueError('jujuresources.cli not found in -X importtime output')
+
+
+def time_calls(tmpdir, args, runs):
+    """
+    Return the sorted wall times of `runs` runs of `args`, in seconds.
+    """
+    calls = []
+    for i in range(runs):
+        start = time.time()
+        run(tmpdir, args)
+        calls.append(time.time() - start)
+    return sorted(calls)
+
+
+def start_daemon(tmpdir):
+    """
+    Start ``juju-resources daemon`` in `tmpdir`, returning once it listens.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT, XDG_CACHE_HOME=os.path.join(tmpdir, 'cache'))
+    daemon = subprocess.Popen([sys.executable, '-c', 'from jujuresources_client import main; main(["daemon"])'],
+                              cwd=tmpdir, env=env)
+    for i in range(100):
+        if os.path.exists(os.path.join(tmpdir, '.jujuresources.sock')):
+            return daemon
+        time.sleep(0.05)
+    daemon.terminate()
+    raise RuntimeError('daemon did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=150,
+                        help='Maximum import time of jujuresources.cli (default: %(default)s)')
+    parser.add_argument('--runs', type=int, default=20)
+    opts = parser.parse_args()
+
+    tmpdir = mkdtemp()
+    try:
+        with open(os.path.join(tmpdir, 'resources.yaml'), 'w') as fp:
+            fp.write(RESOURCES_YAML)
+        resource_path = ['-c', 'import sys; from jujuresources_client import main; '
+                               'sys.exit(main(["resource_path", "foo"]))']
+        run(tmpdir, resource_path)  # warm the bytecode and resources.yaml caches
+
+        imports = sorted(import_time(tmpdir) for i in range(opts.runs))
+        calls = time_calls(tmpdir, resource_path, opts.runs)
+        daemon = start_daemon(tmpdir)
+        try:
+            daemon_calls = time_calls(tmpdir, resource_path, opts.runs)
+        finally:
+            daemon.terminate()
+            daemon.wait()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    import_ms = imports[len(imports) // 2] * 1000
+    print('import jujuresources.cli  p50: {:.1f}ms  min: {:.1f}ms  (budget: {:.0f}ms)'.format(
+        import_ms, imports[0] * 1000, opts.budget_ms))
+    print('resource_path call        p50: {:.1f}ms  min: {:.1f}ms'.format(
+        calls[len(calls) // 2] * 1000, calls[0] * 1000))
+    print('  ... with a daemon       p50: {:.1f}ms  min: {:.1f}ms'.format(
+        daemon_calls[len(daemon_calls) // 2] * 1000, daemon_calls[0] * 1000))
+    return 1 if import_ms > opts.budget_ms else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,47 +1,251 @@
 import os
+import atexit
 import contextlib
+import hashlib
+import json
 import subprocess
+import sys
+import threading
+import time
+from itertools import groupby
 
 try:
-    from urllib.request import urlopen  # Python 3
+    from urllib.request import urlopen, Request, url2pathname  # Python 3
     from urllib.parse import urlparse
 except ImportError:
-    from urllib import urlopen  # Python 2
+    from urllib2 import urlopen, Request  # Python 2
+    from urllib import url2pathname
     from urlparse import urlparse
 
-import yaml
-
+from jujuresources import backend
 from jujuresources.backend import ResourceContainer
 from jujuresources.backend import PyPIResource
 from jujuresources.backend import ALL
+from jujuresources.backend import mirror_urls
+from jujuresources.backend import read_peers
+from jujuresources.mirrors import MirrorRanking
+from jujuresources.scheduler import FetchScheduler
 
 
 __all__ = ['fetch', 'verify', 'install', 'resource_path', 'resource_spec',
-           'ALL', 'config_get', 'juju_log']
+           'ALL', 'config_get', 'invalidate_config', 'juju_log', 'flush_log']
 resources_cache = {}
 
+# all of the charm's config options, keyed by the JUJU_CONTEXT_ID of the
+# hook in which they were read
+config_cache = {}
+
+# where parsed copies of resources.yaml files are kept
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'jujuresources')
+
+# seconds for which a remote resources.yaml is used without checking if it changed
+REVALIDATE_AFTER = 60
+
+
+def _parse_yaml(stream):
+    # yaml is slow to import, and isn't needed if the parsed copy is cached
+    import yaml
+    try:
+        from yaml import CSafeLoader as YamlLoader  # libyaml bindings
+    except ImportError:
+        from yaml import SafeLoader as YamlLoader
+    return yaml.load(stream, Loader=YamlLoader)
+
 
 def config_get(option_name):
     """
     Helper to access a Juju config option when charmhelpers is not available.
 
+    All of the options are read with a single ``config-get`` call, and are
+    kept for the rest of the hook (or, outside of a hook, until
+    :func:`invalidate_config` is called).
+
     :param str option_name: Name of the config option to get the value of
     """
-    try:
-        raw = subprocess.check_output(['config-get', option_name, '--format=yaml'])
-        return yaml.load(raw.decode('UTF-8'))
-    except ValueError:
-        return None
+    context = os.environ.get('JUJU_CONTEXT_ID')
+    if context not in config_cache:
+        try:
+            raw = subprocess.check_output(['config-get', '--format=yaml'])
+            options = _parse_yaml(raw.decode('UTF-8')) or {}
+        except ValueError:
+            return None
+        config_cache.clear()  # from an earlier hook
+        config_cache[context] = options
+    return config_cache[context].get(option_name)
+
+
+def invalidate_config():
+    """
+    Forget the config options read by :func:`config_get`, so that they are
+    read again the next time they are needed.
+    """
+    config_cache.clear()
+
+
+class _LogBuffer(object):
+    """
+    Collects log messages and sends them to ``juju-log`` in batches, with
+    one call for each run of messages of the same level, from a background
+    thread at most `interval` seconds after they are added, or as soon as
+    `max_messages` are waiting.
+
+    If ``juju-log`` isn't available (e.g., outside of a hook), messages
+    are written to stderr instead.
+    """
+    def __init__(self, interval=1.0, max_messages=100):
+        self.interval = interval
+        self.max_messages = max_messages
+        self._messages = []
+        self._timer = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()  # keeps batches in order
+        self._juju_log = True
+
+    def add(self, level, message):
+        with self._lock:
+            self._messages.append((level, message))
+            if len(self._messages) >= self.max_messages and self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self._timer:
+                delay = 0 if len(self._messages) >= self.max_messages else self.interval
+                self._timer = threading.Timer(delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._send_lock:
+            with self._lock:
+                messages, self._messages = self._messages, []
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+            for level, batch in groupby(messages, key=lambda m: m[0]):
+                self._send(level, [message for _, message in batch])
+
+    def _send(self, level, messages):
+        if self._juju_log:
+            try:
+                subprocess.check_call(['juju-log', '-l', level, '\n'.join(messages)])
+                return
+            except OSError:
+                self._juju_log = False  # not available, so don't try again
+            except subprocess.CalledProcessError:
+                pass
+        sys.stderr.write(''.join('{}: {}\n'.format(level, message) for message in messages))
+
+
+_log_buffer = _LogBuffer()
+atexit.register(_log_buffer.flush)
 
 
 def juju_log(message, level='DEBUG'):
     """
     Helper to send Juju log messages when charmhelpers is not available.
 
+    Messages are sent in batches from a background thread, so that logging
+    doesn't start a process per message; see :func:`flush_log`.  If
+    ``juju-log`` isn't available, they are written to stderr.
+
     :param str message: Message to log
     :param str level: Log level (DEBUG, INFO, ERROR, WARNING, CRITICAL; default: DEBUG)
     """
-    subprocess.check_call(['juju-log', '-l', level, message])
+    _log_buffer.add(level, message)
+
+
+def flush_log():
+    """
+    Send the messages logged by :func:`juju_log` which are still waiting
+    to be sent.  This is done when :func:`fetch` and :func:`install` finish,
+    and when the process exits.
+    """
+    _log_buffer.flush()
+
+
+def _cache_file(key):
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def _read_cache(cache_file):
+    try:
+        with open(cache_file) as fp:
+            cached = json.load(fp)
+        return cached if isinstance(cached, dict) and 'resdefs' in cached else {}
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_cache(cache_file, entry):
+    try:
+        data = json.dumps(entry)
+        if json.loads(data)['resdefs'] != entry['resdefs']:
+            return  # e.g., dates or non-string keys, which JSON can't round-trip
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'w') as fp:
+            fp.write(data)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError, TypeError, ValueError):
+        pass  # the cache is only an optimization
+
+
+def _read_resdefs(path):
+    """
+    Parse the local resources.yaml file at `path`, reusing the copy parsed
+    by a previous process, if the file hasn't changed since.
+    """
+    st = os.stat(path)
+    source = [path, st.st_mtime, st.st_size]
+    cache_file = _cache_file(path)
+    cached = _read_cache(cache_file)
+    if cached.get('source') == source:
+        return cached['resdefs']
+    with open(path) as fp:
+        resdefs = _parse_yaml(fp)
+    _write_cache(cache_file, {'source': source, 'resdefs': resdefs})
+    return resdefs
+
+
+def _fetch_resdefs(url):
+    """
+    Fetch and parse the remote resources.yaml at `url`.
+
+    The parsed copy is kept with the response's ``ETag`` and
+    ``Last-Modified`` validators, so that later processes only download it
+    again if it has changed, and not at all within :data:`REVALIDATE_AFTER`
+    seconds of the last check.  If `url` can't be reached, the kept copy
+    is used instead.
+    """
+    cache_file = _cache_file(url)
+    cached = _read_cache(cache_file)
+    if cached.get('source') != url:
+        cached = {}
+    if cached and 0 <= time.time() - cached.get('checked', 0) < REVALIDATE_AFTER:
+        return cached['resdefs']
+    headers = {}
+    if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    try:
+        with contextlib.closing(urlopen(Request(url, headers=headers))) as fp:
+            resdefs = _parse_yaml(fp)
+            info = fp.info()
+            entry = {'source': url, 'etag': info.get('ETag'), 'last_modified': info.get('Last-Modified'),
+                     'resdefs': resdefs}
+    except IOError as e:
+        code = getattr(e, 'code', None)
+        if cached and code == 304:
+            entry = cached
+        elif cached and (code is None or code >= 500):
+            sys.stderr.write('Error fetching {}: {}; using cached copy\n'.format(url, e))
+            return cached['resdefs']
+        else:
+            raise
+    entry['checked'] = time.time()
+    _write_cache(cache_file, entry)
+    return entry['resdefs']
 
 
 def _load(resources_yaml, output_dir=None):
@@ -49,9 +253,11 @@ def _load(resources_yaml, output_dir=None):
         url = resources_yaml
         parsed_url = urlparse(url)
         if not parsed_url.scheme:
-            url = 'file://%s' % os.path.join(os.getcwd(), url)
-        with contextlib.closing(urlopen(url)) as fp:
-            resdefs = yaml.load(fp)
+            resdefs = _read_resdefs(os.path.join(os.getcwd(), url))
+        elif parsed_url.scheme == 'file':
+            resdefs = _read_resdefs(url2pathname(parsed_url.path))
+        else:
+            resdefs = _fetch_resdefs(url)
         _output_dir = output_dir or resdefs.get('options', {}).get('output_dir', 'resources')
         resources = ResourceContainer(_output_dir)
         for name, resource in resdefs.get('resources', {}).items():
@@ -62,35 +268,68 @@ def _load(resources_yaml, output_dir=None):
     return resources_cache[(resources_yaml, output_dir)]
 
 
-def _invalid(resources, which):
-    invalid = set()
-    for resource in resources.subset(which):
-        if not resource.verify():
-            invalid.add(resource.name)
-    return invalid
+@contextlib.contextmanager
+def _recording(metrics=None, events=None, trace=None):
+    """
+    Record per-resource metrics in `metrics`, send events to `events`, and
+    record a timeline in `trace`, if given, within the context.
+    """
+    old_metrics, old_events, old_trace = backend.METRICS, backend.EVENTS, backend.TRACE
+    if metrics is not None:
+        backend.METRICS = metrics
+    if events is not None:
+        backend.EVENTS = events
+    if trace is not None:
+        backend.TRACE = trace
+    try:
+        yield
+    finally:
+        backend.METRICS, backend.EVENTS, backend.TRACE = old_metrics, old_events, old_trace
 
 
-def _fetch(resources, which, mirror_url, force=False, reporthook=None):
-    invalid = _invalid(resources, which)
-    for resource in resources.subset(which):
-        if resource.name not in invalid and not force:
-            continue
-        if reporthook:
-            reporthook(resource.name)
-        resource.fetch(mirror_url)
+def _invalid(resources, which, metrics=None, events=None, trace=None):
+    invalid = set()
+    with _recording(metrics, events, trace):
+        for resource in resources.subset(which):
+            with backend._timed(resource.name, 'verify_seconds'):
+                valid = resource.verify()
+            backend._emit('verified', resource.name, valid=valid)
+            if not valid:
+                invalid.add(resource.name)
+    return invalid
 
 
-def _install(resources, which, mirror_url, destination, skip_top_level):
+def _fetch(resources, which, mirror_url, force=False, reporthook=None, scheduler=None, peers=None,
+           metrics=None, events=None, trace=None):
+    with _recording(metrics, events, trace):
+        invalid = _invalid(resources, which)
+        required = set(resource.name for resource in resources.required())
+        jobs = []
+        for resource in resources.subset(which):
+            if resource.name not in invalid and not force:
+                continue
+            # required resources first, so hooks can proceed as soon as possible
+            jobs.append((0 if resource.name in required else 1, resource))
+        if scheduler is None:
+            ranking = MirrorRanking(os.path.join(resources.output_dir, MirrorRanking.CACHE_FILE))
+            scheduler = FetchScheduler(ranking=ranking)
+        scheduler.run(jobs, mirror_url, reporthook, peers)
+
+
+def _install(resources, which, mirror_url, destination, skip_top_level, metrics=None, events=None,
+             trace=None):
     success = True
     pypi_resources = []
-    for resource in resources.subset(which):
-        if isinstance(resource, PyPIResource):
-            # group pypi resources to reduce subprocess calls
-            pypi_resources.append(resource)
-        else:
-            success = resource.install(destination, skip_top_level) and success
-    if pypi_resources:
-        success = PyPIResource.install_group(pypi_resources, mirror_url) and success
+    with _recording(metrics, events, trace):
+        for resource in resources.subset(which):
+            if isinstance(resource, PyPIResource):
+                # group pypi resources to reduce subprocess calls
+                pypi_resources.append(resource)
+            else:
+                with backend._timed(resource.name, 'install_seconds'):
+                    success = resource.install(destination, skip_top_level) and success
+        if pypi_resources:
+            success = PyPIResource.install_group(pypi_resources, mirror_url) and success
     return success
 
 
@@ -111,7 +350,7 @@ def invalid(which=None, resources_yaml='resources.yaml'):
     return _invalid(resources, which)
 
 
-def verify(which=None, resources_yaml='resources.yaml'):
+def verify(which=None, resources_yaml='resources.yaml', metrics=None, events=None, trace=None):
     """
     Verify if some or all resources previously fetched with :func:`fetch_resources`,
     including validating their cryptographic hash.
@@ -126,22 +365,35 @@ def verify(which=None, resources_yaml='resources.yaml'):
     :param str output_dir: Override ``output_dir`` option from `resources_yaml`
         (this is intended for mirroring via the CLI and it is not recommended
         to be used otherwise)
+    :param metrics: A :class:`~jujuresources.metrics.Metrics` in which to
+        record the time spent verifying each resource.
+    :param events: Callable to which to send a
+        :class:`~jujuresources.events.Event` as each resource is verified.
+    :param trace: A :class:`~jujuresources.trace.Trace` in which to record
+        a timeline of each phase of each resource.
     :return: True if all of the resources are available and valid, otherwise False.
     """
     resources = _load(resources_yaml, None)
-    return not _invalid(resources, which)
+    return not _invalid(resources, which, metrics, events, trace)
 
 
 def fetch(which=None, mirror_url=None, resources_yaml='resources.yaml',
-          force=False, reporthook=None):
+          force=False, reporthook=None, scheduler=None, peers=None, peers_file=None, metrics=None,
+          events=None, trace=None):
     """
     Attempt to fetch all resources for a charm.
 
+    Required resources are fetched ahead of optional ones, in parallel,
+    subject to the limits of `scheduler`.
+
     :param list which: A name, or a list of one or more resource names, to
         fetch.  If ommitted, all non-optional resources are fetched.
         You can also pass ``jujuresources.ALL`` to fetch all optional *and*
         required resources.
-    :param str mirror_url: Fetch resources from the given mirror.
+    :param str mirror_url: Fetch resources from the given mirror.  This can
+        also be a list, or comma-separated string, of mirrors, which are
+        tried fastest first before falling back to the upstream source of
+        each resource.
     :param str resources_yaml: Location of the yaml file containing the
         resource descriptions (default: ``./resources.yaml``).
         Can be a local file name or a remote URL.
@@ -149,14 +401,31 @@ def fetch(which=None, mirror_url=None, resources_yaml='resources.yaml',
     :param func reporthook: Callback for reporting download progress.
         Will be called once for each resource, just prior to fetching, and will
         be passed the resource name.
+    :param scheduler: A :class:`~jujuresources.scheduler.FetchScheduler`
+        limiting the number of concurrent fetches, per host and overall,
+        and the download rate (default: 4 fetches, at most 2 per host).
+    :param list peers: Mirror URLs of peer units (e.g., from relation data)
+        running ``juju-resources serve --peer``.  Resources with a known hash
+        are fetched from a peer, if one has a verified copy, before trying
+        `mirror_url`.
+    :param str peers_file: File listing more peer URLs, one per line.
+    :param metrics: A :class:`~jujuresources.metrics.Metrics` in which to
+        record per-resource timings and sizes.
+    :param events: Callable to which to send a
+        :class:`~jujuresources.events.Event` for each step of fetching and
+        verifying the resources, e.g. for progress bars.  Use
+        :func:`jujuresources.events.from_reporthook` to adapt a `reporthook`.
+    :param trace: A :class:`~jujuresources.trace.Trace` in which to record
+        a timeline of each phase of each resource.
     :return: True or False indicating whether the resources were successfully
         downloaded.
     """
     resources = _load(resources_yaml, None)
     if reporthook is None:
         reporthook = lambda r: juju_log('Fetching %s' % r, level='INFO')
-    _fetch(resources, which, mirror_url, force, reporthook)
-    failed = _invalid(resources, which)
+    peers = mirror_urls(peers) + (read_peers(peers_file) if peers_file else [])
+    _fetch(resources, which, mirror_url, force, reporthook, scheduler, peers, metrics, events, trace)
+    failed = _invalid(resources, which, metrics, events, trace)
     if failed:
         juju_log('Failed to fetch resource%s: %s' % (
             's' if len(failed) > 1 else '',
@@ -164,6 +433,7 @@ def fetch(which=None, mirror_url=None, resources_yaml='resources.yaml',
         ), level='WARNING')
     else:
         juju_log('All resources successfully fetched', level='INFO')
+    flush_log()
     return not failed
 
 
@@ -203,7 +473,7 @@ def resource_spec(resource_name, resources_yaml='resources.yaml'):
 
 
 def install(which=None, mirror_url=None, destination=None, skip_top_level=False,
-            resources_yaml='resources.yaml'):
+            resources_yaml='resources.yaml', metrics=None, events=None, trace=None):
     """
     Install one or more resources.
 
@@ -228,7 +498,29 @@ def install(which=None, mirror_url=None, destination=None, skip_top_level=False,
     :param str resources_yaml: Location of the yaml file containing the
         resource descriptions (default: ``resources.yaml``).
         Can be a local file name or a remote URL.
+    :param metrics: A :class:`~jujuresources.metrics.Metrics` in which to
+        record per-resource timings.
+    :param events: Callable to which to send a
+        :class:`~jujuresources.events.Event` for each archive member installed.
+    :param trace: A :class:`~jujuresources.trace.Trace` in which to record
+        a timeline of each phase of each resource.
     :returns: True if all resources were successfully installed.
     """
     resources = _load(resources_yaml, None)
-    return _install(resources, which, mirror_url, destination, skip_top_level)
+    try:
+        return _install(resources, which, mirror_url, destination, skip_top_level, metrics, events, trace)
+    finally:
+        flush_log()
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # asyncio is slow to import, so only load the async API when it's used
+        if name in ('async_fetch', 'async_verify', 'async_install'):
+            from jujuresources import aio
+            return getattr(aio, name)
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    __all__ += ['async_fetch', 'async_verify', 'async_install']
+elif sys.version_info >= (3, 5):
+    from jujuresources.aio import async_fetch, async_verify, async_install  # noqa
+    __all__ += ['async_fetch', 'async_verify', 'async_install']
@@ -0,0 +1,141 @@
+"""
+:mod:`asyncio` versions of the fetch / verify / install API, for use by
+callers that are already running an event loop.  Requires Python 3.5+.
+
+``pip`` is run with :func:`asyncio.create_subprocess_exec`, while hashing,
+archive extraction, and HTTP downloads (for which the standard library
+has no asyncio client) are run in the loop's default executor, so the
+number of threads in use is bounded by the executor rather than by the
+number of resources.
+"""
+import asyncio
+import subprocess
+import sys
+from functools import partial
+
+import jujuresources
+from jujuresources.backend import PyPIResource
+from jujuresources.backend import _mirror_failed
+from jujuresources.backend import ranked_mirrors
+
+
+def _run_in_executor(func, *args):
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(None, partial(func, *args))
+
+
+async def _async_invalid(resources, which):
+    subset = list(resources.subset(which))
+    results = await asyncio.gather(*[_run_in_executor(resource.verify) for resource in subset])
+    return set(resource.name for resource, valid in zip(subset, results) if not valid)
+
+
+async def _async_fetch_one(resource, mirror_url, semaphore, pip_lock):
+    if not isinstance(resource, PyPIResource) or resource.url:
+        async with semaphore:
+            await _run_in_executor(resource.fetch, mirror_url)
+        return
+    # pip downloads share package directories, so run them one at a time
+    async with pip_lock, semaphore:
+        for index_url in await _run_in_executor(ranked_mirrors, mirror_url) + [None]:
+            cmd = await _run_in_executor(resource._prepare_download, index_url)
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output, _ = await proc.communicate()
+            if proc.returncode:
+                sys.stderr.write('Error fetching {}:\n{}\n'.format(resource.name, output.decode('utf8', 'replace')))
+                _mirror_failed(index_url)
+                continue
+            await _run_in_executor(resource._process_download, index_url)
+            return
+
+
+async def _async_fetch(resources, which, mirror_url, force=False, reporthook=None, concurrency=8):
+    invalid = await _async_invalid(resources, which)
+    semaphore = asyncio.Semaphore(concurrency)
+    pip_lock = asyncio.Lock()
+    fetches = []
+    for resource in resources.subset(which):
+        if resource.name not in invalid and not force:
+            continue
+        if reporthook:
+            reporthook(resource.name)
+        fetches.append(_async_fetch_one(resource, mirror_url, semaphore, pip_lock))
+    await asyncio.gather(*fetches)
+
+
+async def _async_install_files(resources, destination, skip_top_level):
+    # extracted sequentially, since they may share a destination
+    success = True
+    for resource in resources:
+        success = await _run_in_executor(resource.install, destination, skip_top_level) and success
+    return success
+
+
+async def _async_install_pypi(resources, mirror_url):
+    if not resources:
+        return True
+    cmd = await _run_in_executor(PyPIResource._install_group_cmd, resources, mirror_url)
+    proc = await asyncio.create_subprocess_exec(*cmd)
+    return await proc.wait() == 0
+
+
+async def _async_install(resources, which, mirror_url, destination, skip_top_level):
+    pypi_resources = []
+    file_resources = []
+    for resource in resources.subset(which):
+        if isinstance(resource, PyPIResource):
+            pypi_resources.append(resource)
+        else:
+            file_resources.append(resource)
+    results = await asyncio.gather(
+        _async_install_files(file_resources, destination, skip_top_level),
+        _async_install_pypi(pypi_resources, mirror_url))
+    return all(results)
+
+
+async def async_verify(which=None, resources_yaml='resources.yaml'):
+    """
+    Coroutine version of :func:`jujuresources.verify`, which hashes the
+    resources concurrently.
+    """
+    resources = await _run_in_executor(jujuresources._load, resources_yaml, None)
+    return not await _async_invalid(resources, which)
+
+
+async def async_fetch(which=None, mirror_url=None, resources_yaml='resources.yaml',
+                      force=False, reporthook=None, concurrency=8):
+    """
+    Coroutine version of :func:`jujuresources.fetch`, which fetches the
+    resources concurrently.
+
+    :param int concurrency: Maximum number of resources to fetch at once
+        (default: 8).
+    """
+    resources = await _run_in_executor(jujuresources._load, resources_yaml, None)
+    if reporthook is None:
+        reporthook = lambda r: jujuresources.juju_log('Fetching %s' % r, level='INFO')  # noqa
+    await _async_fetch(resources, which, mirror_url, force, reporthook, concurrency)
+    failed = await _async_invalid(resources, which)
+    if failed:
+        jujuresources.juju_log('Failed to fetch resource%s: %s' % (
+            's' if len(failed) > 1 else '',
+            ', '.join(failed)
+        ), level='WARNING')
+    else:
+        jujuresources.juju_log('All resources successfully fetched', level='INFO')
+    await _run_in_executor(jujuresources.flush_log)
+    return not failed
+
+
+async def async_install(which=None, mirror_url=None, destination=None, skip_top_level=False,
+                        resources_yaml='resources.yaml'):
+    """
+    Coroutine version of :func:`jujuresources.install`.  File resources are
+    extracted while ``pip`` installs the PyPI resources.
+    """
+    resources = await _run_in_executor(jujuresources._load, resources_yaml, None)
+    try:
+        return await _async_install(resources, which, mirror_url, destination, skip_top_level)
+    finally:
+        await _run_in_executor(jujuresources.flush_log)
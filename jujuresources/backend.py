@@ -1,23 +1,326 @@
-from contextlib import closing
+import base64
+import binascii
+from contextlib import closing, contextmanager
 import hashlib
+import json
 import os
+import random
 import re
 import shutil
+import socket
+import ssl
 import subprocess
 import sys
 import tarfile
+import threading
+import time
 import zipfile
+import zlib
 
 try:
     # Python 3
     from urllib.parse import urlparse, urljoin, parse_qs
     from hashlib import algorithms_available as hashlib_algs
-    from urllib.request import urlopen
+    from urllib.request import urlopen, Request
+    from urllib.error import URLError, HTTPError
+    basestring = str
+    from sys import intern
+    _connection_errors = (socket.timeout, ConnectionError)
 except ImportError:
     # Python 2
     from urlparse import urlparse, urljoin, parse_qs
     from hashlib import algorithms as hashlib_algs
-    from urllib2 import urlopen
+    from urllib2 import urlopen, Request, URLError, HTTPError
+    _connection_errors = (socket.timeout, socket.error)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from jujuresources import chunks
+from jujuresources.events import Event
+
+
+_hash_suffixes = frozenset(hashlib_algs)
+
+
+# hashlib names mapped to the names used in HTTP Digest headers (RFC 3230)
+DIGEST_ALGORITHMS = {
+    'md5': 'md5',
+    'sha1': 'sha',
+    'sha256': 'sha-256',
+    'sha512': 'sha-512',
+}
+
+
+def parse_digest(headers, hash_type):
+    """
+    Extract the hex digest of type `hash_type` from the ``Repr-Digest`` or
+    ``Digest`` headers of an HTTP response, or return ``None`` if the
+    server didn't provide one.
+    """
+    name = DIGEST_ALGORITHMS.get(hash_type)
+    if not name:
+        return None
+    for header in ('Repr-Digest', 'Digest'):
+        value = headers.get(header)
+        if not isinstance(value, basestring):
+            continue
+        for item in value.split(','):
+            alg, _, encoded = item.strip().partition('=')
+            if alg.strip().lower() != name:
+                continue
+            try:
+                digest = base64.b64decode(encoded.strip().strip(':'))
+            except (TypeError, ValueError, binascii.Error):
+                return None
+            if len(digest) != hashlib.new(hash_type).digest_size:
+                return None
+            return binascii.hexlify(digest).decode('ascii')
+    return None
+
+
+# content-codings we can decode when fetching from a mirror
+ACCEPT_ENCODING = 'zstd, gzip' if zstandard else 'gzip'
+
+
+# optional TokenBucket limiting the combined rate of all downloads
+THROTTLE = None
+
+
+def _content_decoder(encoding):
+    if not isinstance(encoding, basestring):
+        return None
+    encoding = encoding.strip().lower()
+    if encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'zstd' and zstandard:
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def decode_content(data, encoding):
+    """
+    Undo the ``Content-Encoding`` of an HTTP response body.
+    """
+    decoder = _content_decoder(encoding)
+    if not decoder:
+        return data
+    return decoder.decompress(data) + decoder.flush()
+
+
+def _copy_response(res_in, res_out, encoding=None, name=None):
+    """
+    Stream an HTTP response body to `res_out`, undoing its `encoding`,
+    and subject to the global :data:`THROTTLE`, if any.  If `name` is
+    given, ``bytes`` events are sent for that resource.
+    """
+    decoder = _content_decoder(encoding)
+    report = name is not None and EVENTS is not None
+    if report:
+        size = None if decoder else res_in.info().get('Content-Length')
+        size = int(size) if size and size.isdigit() else None
+        total = 0
+    for chunk in iter(lambda: res_in.read(64 * 1024), b''):
+        if THROTTLE:
+            THROTTLE.consume(len(chunk))
+        if decoder:
+            chunk = decoder.decompress(chunk)
+        if chunk:
+            res_out.write(chunk)
+            if report:
+                total += len(chunk)
+                _emit('bytes', name, bytes=len(chunk), total=total, size=size)
+    if decoder:
+        tail = decoder.flush()
+        if tail:
+            res_out.write(tail)
+            if report:
+                total += len(tail)
+                _emit('bytes', name, bytes=len(tail), total=total, size=size)
+
+
+# number of times to retry a download after a transient error, and the
+# base and maximum delays (in seconds) of the exponential backoff between tries
+RETRIES = 3
+RETRY_BACKOFF = 1.0
+RETRY_BACKOFF_MAX = 30.0
+
+
+def mirror_urls(mirror_url):
+    """
+    Return `mirror_url` as a list of mirrors to try, in order.  It can be
+    ``None``, a single URL, a comma-separated string of URLs, or a list.
+    """
+    if not mirror_url:
+        return []
+    if isinstance(mirror_url, basestring):
+        mirror_url = mirror_url.split(',')
+    return [url.strip() for url in mirror_url if url.strip()]
+
+
+# optional MirrorRanking used to order mirrors from fastest to slowest
+RANKING = None
+
+
+def ranked_mirrors(mirror_url):
+    """
+    Return the mirrors in `mirror_url` (see :func:`mirror_urls`), fastest
+    first according to the global :data:`RANKING`, if any.
+    """
+    mirrors = mirror_urls(mirror_url)
+    return RANKING.rank(mirrors) if RANKING else mirrors
+
+
+def _mirror_failed(mirror_url):
+    if RANKING and mirror_url:
+        RANKING.failed(mirror_url)
+
+
+# optional list of the mirror URLs of peer units, from which resources are
+# fetched before trying any mirror, and the number of peers to try for each
+PEERS = None
+PEER_ATTEMPTS = 3
+
+
+# whether to assemble resources from the chunks they share with older local
+# versions, fetching only the missing chunks from the mirror, and the seconds
+# to wait for the mirror before falling back to fetching the whole resource
+DELTA = False
+DELTA_TIMEOUT = 30
+
+
+# optional dict in which long-running processes remember the results of
+# verifying files, keyed by their path, size, mtime and expected hash
+VERIFIED = None
+
+
+# optional Metrics in which to record per-resource timings and sizes, and
+# optional Trace in which to record when each phase ran
+METRICS = None
+TRACE = None
+
+
+def _record(name, metric, value):
+    if METRICS is not None:
+        METRICS.add(name, metric, value)
+
+
+@contextmanager
+def _timed(name, metric):
+    """
+    Record the time spent in the context as `metric` of the resource
+    called `name`, in the global :data:`METRICS` and :data:`TRACE`, if any.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        _record(name, metric, end - start)
+        if TRACE is not None:
+            TRACE.add(name, metric, start, end)
+
+
+# optional callable to which an Event is sent for each step of fetching,
+# verifying and installing resources (see jujuresources.events)
+EVENTS = None
+_events_lock = threading.RLock()
+
+
+def _emit(event_type, name, **data):
+    events = EVENTS
+    if events is not None:
+        with _events_lock:  # resources are fetched in parallel
+            events(Event(event_type, name, time.time(), data))
+
+
+def read_peers(filename):
+    """
+    Read the URLs of peer units from `filename`, one per line, ignoring
+    blank lines and ``#`` comments.  A missing file means no peers.
+    """
+    try:
+        with open(filename) as fp:
+            return [line.strip() for line in fp if line.strip() and not line.strip().startswith('#')]
+    except IOError:
+        return []
+
+
+def _is_transient(error):
+    if isinstance(error, HTTPError):
+        return error.code >= 500 or error.code in (408, 429)
+    if isinstance(error, URLError):
+        error = error.reason  # e.g. connection refused, or a missing file:// path
+        if isinstance(error, socket.gaierror):
+            return error.errno == getattr(socket, 'EAI_AGAIN', None)  # temporary DNS failure
+    if isinstance(error, ssl.SSLError):
+        return False  # e.g. certificate verification failed (Python 2 makes these socket errors)
+    return isinstance(error, _connection_errors)
+
+
+def retry(func, *args):
+    """
+    Call `func` with `args`, retrying up to :data:`RETRIES` times if it
+    raises a transient network error, with jittered exponential backoff
+    between tries.  Other errors, or the last one, are raised.
+    """
+    for attempt in range(RETRIES + 1):
+        try:
+            return func(*args)
+        except IOError as e:
+            if attempt == RETRIES or not _is_transient(e):
+                raise
+            time.sleep(random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt)))
+
+
+def _makedirs(path):
+    """
+    Create `path` if it doesn't exist, even if another fetch is racing to.
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _listfiles(dirname):
+    """
+    List the names of the regular files in `dirname`, using a single
+    ``scandir`` pass where available rather than a ``stat`` per entry.
+    """
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(dirname):
+            if entry.is_file():
+                yield entry.name
+    else:
+        for filename in os.listdir(dirname):
+            if os.path.isfile(os.path.join(dirname, filename)):
+                yield filename
+
+
+def _listdirs(dirname):
+    """
+    List the names of the subdirectories of `dirname`.
+    """
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(dirname):
+            if entry.is_dir():
+                yield entry.name
+    else:
+        for filename in os.listdir(dirname):
+            if os.path.isdir(os.path.join(dirname, filename)):
+                yield filename
+
+
+def _intern(value):
+    # Python 2 can only intern byte strings
+    try:
+        return intern(value)
+    except TypeError:
+        return value
 
 
 class ALL(object):
@@ -28,17 +331,52 @@ class ALL(object):
 
 
 class ResourceContainer(dict):
+    """
+    Maps resource names to :class:`Resource` instances, which are only
+    created from their definitions when they are first looked up, so that
+    using a single resource doesn't pay for every other one in the file.
+    """
     def __init__(self, output_dir):
         super(ResourceContainer, self).__init__()
         self._required = set()
+        self._definitions = {}
         self.output_dir = output_dir
 
     def add_required(self, name, resource):
-        self[name] = Resource.get(name, resource, self.output_dir)
+        self.add_optional(name, resource)
         self._required.add(name)
 
     def add_optional(self, name, resource):
-        self[name] = Resource.get(name, resource, self.output_dir)
+        super(ResourceContainer, self).pop(name, None)
+        self._definitions[name] = resource
+
+    def __missing__(self, name):
+        definition = self._definitions.pop(name)
+        if not self._definitions:
+            self._definitions = {}  # dicts don't shrink as items are removed
+        resource = self[name] = Resource.get(name, definition, self.output_dir)
+        return resource
+
+    def __contains__(self, name):
+        return super(ResourceContainer, self).__contains__(name) or name in self._definitions
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return super(ResourceContainer, self).__len__() + len(self._definitions)
+
+    def keys(self):
+        return list(super(ResourceContainer, self).keys()) + list(self._definitions)
+
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
 
     def all(self):
         return self.values()
@@ -60,7 +398,14 @@ class Resource(object):
     """
     Base class for a Resource.
     Handles local file resources (with explicit ``filename`` or ``destination``).
+
+    Resources use ``__slots__`` to keep large resources files compact.
+    ``__dict__`` is kept so instances can still be patched, but it is
+    only allocated for those that are.
     """
+    __slots__ = ('name', 'source', 'filename', 'destination', 'spec', 'hash', 'hash_type',
+                 'skip_hash', 'output_dir', '__dict__')
+
     @classmethod
     def get(cls, name, definition, output_dir):
         """
@@ -81,9 +426,9 @@ class Resource(object):
             'destination', os.path.join(output_dir, self.filename))
         self.spec = self.destination
         self.hash = definition.get('hash', '')
-        self.hash_type = definition.get('hash_type', '')
+        self.hash_type = _intern(definition.get('hash_type', ''))
         self.skip_hash = definition.get('skip_hash', False)
-        self.output_dir = output_dir
+        self.output_dir = _intern(output_dir)
 
     def fetch(self, mirror_url=None):
         return
@@ -95,10 +440,23 @@ class Resource(object):
             return True  # for testing use only
         if self.hash_type not in hashlib_algs:
             return False
-        with open(self.destination, 'rb') as fp:
+        if VERIFIED is None:
+            return self._check_hash()
+        st = os.stat(self.destination)
+        key = (self.destination, st.st_size, st.st_mtime, self.hash_type, self.hash)
+        if key not in VERIFIED:
+            VERIFIED[key] = self._check_hash()
+        return VERIFIED[key]
+
+    def _check_hash(self):
+        with _timed(self.name, 'hash_seconds'), open(self.destination, 'rb') as fp:
             hash = hashlib.new(self.hash_type)
+            size = os.fstat(fp.fileno()).st_size if EVENTS is not None else None
             for chunk in iter(lambda: fp.read(16*1024), b''):  # read chunks until nothing returned
                 hash.update(chunk)
+                if size is not None:
+                    _emit('hash_progress', self.name, bytes=fp.tell(), size=size)
+            _record(self.name, 'hash_bytes', fp.tell())
             if self.hash != hash.hexdigest():
                 return False
         return True
@@ -128,19 +486,27 @@ class Resource(object):
                     member.filename = path  # zipfiles
                 yield member
 
+        def report_members(members):
+            for member in members:
+                if EVENTS is not None:
+                    path = member.path if hasattr(member, 'path') else member.filename
+                    _emit('extract_member', self.name, member=path)
+                yield member
+
         if not os.path.exists(destination):
             os.makedirs(destination)
 
-        if tarfile.is_tarfile(self.destination):
-            with tarfile.open(self.destination) as tf:
-                tf.extractall(destination, members=filter_members(tf))
-        elif zipfile.is_zipfile(self.destination):
-            with zipfile.ZipFile(self.destination, 'r') as zf:
-                zf.extractall(destination, members=filter_members(zf))
-        elif self._is_bugged_tarfile():
-            self._handle_bugged_tarfile(destination, skip_top_level)
-        else:
-            shutil.copy2(self.destination, destination)
+        with _timed(self.name, 'extract_seconds'):
+            if tarfile.is_tarfile(self.destination):
+                with tarfile.open(self.destination) as tf:
+                    tf.extractall(destination, members=report_members(filter_members(tf)))
+            elif zipfile.is_zipfile(self.destination):
+                with zipfile.ZipFile(self.destination, 'r') as zf:
+                    zf.extractall(destination, members=report_members(filter_members(zf)))
+            elif self._is_bugged_tarfile():
+                self._handle_bugged_tarfile(destination, skip_top_level)
+            else:
+                shutil.copy2(self.destination, destination)
         return True
 
     def _is_bugged_tarfile(self):
@@ -164,10 +530,13 @@ class Resource(object):
         args = ['tar', '-xzf', self.destination, '-C', destination]
         if skip_top_level:
             args.extend(['--strip-components', '1'])
-        subprocess.check_call(args)
+        with _timed(self.name, 'tar_seconds'):
+            subprocess.check_call(args)
 
 
 class URLResource(Resource):
+    __slots__ = ('url',)
+
     def __init__(self, name, definition, output_dir):
         super(URLResource, self).__init__(name, definition, output_dir)
         self.url = definition.get('url', '')
@@ -178,12 +547,39 @@ class URLResource(Resource):
             'destination', os.path.join(self.output_dir, name, self.filename))
 
     def fetch(self, mirror_url=None):
-        if mirror_url:
-            url = urljoin(mirror_url, os.path.join(self.name, self.filename))
-        else:
+        """
+        Download the resource from each of the mirrors in `mirror_url` in turn
+        (see :func:`ranked_mirrors`), then from its upstream URL, until one
+        succeeds.  Transient errors are retried (see :func:`retry`).
+
+        If there are any :data:`PEERS`, a verified copy is first sought from
+        them.  If :data:`DELTA` is set, only the parts of the resource which
+        differ from older local versions are fetched from mirrors.
+        """
+        sources = [(urljoin(mirror, os.path.join(self.name, self.filename)), mirror)
+                   for mirror in ranked_mirrors(mirror_url)]
+        if self.url:
             url = self.url
-        if url.startswith('./'):
-            url = url[2:]  # urlretrieve complains about this for some reason
+            if url.startswith('./'):
+                url = url[2:]  # urlretrieve complains about this for some reason
+            sources.append((url, None))
+
+        if not os.path.exists(os.path.dirname(self.destination)):
+            _makedirs(os.path.dirname(self.destination))
+        if self._fetch_from_peers():
+            return
+        for url, mirror_url in sources:
+            if DELTA and mirror_url and self._fetch_delta(url):
+                return
+            try:
+                digest = retry(self._download, url, mirror_url)
+                break
+            except (IOError, zlib.error) as e:
+                sys.stderr.write('Error fetching {}: {}\n'.format(url, e))
+                _emit('failed', self.name, error=e, url=url)
+                _mirror_failed(mirror_url)
+        else:
+            return  # ignore download errors; they will be caught by verify
 
         if urlparse(self.hash).scheme:
             hash_url_parts = urlparse(self.hash)
@@ -191,27 +587,147 @@ class URLResource(Resource):
             hash_url = urljoin(mirror_url, os.path.join(self.name, hash_filename)) if mirror_url else self.hash
             hash_dst = os.path.join(os.path.dirname(self.destination), hash_filename)
             try:
-                with closing(urlopen(hash_url)) as hash_in, open(hash_dst, 'w+b') as hash_out:
-                    hash_out.write(hash_in.read())
+                retry(self._download_hash, hash_url, hash_dst)
                 with open(hash_dst) as fp:
                     self.hash = fp.read(8*1024).strip()  # hashes should never be that big
             except IOError as e:
                 sys.stderr.write('Error fetching hash {}: {}\n'.format(hash_url, e))
                 return  # ignore download errors; they will be caught by verify
+            if digest and digest != self.hash:
+                # a digest header only describes the bytes the server has, so it
+                # can't replace the stored hash, but it shows where a bad copy came from
+                sys.stderr.write('Copy of {} at {} does not match {}\n'.format(self.name, url, hash_url))
 
-        if not os.path.exists(os.path.dirname(self.destination)):
-            os.makedirs(os.path.dirname(self.destination))
+    def _fetch_from_peers(self):
+        """
+        Try to download the resource from a few randomly chosen
+        :data:`PEERS`, returning True once a copy passes :meth:`verify`.
+        """
+        if not PEERS or self.skip_hash or not self.hash or urlparse(self.hash).scheme:
+            return False  # a peer's copy can't be trusted without a known hash
+        peers = mirror_urls(PEERS)
+        for peer in random.sample(peers, min(PEER_ATTEMPTS, len(peers))):
+            try:
+                self._download(urljoin(peer, os.path.join(self.name, self.filename)), peer)
+            except (IOError, zlib.error):
+                continue  # peers are only an optimization; don't retry
+            if self.verify():
+                return True
+        return False
+
+    def _old_versions(self):
+        """
+        Find local files which are likely older versions of the resource,
+        e.g. ``spark-2.1.0.tgz`` for ``spark-2.1.1.tgz``.
+        """
+        dirname = os.path.dirname(self.destination) or '.'
+        prefix = re.split(r'[-_.]?\d', self.filename, 1)[0]
+        if not prefix or not os.path.isdir(dirname):
+            return []
+        old_versions = []
+        for filename in _listfiles(dirname):
+            if not filename.startswith(prefix) or filename.endswith(('.part', chunks.SUFFIX)):
+                continue
+            if filename.rpartition('.')[2] in _hash_suffixes:
+                continue
+            old_versions.append(os.path.join(dirname, filename))
+        return sorted(old_versions, key=lambda path: path != self.destination)
+
+    def _fetch_delta(self, url):
+        """
+        Assemble the resource from the chunks listed in the mirror's chunk
+        index for `url` (see :mod:`jujuresources.chunks`), copying those it
+        shares with older local versions and fetching the rest with
+        ``Range`` requests.  Returns True if the result passes :meth:`verify`.
+        """
+        if self.skip_hash or not self.hash or urlparse(self.hash).scheme:
+            return False  # can't tell if the result is right
+        old_versions = self._old_versions()
+        if not old_versions:
+            return False
+        try:
+            request = Request(url + chunks.SUFFIX, headers={'Accept-Encoding': ACCEPT_ENCODING})
+            with closing(urlopen(request, timeout=DELTA_TIMEOUT)) as fp:
+                index = chunks.load_index(decode_content(fp.read(), fp.info().get('Content-Encoding')))
+        except (IOError, ValueError, zlib.error):
+            return False
+        local = chunks.local_chunks(old_versions, index)
+        if not local:
+            return False
+        partial = self.destination + '.part'
+        try:
+            with open(partial, 'wb') as res_out:
+                offset = 0
+                missing_start = None
+                for length, digest in index['chunks'] + [(0, None)]:
+                    source = local.get(digest)
+                    if (source or digest is None) and missing_start is not None:
+                        self._download_range(url, missing_start, offset - missing_start, res_out)
+                        missing_start = None
+                    if source:
+                        path, source_offset, _ = source
+                        with open(path, 'rb') as fp:
+                            fp.seek(source_offset)
+                            res_out.write(fp.read(length))
+                    elif missing_start is None and digest is not None:
+                        missing_start = offset
+                    offset += length
+            if os.path.exists(self.destination):
+                os.remove(self.destination)
+            os.rename(partial, self.destination)
+        except (IOError, zlib.error) as e:
+            sys.stderr.write('Error fetching changes to {}: {}\n'.format(url, e))
+            if os.path.exists(partial):
+                os.remove(partial)
+            return False
+        return self.verify()
+
+    def _download_range(self, url, start, length, res_out):
+        request = Request(url, headers={'Range': 'bytes={}-{}'.format(start, start + length - 1)})
+        with _timed(self.name, 'first_byte_seconds'):
+            res_in = urlopen(request, timeout=DELTA_TIMEOUT)
+        with closing(res_in):
+            if res_in.getcode() != 206:
+                raise IOError('Range requests are not supported by {}'.format(url))
+            before = res_out.tell()
+            with _timed(self.name, 'transfer_seconds'):
+                _copy_response(res_in, res_out, name=self.name)
+            _record(self.name, 'transfer_bytes', res_out.tell() - before)
+            if res_out.tell() - before != length:
+                raise IOError('Incomplete range from {}'.format(url))
+
+    def _download(self, url, mirror_url):
+        """
+        Download `url` to the destination, returning the digest the server
+        sent for it, if any.
+        """
         if os.path.exists(self.destination):
             os.remove(self.destination)  # urlretrieve won't overwrite
-        try:
-            with closing(urlopen(url)) as res_in, open(self.destination, 'w+b') as res_out:
-                res_out.write(res_in.read())
-        except IOError as e:
-            sys.stderr.write('Error fetching {}: {}\n'.format(self.url, e))
-            return  # ignore download errors; they will be caught by verify
+        if mirror_url:
+            # our mirror can send text-like resources compressed
+            url = Request(url, headers={'Accept-Encoding': ACCEPT_ENCODING})
+        with _timed(self.name, 'first_byte_seconds'):
+            res_in = urlopen(url)
+        with closing(res_in), open(self.destination, 'w+b') as res_out:
+            headers = res_in.info()
+            encoding = headers.get('Content-Encoding') if mirror_url else None
+            with _timed(self.name, 'transfer_seconds'):
+                _copy_response(res_in, res_out, encoding, self.name)
+            _record(self.name, 'transfer_bytes', res_out.tell())
+            return parse_digest(headers, self.hash_type)
+
+    @staticmethod
+    def _download_hash(hash_url, hash_dst):
+        with closing(urlopen(hash_url)) as hash_in, open(hash_dst, 'w+b') as hash_out:
+            hash_out.write(hash_in.read())
 
 
 class PyPIResource(URLResource):
+    __slots__ = ('package_name', 'destination_dir')
+    INDEX_MANIFEST = '.jujuresources-index.json'
+    _local_hash_cache = {}
+    _index_lock = threading.Lock()
+
     def __init__(self, name, definition, output_dir):
         super(PyPIResource, self).__init__(name, definition, output_dir)
         self.spec = definition.get('pypi', '')
@@ -242,17 +758,37 @@ class PyPIResource(URLResource):
     def fetch(self, mirror_url=None):
         if self.url:
             return super(PyPIResource, self).fetch(mirror_url)
+        # pip does its own retrying, so we only need to fail over
+        for index_url in ranked_mirrors(mirror_url) + [None]:
+            cmd = self._prepare_download(index_url)
+            try:
+                with _timed(self.name, 'pip_seconds'):
+                    subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as e:  # noqa
+                sys.stderr.write('Error fetching {}:\n{}\n'.format(self.name, e.output))
+                _mirror_failed(index_url)
+                continue
+            self._process_download(index_url)
+            return
+
+    def _prepare_download(self, mirror_url):
+        """
+        Prepare the destination directory for `pip`, and return the command
+        to run to download the package and its dependencies into it.
+        """
         if os.path.exists(self.destination_dir):
             shutil.rmtree(self.destination_dir)  # `pip --download` won't overwrite
         os.makedirs(self.destination_dir)
         cmd = ['pip', 'install', self.spec, '--download', self.destination_dir]
         if mirror_url:
             cmd.extend(['-i', mirror_url])
-        try:
-            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:  # noqa
-            sys.stderr.write('Error fetching {}:\n{}\n'.format(self.name, e.output))
-            return
+        return cmd
+
+    def _process_download(self, mirror_url):
+        """
+        Record the hashes of the files downloaded by `pip`, and move the
+        dependencies into their own package directories.
+        """
         if not mirror_url:
             mirror_url = 'https://pypi.python.org/simple'
         mirror_url = mirror_url.rstrip('/') + '/'  # ensure trailing slash
@@ -279,19 +815,48 @@ class PyPIResource(URLResource):
             return
         if self.url:
             return
-        if not os.path.isdir(self.destination_dir):
-            return
-        for filename in os.listdir(self.destination_dir):
-            fullname = os.path.join(self.destination_dir, filename)
-            for hash_type in hashlib_algs:
-                hash_file = '{}.{}'.format(fullname, hash_type)
-                if os.path.isfile(hash_file):
-                    self.filename = filename
-                    self.destination = fullname
-                    self.hash_type = hash_type.lower()
-                    with open(hash_file) as fp:
-                        self.hash = fp.readline().strip()
-                    return
+        for filename, hash_type, hash in self._find_local_artifacts(self.destination_dir):
+            if hash_type:
+                self.filename, self.hash_type, self.hash = filename, hash_type, hash
+                self.destination = os.path.join(self.destination_dir, filename)
+                return
+
+    @classmethod
+    def _find_local_artifacts(cls, dirname):
+        """
+        Find all of the package files in `dirname`, returning a sorted list of
+        ``(filename, hash_type, hash)`` tuples.  The hash is read from a sidecar
+        file next to the package (e.g., ``foo.tgz`` and ``foo.tgz.md5``); if
+        there is none, `hash_type` and `hash` will be empty.
+
+        Results are cached by the directory's mtime, since this is called
+        on every :meth:`verify`.
+        """
+        try:
+            mtime = os.stat(dirname).st_mtime
+        except OSError:
+            return []
+        cached = cls._local_hash_cache.get(dirname)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        filenames = set(_listfiles(dirname))
+        hashes = {}
+        sidecars = set()
+        for filename in sorted(filenames):
+            base, _, hash_type = filename.rpartition('.')
+            if hash_type in _hash_suffixes and base in filenames:
+                sidecars.add(filename)
+                if base not in hashes:
+                    with open(os.path.join(dirname, filename)) as fp:
+                        hashes[base] = (hash_type.lower(), fp.readline().strip())
+        artifacts = []
+        for filename in sorted(filenames - sidecars):
+            if filename == 'index.html':
+                continue
+            hash_type, hash = hashes.get(filename, ('', ''))
+            artifacts.append((filename, hash_type, hash))
+        cls._local_hash_cache[dirname] = (mtime, artifacts)
+        return artifacts
 
     def get_remote_hash(self, filename, mirror_url):
         if self.skip_hash:
@@ -323,7 +888,7 @@ class PyPIResource(URLResource):
         old_dest = os.path.join(self.destination_dir, filename)
         new_dest = os.path.join(new_dir, filename)
         if not os.path.exists(new_dir):
-            os.makedirs(new_dir)
+            _makedirs(new_dir)
         os.rename(old_dest, new_dest)
         hash_type, hash = self.get_remote_hash(filename, mirror_url)
         if hash_type:
@@ -347,53 +912,114 @@ class PyPIResource(URLResource):
 
     @classmethod
     def _get_index(cls, url):
-        if not getattr(cls, '_index', None):
-            cls._index = set()
-            try:
-                with closing(urlopen(url)) as fp:
-                    for line in fp:
-                        matches = re.findall(r'<a href=(?:"[^"]*"|\'[^\']*\')>([^</]+)', line.decode('utf-8'))
-                        for project in matches:
-                            cls._index.add(project)
-            except IOError as e:
-                sys.stderr.write('Error fetching index {}: {}\n'.format(url, e))
+        with cls._index_lock:  # don't let other threads see a partial index
+            if not getattr(cls, '_index', None):
+                index = set()
+                try:
+                    with closing(urlopen(url)) as fp:
+                        for line in fp:
+                            matches = re.findall(r'<a href=(?:"[^"]*"|\'[^\']*\')>([^</]+)', line.decode('utf-8'))
+                            for project in matches:
+                                index.add(project)
+                except IOError as e:
+                    sys.stderr.write('Error fetching index {}: {}\n'.format(url, e))
+                cls._index = index
         return cls._index
 
-    def _write_file(self, filename, text):
+    @staticmethod
+    def _write_file(filename, text):
         with open(filename, 'w') as fp:
             fp.write(text)
 
     @classmethod
-    def build_pypi_indexes(cls, root_dir):
-        for entry in os.listdir(root_dir):
+    def build_pypi_indexes(cls, root_dir, force=False):
+        """
+        Write a PyPI "simple" index page for each mirrored package directory
+        in `root_dir`, as well as a root index page listing the packages.
+
+        A manifest of directory mtimes is kept in `root_dir` so that only
+        the directories which have changed since the last run are rescanned,
+        unless `force` is given.
+
+        Returns a list of the packages whose index pages were (re)written.
+        """
+        manifest_file = os.path.join(root_dir, cls.INDEX_MANIFEST)
+        manifest = {} if force else cls._read_manifest(manifest_file)
+        new_manifest = {}
+        updated = []
+        for entry in sorted(_listdirs(root_dir)):
+            if entry.startswith('.'):
+                continue  # server caches
             candidate = os.path.join(root_dir, entry)
-            if not os.path.isdir(candidate):
-                continue
-            res = PyPIResource(entry, {'pypi': entry}, root_dir)
-            res.get_local_hash()
-            if not res.hash_type:
+            mtime = os.stat(candidate).st_mtime
+            if manifest.get(entry, [None])[0] == mtime:
+                new_manifest[entry] = manifest[entry]
                 continue
-            res._write_file(os.path.join(candidate, 'index.html'), '\n'.join([
-                '<html>',
-                '  <head>',
-                '    <title>Links for {}</title>'.format(res.package_name),
-                '    <meta name="api-version" value="2" />',
-                '  </head>',
-                '  <body>',
-                '    <h1>Links for {}</h1>'.format(res.package_name),
-                '    <a href="{0.filename}#{0.hash_type}={0.hash}" rel="internal">'
-                '{0.filename}</h1>'.format(res),
-                '  </body>',
-                '</html>',
-            ]))
+            artifacts = cls._find_local_artifacts(candidate)
+            is_package = any(hash_type for _, hash_type, _ in artifacts)
+            if is_package:
+                cls._write_file(os.path.join(candidate, 'index.html'), '\n'.join(
+                    ['<html>',
+                     '  <head>',
+                     '    <title>Links for {}</title>'.format(entry),
+                     '    <meta name="api-version" value="2" />',
+                     '  </head>',
+                     '  <body>',
+                     '    <h1>Links for {}</h1>'.format(entry)] +
+                    ['    <a href="{0}{1}" rel="internal">{0}</a><br/>'.format(
+                        filename, '#{}={}'.format(hash_type, hash) if hash_type else '')
+                     for filename, hash_type, hash in artifacts] +
+                    ['  </body>',
+                     '</html>']))
+                mtime = os.stat(candidate).st_mtime  # adding index.html changes it
+                updated.append(entry)
+            new_manifest[entry] = [mtime, is_package]
+        packages = sorted(entry for entry, (_, is_package) in new_manifest.items() if is_package)
+        old_packages = sorted(entry for entry, (_, is_package) in manifest.items() if is_package)
+        root_index = os.path.join(root_dir, 'index.html')
+        if packages != old_packages or not os.path.exists(root_index):
+            cls._write_file(root_index, '\n'.join(
+                ['<html>',
+                 '  <head>',
+                 '    <title>Simple Index</title>',
+                 '    <meta name="api-version" value="2" />',
+                 '  </head>',
+                 '  <body>'] +
+                ['    <a href="{0}/">{0}</a><br/>'.format(package) for package in packages] +
+                ['  </body>',
+                 '</html>']))
+        if new_manifest != manifest:
+            cls._write_file(manifest_file, json.dumps(new_manifest))
+        return updated
+
+    @classmethod
+    def _read_manifest(cls, manifest_file):
+        try:
+            with open(manifest_file) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
 
     def install(self):
         if not self.verify():
             return False
-        return subprocess.call(['pip', 'install', self.destination]) == 0
+        with _timed(self.name, 'pip_seconds'):
+            return subprocess.call(['pip', 'install', self.destination]) == 0
 
     @classmethod
     def install_group(cls, resources, mirror_url=None):
+        cmd = cls._install_group_cmd(resources, mirror_url)
+        start = time.time()
+        result = subprocess.call(cmd)
+        end = time.time()
+        for resource in resources:
+            _record(resource.name, 'pip_seconds', end - start)
+        if TRACE is not None:
+            TRACE.add(', '.join(resource.name for resource in resources), 'pip_seconds', start, end)
+        return result == 0
+
+    @classmethod
+    def _install_group_cmd(cls, resources, mirror_url=None):
         to_install = []
         for resource in resources:
             if resource.verify():
@@ -403,6 +1029,9 @@ class PyPIResource(URLResource):
                 # otherwise, try installing directly from mirror
                 to_install.append(resource.spec)
         cmd = ['pip', 'install'] + to_install
-        if mirror_url:
-            cmd.extend(['-i', mirror_url])
-        return subprocess.call(cmd) == 0
+        mirrors = mirror_urls(mirror_url)
+        if mirrors:
+            cmd.extend(['-i', mirrors[0]])
+        for extra_url in mirrors[1:]:
+            cmd.extend(['--extra-index-url', extra_url])
+        return cmd
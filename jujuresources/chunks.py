@@ -0,0 +1,128 @@
+"""
+Content-defined chunking of resources, so that a new version of a
+resource can be assembled from the chunks it shares with an older one.
+
+Chunk boundaries are found with a "gear" rolling hash, so an insertion
+or deletion only changes the chunks around it, rather than shifting every
+chunk after it as fixed-size blocks would.  Each chunk is identified by
+its SHA-256 digest.
+
+Only the low bits of the hash are tested for a boundary, so only those
+are computed, which keeps the hash in small ints that CPython handles
+much faster.  Chunking is still CPU bound (several MB/s), which is why
+the mirror caches the indexes it serves.
+
+A chunk index is a JSON document describing a file's chunks::
+
+    {"min_size": 16384, "avg_size": 65536, "max_size": 262144,
+     "size": 81920, "chunks": [[65536, "<sha256>"], [16384, "<sha256>"]]}
+"""
+import hashlib
+import json
+
+SUFFIX = '.chunks'
+
+MIN_SIZE = 16 * 1024
+AVG_SIZE = 64 * 1024
+MAX_SIZE = 256 * 1024
+
+_GEAR = [int(hashlib.md5(str(i).encode('ascii')).hexdigest()[:16], 16) for i in range(256)]
+
+
+def _find_cut(buf, start, end, min_size, bits):
+    """
+    Return the offset in `buf` of the end of the chunk starting at `start`,
+    which is at most `end`.  A chunk ends where the low `bits` bits of the
+    hash are all zero.
+    """
+    if end - start <= min_size:
+        return end
+    mask = (1 << bits) - 1
+    gear = [g & mask for g in _GEAR]
+    h = 0
+    # the low bits of the hash only depend on the last `bits` bytes, so
+    # there's no need to roll it over the rest of the minimum chunk size
+    for b in buf[start + min_size - bits:start + min_size]:
+        h = ((h << 1) + gear[b]) & mask
+    i = start + min_size
+    for b in buf[i:end]:
+        h = ((h << 1) + gear[b]) & mask
+        i += 1
+        if not h:
+            return i
+    return end
+
+
+def iter_chunks(fp, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE):
+    """
+    Split the contents of the file object `fp` into content-defined chunks,
+    yielding each one as a byte string.
+    """
+    bits = avg_size.bit_length() - 1
+    buf = bytearray()
+    pos = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - pos < max_size:
+            data = fp.read(max(max_size, 1024 * 1024))
+            eof = not data
+            buf = buf[pos:] + data
+            pos = 0
+        if pos >= len(buf):
+            return
+        cut = _find_cut(buf, pos, min(len(buf), pos + max_size), min_size, bits)
+        yield bytes(buf[pos:cut])
+        pos = cut
+
+
+def build_index(path, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE):
+    """
+    Return the chunk index of the file at `path`.
+    """
+    index = {'min_size': min_size, 'avg_size': avg_size, 'max_size': max_size, 'size': 0, 'chunks': []}
+    with open(path, 'rb') as fp:
+        for chunk in iter_chunks(fp, min_size, avg_size, max_size):
+            index['chunks'].append([len(chunk), hashlib.sha256(chunk).hexdigest()])
+            index['size'] += len(chunk)
+    return index
+
+
+def load_index(data):
+    """
+    Parse and sanity check a JSON chunk index, raising :class:`ValueError`
+    if it is invalid.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    index = json.loads(data)
+    try:
+        sizes = [int(index[key]) for key in ('min_size', 'avg_size', 'max_size', 'size')]
+        chunks = [(int(length), str(digest)) for length, digest in index['chunks']]
+    except (KeyError, TypeError):
+        raise ValueError('Invalid chunk index')
+    if min(sizes[:3]) <= 0 or sum(length for length, _ in chunks) != sizes[3]:
+        raise ValueError('Invalid chunk index')
+    index['chunks'] = chunks
+    return index
+
+
+def local_chunks(paths, index):
+    """
+    Chunk the files in `paths` the same way as `index`, returning a dict
+    mapping the digests of the chunks which `index` needs to the
+    ``(path, offset, length)`` at which they can be found.
+    """
+    wanted = set(digest for _, digest in index['chunks'])
+    found = {}
+    for path in paths:
+        offset = 0
+        try:
+            with open(path, 'rb') as fp:
+                for chunk in iter_chunks(fp, index['min_size'], index['avg_size'], index['max_size']):
+                    digest = hashlib.sha256(chunk).hexdigest()
+                    if digest in wanted and digest not in found:
+                        found[digest] = (path, offset, len(chunk))
+                    offset += len(chunk)
+        except IOError:
+            continue
+    return found
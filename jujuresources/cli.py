@@ -1,19 +1,16 @@
 from __future__ import print_function
+import json
 import os
+import re
 import ssl
 import sys
 import socket
 import argparse
-from pkg_resources import iter_entry_points
 
 try:
-    # Python 3
-    from http.server import SimpleHTTPRequestHandler
-    from http.server import HTTPServer
+    from shlex import quote  # Python 3
 except ImportError:
-    # Python 2
-    from SimpleHTTPServer import SimpleHTTPRequestHandler
-    from SocketServer import TCPServer as HTTPServer
+    from pipes import quote  # Python 2
 
 from jujuresources import _fetch
 from jujuresources import _install
@@ -21,6 +18,13 @@ from jujuresources import _invalid
 from jujuresources import _load
 from jujuresources import ALL
 from jujuresources import backend
+from jujuresources.mirrors import MirrorRanking
+from jujuresources.scheduler import FetchScheduler
+
+# subcommands provided by this module, which can be dispatched to without
+# the (slow) search for subcommands registered by other packages
+SUBCOMMANDS = ['fetch', 'verify', 'install', 'resource_path', 'resource_spec', 'paths', 'index', 'serve',
+               'daemon']
 
 
 def arg(*args, **kwargs):
@@ -47,22 +51,51 @@ def argset(name, *args, **kwargs):
     return _arg
 
 
+def iter_entry_points(group):
+    """
+    List the entry points registered for `group`.
+    """
+    try:
+        from importlib.metadata import entry_points  # Python 3.8+
+    except ImportError:
+        from pkg_resources import iter_entry_points as _iter_entry_points
+        return list(_iter_entry_points(group))
+    eps = entry_points()
+    if hasattr(eps, 'select'):  # Python 3.10+
+        return list(eps.select(group=group))
+    return list(eps.get(group, []))
+
+
 print = print  # for testing
 _exit = sys.exit  # for testing
 
 
-def resources(argv=sys.argv[1:]):
+def resources(argv=sys.argv[1:], use_daemon=True):
     """
     Juju CLI subcommand for dispatching resources subcommands.
-    """
-    eps = iter_entry_points('jujuresources.subcommands')
-    ep_map = {ep.name: ep.load() for ep in eps}
 
-    parser = argparse.ArgumentParser()
+    Subcommands which a running ``juju-resources daemon`` can handle are
+    sent to it, unless `use_daemon` is false.
+    """
     if '--description' in argv:
         print('Manage and mirror charm resources')
         return 0
 
+    command = next((a for a in argv if not a.startswith('-')), None)
+    if use_daemon:
+        from jujuresources import daemon as _daemon
+        response = _daemon.request(argv) if command in _daemon.SUBCOMMANDS else None
+        if response is not None:
+            sys.stdout.write(response['stdout'])
+            sys.stderr.write(response['stderr'])
+            return _exit(response['status'])
+
+    ep_map = dict((name, globals()[name]) for name in SUBCOMMANDS)
+    if command not in ep_map:
+        ep_map.update((ep.name, ep.load()) for ep in iter_entry_points('jujuresources.subcommands'))
+
+    parser = argparse.ArgumentParser()
+
     subparsers = {}
     subparser_factory = parser.add_subparsers()
     subparsers['help'] = subparser_factory.add_parser('help', help='Display help for a subcommand')
@@ -87,20 +120,79 @@ def resources(argv=sys.argv[1:]):
         return _exit(opts.subcommand(opts) or 0)
 
 
+def _metrics(opts):
+    """
+    Return the Metrics to record in if ``--metrics`` was given, shared by
+    fetch and the verify which follows it.
+    """
+    if not opts.metrics:
+        return None
+    if getattr(opts, 'recorded_metrics', None) is None:
+        from jujuresources.metrics import Metrics
+        opts.recorded_metrics = Metrics()
+    return opts.recorded_metrics
+
+
+def _trace(opts):
+    """
+    Return the Trace to record in if ``--trace`` was given, shared by fetch
+    and the verify which follows it.
+    """
+    if not opts.trace:
+        return None
+    if getattr(opts, 'recorded_trace', None) is None:
+        from jujuresources.trace import Trace
+        opts.recorded_trace = Trace()
+    return opts.recorded_trace
+
+
+def _write_reports(opts):
+    if opts.metrics:
+        _metrics(opts).write(opts.metrics, opts.metrics_format)
+    if opts.trace:
+        _trace(opts).write(opts.trace)
+
+
 @arg('-r', '--resources', default='resources.yaml',
      help='File or URL containing the YAML resource descriptions (default: ./resources.yaml)')
 @arg('-d', '--output-dir', default=None,
      help='Directory to place the fetched resources (default: ./resources/)')
 @arg('-u', '--mirror-url',
-     help='URL at which the resources are mirrored')
+     help='URL at which the resources are mirrored; several can be given, '
+          'separated by commas, to be tried fastest first')
 @arg('-a', '--all', action='store_true',
      help='Include all optional resources as well as required')
 @arg('-q', '--quiet', action='store_true',
      help='Suppress output and only set the return code')
 @arg('-f', '--force', action='store_true',
      help='Force re-download of valid resources')
+@arg('--retries', type=int, default=backend.RETRIES,
+     help='Number of times to retry a download after a transient error '
+          '(default: %(default)s)')
+@arg('--delta', action='store_true',
+     help='Fetch only the parts of resources which differ from older local versions, '
+          'from mirrors which support it')
+@arg('--peers', default=None,
+     help='Comma-separated URLs of peer units running "serve --peer", from '
+          'which to fetch resources before trying the mirror')
+@arg('--peers-file', default=None,
+     help='File listing the URLs of peer units, one per line')
 @arg('-v', '--verbose', action='store_true',
      help='Write download error information to stderr')
+@arg('-j', '--jobs', type=int, default=4,
+     help='Maximum number of resources to fetch at once (default: 4)')
+@arg('--per-host', type=int, default=2,
+     help='Maximum number of simultaneous fetches from any one host (default: 2)')
+@arg('--rate-limit', type=int, default=None,
+     help='Cap the combined download rate at this many bytes per second')
+@arg('--metrics', default=None, metavar='FILE',
+     help='Write per-resource timings and sizes to FILE')
+@arg('--metrics-format', choices=['json', 'prometheus'], default=None,
+     help='Format of the --metrics file (default: prometheus if FILE ends in .prom, '
+          'otherwise json)')
+@arg('--trace', default=None, metavar='FILE',
+     help='Write a timeline of each phase of each resource to FILE, in the '
+          'Chrome Trace Event format (for chrome://tracing or ui.perfetto.dev)')
 @arg('resource_names', nargs='*',
      help='Names of specific resources to fetch (defaults to all required, '
           'or all if --all is given)')
@@ -114,7 +206,14 @@ def fetch(opts):
     reporthook = None if opts.quiet else lambda name: print('Fetching {}...'.format(name))
     if opts.verbose:
         backend.VERBOSE = True
-    _fetch(resources, opts.resource_names, opts.mirror_url, opts.force, reporthook)
+    backend.RETRIES = opts.retries
+    if opts.delta:
+        backend.DELTA = True
+    ranking = MirrorRanking(os.path.join(resources.output_dir, MirrorRanking.CACHE_FILE))
+    scheduler = FetchScheduler(opts.jobs, opts.per_host, opts.rate_limit, ranking)
+    peers = backend.mirror_urls(opts.peers) + (backend.read_peers(opts.peers_file) if opts.peers_file else [])
+    _fetch(resources, opts.resource_names, opts.mirror_url, opts.force, reporthook, scheduler, peers,
+           _metrics(opts), None, _trace(opts))
     return verify(opts)
 
 
@@ -126,6 +225,14 @@ def fetch(opts):
      help='Include all optional resources as well as required')
 @arg('-q', '--quiet', action='store_true',
      help='Suppress output and only set the return code')
+@arg('--metrics', default=None, metavar='FILE',
+     help='Write per-resource timings and sizes to FILE')
+@arg('--metrics-format', choices=['json', 'prometheus'], default=None,
+     help='Format of the --metrics file (default: prometheus if FILE ends in .prom, '
+          'otherwise json)')
+@arg('--trace', default=None, metavar='FILE',
+     help='Write a timeline of each phase of each resource to FILE, in the '
+          'Chrome Trace Event format (for chrome://tracing or ui.perfetto.dev)')
 @arg('resource_names', nargs='*',
      help='Names of specific resources to verify (defaults to all required, '
           'or all if --all is given)')
@@ -136,7 +243,8 @@ def verify(opts):
     resources = _load(opts.resources, opts.output_dir)
     if opts.all:
         opts.resource_names = ALL
-    invalid = _invalid(resources, opts.resource_names)
+    invalid = _invalid(resources, opts.resource_names, _metrics(opts), None, _trace(opts))
+    _write_reports(opts)
     if not invalid:
         if not opts.quiet:
             print("All resources successfully downloaded")
@@ -161,6 +269,14 @@ def verify(opts):
      help='Destination for archive or file resources to be installed to')
 @arg('-s', '--skip-top-level', action='store_true',
      help='Skip top-level members of archives, and extract children directly to destination')
+@arg('--metrics', default=None, metavar='FILE',
+     help='Write per-resource timings and sizes to FILE')
+@arg('--metrics-format', choices=['json', 'prometheus'], default=None,
+     help='Format of the --metrics file (default: prometheus if FILE ends in .prom, '
+          'otherwise json)')
+@arg('--trace', default=None, metavar='FILE',
+     help='Write a timeline of each phase of each resource to FILE, in the '
+          'Chrome Trace Event format (for chrome://tracing or ui.perfetto.dev)')
 @arg('resource_names', nargs='*',
      help='Names of specific resources to verify (defaults to all required, '
           'or all if --all is given)')
@@ -172,7 +288,8 @@ def install(opts):
     if opts.all:
         opts.resource_names = ALL
     success = _install(resources, opts.resource_names, opts.mirror_url,
-                       opts.destination, opts.skip_top_level)
+                       opts.destination, opts.skip_top_level, _metrics(opts), None, _trace(opts))
+    _write_reports(opts)
     if success:
         if not opts.quiet:
             print("All resources successfully installed")
@@ -216,6 +333,94 @@ def resource_spec(opts):
     print(resources[opts.resource_name].spec)
 
 
+@arg('-r', '--resources', default='resources.yaml',
+     help='File or URL containing the YAML resource descriptions (default: ./resources.yaml)')
+@arg('-d', '--output-dir', default=None,
+     help='Directory containing the fetched resources (default: ./resources/)')
+@arg('-s', '--shell', action='store_true',
+     help='Output shell variable assignments, for eval, instead of JSON')
+@arg('resource_names', nargs='*',
+     help='Names of specific resources to describe (defaults to all, '
+          'optional as well as required)')
+def paths(opts):
+    """
+    Output the path, spec, hash and verified state of many resources at once.
+    """
+    resources = _load(opts.resources, opts.output_dir)
+    unknown = [name for name in opts.resource_names if name not in resources]
+    if unknown:
+        sys.stderr.write('Invalid resource name: {}\n'.format(', '.join(unknown)))
+        return 1
+    selected = resources.subset(opts.resource_names or ALL)
+    prefixes = {}
+    for resource in selected:
+        prefixes.setdefault('RESOURCE_' + re.sub(r'[^A-Z0-9]', '_', resource.name.upper()), set()).add(resource.name)
+    clashes = sorted(' and '.join(sorted(names)) for names in prefixes.values() if len(names) > 1)
+    if opts.shell and clashes:
+        sys.stderr.write('Resource names map to the same shell variables: {}\n'.format(', '.join(clashes)))
+        return 1
+    info = {}
+    for resource in selected:
+        verified = resource.verify()  # fills in the details of PyPI resources
+        info[resource.name] = {
+            'path': resource.destination,
+            'spec': resource.spec,
+            'verified': verified,
+            'hash': resource.hash,
+            'hash_type': resource.hash_type,
+        }
+    if not opts.shell:
+        print(json.dumps(info, indent=2, sort_keys=True))
+        return
+    for prefix, (name,) in sorted(prefixes.items()):
+        for key in ('path', 'spec', 'hash', 'hash_type'):
+            print('{}_{}={}'.format(prefix, key.upper(), quote(info[name][key])))
+        print('{}_VERIFIED={}'.format(prefix, 'true' if info[name]['verified'] else 'false'))
+
+
+@arg('-r', '--resources', default='resources.yaml',
+     help='File or URL containing the YAML resource descriptions (default: ./resources.yaml)')
+@arg('-d', '--output-dir', default=None,
+     help='Directory containing the fetched resources (default: ./resources/)')
+@arg('-f', '--force', action='store_true',
+     help='Regenerate all index pages, even for unchanged packages')
+@arg('-q', '--quiet', action='store_true',
+     help='Suppress output and only set the return code')
+def index(opts):
+    """
+    Build or update the PyPI index pages for previously mirrored resources.
+    """
+    resources = _load(opts.resources, opts.output_dir)
+    opts.output_dir = resources.output_dir  # allow resources.yaml to set default output_dir
+    if not os.path.exists(opts.output_dir):
+        sys.stderr.write("Resources dir '{}' not found.  Did you fetch?\n".format(opts.output_dir))
+        return 1
+    updated = backend.PyPIResource.build_pypi_indexes(opts.output_dir, opts.force)
+    if not opts.quiet:
+        print("Updated {} package index{}".format(len(updated), '' if len(updated) == 1 else 'es'))
+
+
+@arg('-S', '--socket', default=None,
+     help='Unix socket on which to listen (default: $JUJU_RESOURCES_SOCKET, '
+          'or ./.jujuresources.sock)')
+@arg('--idle-timeout', type=float, default=None,
+     help='Exit after this many seconds without a request')
+def daemon(opts):
+    """
+    Run a resident server which answers fetch, verify, resource_path,
+    resource_spec and paths from memory
+    """
+    from jujuresources.daemon import ResourceDaemon
+    from jujuresources.daemon import default_socket
+
+    try:
+        server = ResourceDaemon(opts.socket or default_socket(), opts.idle_timeout)
+    except (IOError, OSError) as e:
+        sys.stderr.write('{}\n'.format(e))
+        return 1
+    server.serve()
+
+
 @arg('-r', '--resources', default='resources.yaml',
      help='File or URL containing the YAML resource descriptions (default: ./resources.yaml)')
 @arg('-d', '--output-dir', default=None,
@@ -226,24 +431,43 @@ def resource_spec(opts):
      help='Port on which to bind the mirror server')
 @arg('-s', '--ssl-cert', default=None,
      help='Path to an SSL certificate file (will run without SSL if not given)')
+@arg('-c', '--max-connections', type=int, default=100,
+     help='Maximum number of requests to handle concurrently (default: 100)')
+@arg('--peer', action='store_true',
+     help='Only serve resources which pass verification, for fetching by peer units')
 def serve(opts):
     """
     Run a light-weight HTTP server hosting previously mirrored resources
     """
+    from jujuresources.server import ChunkIndexCache
+    from jujuresources.server import CompressedCache
+    from jujuresources.server import DigestCache
+    from jujuresources.server import MirrorServer
+    from jujuresources.server import VerifiedFiles
+
     resources = _load(opts.resources, opts.output_dir)
     opts.output_dir = resources.output_dir  # allow resources.yaml to set default output_dir
     if not os.path.exists(opts.output_dir):
         sys.stderr.write("Resources dir '{}' not found.  Did you fetch?\n".format(opts.output_dir))
         return 1
     backend.PyPIResource.build_pypi_indexes(opts.output_dir)
+    digests = DigestCache(opts.output_dir)
+    digests.precompute(resources.all())
+    chunk_indexes = ChunkIndexCache(opts.output_dir)
+    chunk_indexes.precompute(resources.all())
+    verified = VerifiedFiles(resources.all(), digests) if opts.peer else None
     os.chdir(opts.output_dir)
 
-    HTTPServer.allow_reuse_address = True
-    httpd = HTTPServer((opts.host, opts.port), SimpleHTTPRequestHandler)
+    httpd = MirrorServer((opts.host, opts.port), max_connections=opts.max_connections,
+                         digests=digests, compressed=CompressedCache('.'), verified=verified,
+                         chunks=chunk_indexes)
 
     if opts.ssl_cert:
         httpd.socket = ssl.wrap_socket(httpd.socket, certfile=opts.ssl_cert, server_side=True)
 
     print("Serving at: http{}://{}:{}/".format(
         's' if opts.ssl_cert else '', socket.gethostname(), opts.port))
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    finally:
+        digests.save()  # any digests not yet saved in the background
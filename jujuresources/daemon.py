@@ -0,0 +1,171 @@
+"""
+Resident server which keeps resources loaded between CLI calls.
+
+``juju-resources daemon`` runs the subcommands in :data:`SUBCOMMANDS` for
+clients connecting to its Unix socket, keeping the parsed resources and
+the results of verifying them in memory between requests.  The CLI sends
+those subcommands to the daemon when its socket exists, and runs them
+itself otherwise.
+
+The client side, and the protocol, are in :mod:`jujuresources_client`,
+which the ``juju-resources`` command uses without importing this package.
+"""
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+
+try:
+    from socketserver import UnixStreamServer, StreamRequestHandler  # Python 3
+    from urllib.parse import urlparse
+    from urllib.request import url2pathname
+    from io import StringIO
+except ImportError:
+    from SocketServer import UnixStreamServer, StreamRequestHandler  # Python 2
+    from urlparse import urlparse
+    from urllib import url2pathname
+    from StringIO import StringIO
+
+import jujuresources
+from jujuresources import backend
+from jujuresources_client import SOCKET_FILE, SUBCOMMANDS, default_socket, request  # noqa
+
+# process-wide settings which subcommands change, and which are restored
+# after each request
+_SETTINGS = ['THROTTLE', 'RETRIES', 'RANKING', 'PEERS', 'DELTA', 'VERBOSE']
+
+
+class DaemonRequestHandler(StreamRequestHandler):
+    # seconds to wait for a client to send its request, so that one which
+    # never does can't block the daemon
+    timeout = 5
+
+    def handle(self):
+        try:
+            req = json.loads(self.rfile.read().decode('utf-8'))
+            argv = [str(arg) for arg in req['argv']]
+            cwd = req['cwd']
+        except (ValueError, KeyError, TypeError, socket.error):  # including socket.timeout
+            return
+        response = self.server.run(argv, cwd)
+        self.wfile.write(json.dumps(response).encode('utf-8'))
+
+
+class ResourceDaemon(UnixStreamServer):
+    """
+    Unix socket server which runs CLI subcommands in this process, one at
+    a time, since they change process-wide settings.
+
+    Resources loaded by earlier requests are reused until their
+    resources.yaml changes.  Remote ones are reused for
+    :data:`jujuresources.REVALIDATE_AFTER` seconds.  The daemon exits
+    after `idle_timeout` seconds without a request, if given.
+    """
+    def __init__(self, socket_file, idle_timeout=None, handler_class=DaemonRequestHandler):
+        if _listening(socket_file):
+            raise IOError('A daemon is already listening on {}'.format(socket_file))
+        if os.path.exists(socket_file):
+            os.remove(socket_file)  # left behind by a daemon that was killed
+        UnixStreamServer.__init__(self, socket_file, handler_class)
+        os.chmod(socket_file, 0o600)
+        self.cwd = os.getcwd()
+        self.idle_timeout = idle_timeout
+        self.timeout = 0.5  # how often to check for stop() or the idle timeout
+        self._stopped = False
+        self._last_request = time.time()
+        self._versions = {}
+
+    def serve(self):
+        """
+        Handle requests until :meth:`stop` is called, or none arrive for
+        `idle_timeout` seconds.
+        """
+        verified = backend.VERIFIED
+        backend.VERIFIED = {} if verified is None else verified
+        try:
+            while not self._stopped:
+                self.handle_request()
+        finally:
+            backend.VERIFIED = verified
+            self.server_close()
+
+    def stop(self):
+        self._stopped = True
+
+    def handle_timeout(self):
+        if self.idle_timeout and time.time() - self._last_request > self.idle_timeout:
+            self._stopped = True
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+    def run(self, argv, cwd):
+        """
+        Run the CLI subcommand `argv` for a client in `cwd`, returning its
+        exit status and output.
+        """
+        from jujuresources import cli
+
+        self._last_request = time.time()
+        command = next((arg for arg in argv if not arg.startswith('-')), None)
+        if command not in SUBCOMMANDS or os.path.realpath(cwd) != os.path.realpath(self.cwd):
+            return {}
+        self._forget_changed()
+        settings = dict((name, getattr(backend, name, None)) for name in _SETTINGS)
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            try:
+                status = cli.resources(argv, use_daemon=False)
+            except SystemExit as e:
+                status = e.code
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            if status is None:
+                status = 0
+            elif not isinstance(status, int):
+                sys.stderr.write('{}\n'.format(status))
+                status = 1
+            return {'status': status, 'stdout': sys.stdout.getvalue(), 'stderr': sys.stderr.getvalue()}
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            for name, value in settings.items():
+                setattr(backend, name, value)
+            for key in jujuresources.resources_cache:
+                self._versions.setdefault(key, self._version(key[0]))
+
+    def _version(self, resources_yaml):
+        parsed = urlparse(resources_yaml)
+        if parsed.scheme and parsed.scheme != 'file':
+            return int(time.time() // max(jujuresources.REVALIDATE_AFTER, 1))
+        try:
+            st = os.stat(url2pathname(parsed.path) if parsed.scheme else resources_yaml)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _forget_changed(self):
+        for key, version in list(self._versions.items()):
+            if self._version(key[0]) != version:
+                jujuresources.resources_cache.pop(key, None)
+                del self._versions[key]
+
+
+def _listening(socket_file):
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_file):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_file)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
@@ -0,0 +1,56 @@
+"""
+Structured events describing the progress of fetching, verifying and
+installing resources.
+
+Pass a callable to :func:`jujuresources.fetch`, :func:`~jujuresources.verify`
+or :func:`~jujuresources.install` as `events` and it is called with an
+:class:`Event` for each step.  Resources are fetched in parallel, but
+calls are serialized, so the callable doesn't need to lock.  Keep it
+quick, since the fetch waits for it.
+
+The events, and the keys of their ``data``, are:
+
+``fetch_start``
+    A resource is about to be fetched (``mirror_url``).
+``bytes``
+    A chunk of a download was written (``bytes``: its size; ``total``: the
+    bytes written so far; ``size``: the expected size, or ``None`` if
+    unknown).
+``hash_progress``
+    A chunk of the file was hashed (``bytes``: the bytes hashed so far;
+    ``size``: the size of the file).
+``verified``
+    A resource was verified (``valid``: whether it is available and valid).
+``extract_member``
+    An archive member is being installed (``member``: its path).
+``failed``
+    A download failed (``error``: the exception; ``url``: the URL, if it
+    may still be fetched from elsewhere).
+"""
+from collections import namedtuple
+
+FETCH_START = 'fetch_start'
+BYTES = 'bytes'
+HASH_PROGRESS = 'hash_progress'
+VERIFIED = 'verified'
+EXTRACT_MEMBER = 'extract_member'
+FAILED = 'failed'
+
+
+class Event(namedtuple('Event', 'type name time data')):
+    """
+    An event of `type` for the resource called `name`, at `time` (as
+    returned by :func:`time.time`), with a dict of event-specific `data`.
+    """
+    __slots__ = ()
+
+
+def from_reporthook(reporthook):
+    """
+    Adapt a `reporthook`, which is called with the name of each resource
+    before fetching it, to an `events` callable.
+    """
+    def events(event):
+        if event.type == FETCH_START:
+            reporthook(event.name)
+    return events
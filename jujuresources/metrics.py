@@ -0,0 +1,136 @@
+"""
+Per-resource timings and sizes, recorded while fetching, verifying and
+installing resources, for tracking performance across many units.
+
+Pass a :class:`Metrics` to :func:`jujuresources.fetch`,
+:func:`~jujuresources.verify` or :func:`~jujuresources.install` (or use
+the ``--metrics`` CLI option) to record, for each resource:
+
+``fetch_seconds``, ``verify_seconds``, ``install_seconds``
+    Total time spent fetching, verifying and installing it.
+``first_byte_seconds``
+    Time from requesting a download until the response headers arrive,
+    which includes the DNS lookup and connecting, as urllib doesn't time
+    those separately.
+``transfer_seconds``, ``transfer_bytes``, ``transfer_bytes_per_second``
+    Time spent reading download bodies, their (decoded) size, and the
+    resulting throughput.
+``hash_seconds``, ``hash_bytes``
+    Time spent hashing the downloaded file, and its size.
+``extract_seconds``
+    Time spent extracting or copying the file during install.
+``pip_seconds``
+    Time spent in ``pip`` subprocesses.  A group install's time is recorded
+    for each resource in the group.
+``tar_seconds``
+    Time spent in ``tar``, for archives which :mod:`tarfile` can't read.
+
+Repeated measurements, e.g. of retried downloads, or of the ``Range``
+requests of a ``--delta`` fetch, are added together.
+
+Since :func:`~jujuresources.fetch` and friends already return whether
+they succeeded, the metrics are recorded in a :class:`Metrics` passed in
+by the caller, rather than returned.
+"""
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+FORMATS = ('json', 'prometheus')
+
+_HELP = {
+    'fetch_seconds': 'Time spent fetching the resource',
+    'verify_seconds': 'Time spent verifying the resource',
+    'install_seconds': 'Time spent installing the resource',
+    'first_byte_seconds': 'Time until the response headers of downloads arrived',
+    'transfer_seconds': 'Time spent reading download bodies',
+    'transfer_bytes': 'Bytes downloaded',
+    'transfer_bytes_per_second': 'Download throughput',
+    'hash_seconds': 'Time spent hashing the resource',
+    'hash_bytes': 'Bytes hashed',
+    'extract_seconds': 'Time spent extracting or copying the resource',
+    'pip_seconds': 'Time spent in pip',
+    'tar_seconds': 'Time spent in tar',
+}
+
+
+class Metrics(object):
+    """
+    Thread-safe collection of metrics for each resource, keyed by name.
+    """
+    def __init__(self):
+        self._resources = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, metric, value):
+        """
+        Add `value` to the `metric` of the resource called `name`.
+        """
+        with self._lock:
+            metrics = self._resources.setdefault(name, {})
+            metrics[metric] = metrics.get(metric, 0) + value
+
+    @contextmanager
+    def timer(self, name, metric):
+        """
+        Context manager which adds the time spent in it to `metric`.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, metric, time.time() - start)
+
+    def as_dict(self):
+        """
+        Return a dict mapping the name of each resource to a dict of its
+        metrics.
+        """
+        with self._lock:
+            resources = dict((name, dict(metrics)) for name, metrics in self._resources.items())
+        for metrics in resources.values():
+            if metrics.get('transfer_seconds'):
+                metrics['transfer_bytes_per_second'] = metrics.get('transfer_bytes', 0) / metrics['transfer_seconds']
+        return resources
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix='jujuresources_'):
+        """
+        Return the metrics in the Prometheus text exposition format, e.g.
+        for the node exporter's textfile collector.
+        """
+        resources = self.as_dict()
+        lines = []
+        for metric in sorted(set(metric for metrics in resources.values() for metric in metrics)):
+            name = prefix + metric
+            lines.append('# HELP {} {}'.format(name, _HELP.get(metric, metric)))
+            lines.append('# TYPE {} gauge'.format(name))
+            for resource in sorted(resources):
+                if metric in resources[resource]:
+                    lines.append('{}{{resource="{}"}} {!r}'.format(
+                        name, _escape_label(resource), float(resources[resource][metric])))
+        return ''.join(line + '\n' for line in lines)
+
+    def write(self, filename, format=None):
+        """
+        Atomically write the metrics to `filename`, as JSON or in the
+        Prometheus format, which is the default if `filename` ends in
+        ``.prom``.
+        """
+        if format is None:
+            format = 'prometheus' if filename.endswith('.prom') else 'json'
+        if format not in FORMATS:
+            raise ValueError('Unknown metrics format: {}'.format(format))
+        data = self.to_prometheus() if format == 'prometheus' else self.to_json() + '\n'
+        tmp_file = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_file, 'w') as fp:
+            fp.write(data)
+        os.rename(tmp_file, filename)
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,120 @@
+from contextlib import closing
+import json
+import threading
+import time
+
+try:
+    from urllib.request import urlopen, Request  # Python 3
+except ImportError:
+    from urllib2 import urlopen, Request  # Python 2
+
+
+class MirrorRanking(object):
+    """
+    Orders mirrors from fastest to slowest, by probing each one with a
+    ``HEAD`` request to measure its round-trip time, then a ranged ``GET``
+    of up to `sample_size` bytes of `probe_path` to sample its throughput.
+
+    Throughput is only sampled if `probe_path` is at least `sample_size`
+    bytes long.  By default, it is the mirror's root index page, which is
+    too small, so mirrors are ranked by latency alone; give the path of a
+    large file on the mirrors to rank them by throughput.
+
+    Rankings are kept for `ttl` seconds, and are saved to `cache_file`,
+    if given, so that later runs can reuse them.  Mirrors that fail are
+    probed again the next time they are ranked.
+    """
+    CACHE_FILE = '.jujuresources-mirrors.json'
+
+    # size of the download to estimate the cost of, when comparing mirrors
+    REFERENCE_SIZE = 1024 * 1024
+
+    def __init__(self, cache_file=None, ttl=3600, probe_path='', sample_size=64 * 1024, timeout=5):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.probe_path = probe_path
+        self.sample_size = sample_size
+        self.timeout = timeout
+        self._scores = self._read_cache()
+        self._lock = threading.Lock()
+
+    def rank(self, mirrors):
+        """
+        Return `mirrors` sorted from fastest to slowest, probing any which
+        haven't been ranked in the last `ttl` seconds.  Mirrors that are
+        equally fast (e.g., all unreachable) keep their given order.
+        """
+        if len(mirrors) < 2:
+            return list(mirrors)
+        with self._lock:
+            now = time.time()
+            stale = [mirror for mirror in mirrors
+                     if now - self._scores.get(mirror, (0, None))[0] > self.ttl]
+            for mirror in stale:
+                self._scores[mirror] = (time.time(), self.probe(mirror))
+            if stale:
+                self._write_cache()
+            return sorted(mirrors, key=self.score)
+
+    def score(self, mirror):
+        """
+        Return the estimated number of seconds to download
+        :data:`REFERENCE_SIZE` bytes from `mirror`, or infinity if it
+        failed or hasn't been probed.
+        """
+        score = self._scores.get(mirror, (0, None))[1]
+        return float('inf') if score is None else score
+
+    def failed(self, mirror):
+        """
+        Record that a download from `mirror` failed, expiring its ranking
+        so that it is probed again the next time it is ranked.
+        """
+        with self._lock:
+            self._scores[mirror] = (0, None)
+            self._write_cache()
+
+    def probe(self, mirror):
+        """
+        Measure `mirror`, returning its score, or ``None`` if it can't be
+        reached.
+        """
+        url = mirror.rstrip('/') + '/' + self.probe_path.lstrip('/')
+        try:
+            start = time.time()
+            with closing(urlopen(_HeadRequest(url), timeout=self.timeout)):
+                rtt = time.time() - start
+            request = Request(url, headers={'Range': 'bytes=0-{}'.format(self.sample_size - 1)})
+            with closing(urlopen(request, timeout=self.timeout)) as res:
+                first_byte = time.time()
+                size = len(res.read(self.sample_size))
+                elapsed = time.time() - first_byte
+        except (IOError, ValueError):
+            return None
+        if size < self.sample_size or not elapsed:
+            return rtt  # too small or fast to measure; go by latency alone
+        return rtt + self.REFERENCE_SIZE * elapsed / size
+
+    def _read_cache(self):
+        if not self.cache_file:
+            return {}
+        try:
+            with open(self.cache_file) as fp:
+                return dict((mirror, tuple(entry)) for mirror, entry in json.load(fp).items())
+        except (IOError, ValueError, TypeError):
+            return {}
+
+    def _write_cache(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file, 'w') as fp:
+                json.dump(self._scores, fp)
+        except IOError:
+            pass  # the ranking is only an optimization
+
+
+class _HeadRequest(Request):
+    # Python 2's Request doesn't take a method argument
+    def get_method(self):
+        return 'HEAD'
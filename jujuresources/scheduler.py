@@ -0,0 +1,145 @@
+import threading
+import time
+
+try:
+    from urllib.parse import urlparse  # Python 3
+except ImportError:
+    from urlparse import urlparse  # Python 2
+
+from jujuresources import backend
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket limiting the combined throughput of all
+    downloads to `rate` bytes per second, with bursts of up to `burst`
+    bytes (default: one second's worth).
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        Take `amount` tokens from the bucket, sleeping as long as needed
+        for them to become available.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class FetchScheduler(object):
+    """
+    Runs resource fetches in parallel, with at most `max_workers` at once
+    and at most `max_per_host` against any single host.  Optionally, the
+    combined download rate of URL resources is capped at `rate_limit`
+    bytes per second (``pip`` downloads can not be throttled).
+
+    If a :class:`~jujuresources.mirrors.MirrorRanking` is given as
+    `ranking`, it is used to try the fastest of several mirrors first.
+
+    Jobs are started in priority order, so required resources can be
+    fetched ahead of optional ones.
+
+    Resources fetched with ``pip`` share directories, so they are fetched
+    one at a time, in their own :data:`PIP_HOST` lane.
+    """
+    PIP_HOST = 'pypi'
+
+    def __init__(self, max_workers=4, max_per_host=2, rate_limit=None, ranking=None):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.rate_limit = rate_limit
+        self.ranking = ranking
+
+    @staticmethod
+    def host(resource, mirror_url):
+        """
+        Return the host that `resource` will be fetched from.
+        """
+        if isinstance(resource, backend.PyPIResource) and not resource.url:
+            return FetchScheduler.PIP_HOST
+        mirrors = backend.ranked_mirrors(mirror_url)
+        if mirrors:
+            return urlparse(mirrors[0]).netloc
+        url = getattr(resource, 'url', '')
+        if url:
+            return urlparse(url).netloc
+        return ''
+
+    def run(self, jobs, mirror_url, reporthook=None, peers=None):
+        """
+        Fetch the resources in `jobs`, a list of ``(priority, resource)``
+        tuples, from `mirror_url`, or from `peers`, a list of the mirror
+        URLs of peer units, if they have them.  Lower priorities are
+        started first.
+        """
+        pending = []
+        active = {}
+        errors = []
+        cond = threading.Condition()
+
+        def next_job():
+            for job in pending:
+                limit = 1 if job[3] == self.PIP_HOST else self.max_per_host
+                if active.get(job[3], 0) < limit:
+                    pending.remove(job)
+                    active[job[3]] = active.get(job[3], 0) + 1
+                    return job
+            return None
+
+        def worker():
+            while True:
+                with cond:
+                    job = next_job()
+                    while job is None and pending:
+                        cond.wait()
+                        job = next_job()
+                if job is None:
+                    return
+                resource, host = job[2], job[3]
+                try:
+                    if reporthook:
+                        reporthook(resource.name)
+                    backend._emit('fetch_start', resource.name, mirror_url=mirror_url)
+                    with backend._timed(resource.name, 'fetch_seconds'):
+                        resource.fetch(mirror_url)
+                except Exception as e:
+                    backend._emit('failed', resource.name, error=e, url=None)
+                    errors.append(e)
+                finally:
+                    with cond:
+                        active[host] -= 1
+                        cond.notify_all()
+
+        old_throttle, old_ranking, old_peers = backend.THROTTLE, backend.RANKING, backend.PEERS
+        if peers:
+            backend.PEERS = peers
+        if self.rate_limit:
+            backend.THROTTLE = TokenBucket(self.rate_limit)
+        if self.ranking:
+            backend.RANKING = self.ranking
+        try:
+            pending.extend((priority, index, resource, self.host(resource, mirror_url))
+                           for index, (priority, resource) in enumerate(jobs))
+            pending.sort(key=lambda job: job[:2])
+            threads = [threading.Thread(target=worker)
+                       for i in range(min(self.max_workers, len(pending)))]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            backend.THROTTLE, backend.RANKING, backend.PEERS = old_throttle, old_ranking, old_peers
+        if errors:
+            raise errors[0]
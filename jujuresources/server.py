@@ -0,0 +1,599 @@
+import base64
+import binascii
+from contextlib import closing
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import threading
+from email.utils import parsedate_tz, mktime_tz
+from io import BytesIO
+
+try:
+    # Python 3
+    from http.server import SimpleHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # Python 2
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import TCPServer as HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from jujuresources import chunks
+from jujuresources.backend import DIGEST_ALGORITHMS
+from jujuresources.backend import PyPIResource
+from jujuresources.backend import _hash_suffixes
+from jujuresources.backend import zstandard
+
+
+def _fixed_length(hash_type):
+    try:
+        return hashlib.new(hash_type).digest_size > 0  # e.g. not shake_128
+    except ValueError:
+        return False
+
+
+# hash types which can be cached and served as sidecars (e.g., ``foo.tgz.sha256``)
+DIGEST_TYPES = frozenset(hash_type for hash_type in _hash_suffixes if _fixed_length(hash_type))
+
+
+def _same_mtime(mtime, other):
+    # os.utime keeps only whole microseconds on Python 2, so a cached
+    # variant's mtime can't be expected to equal its source's exactly
+    return abs(mtime - other) < 1e-5
+
+
+class DigestCache(object):
+    """
+    Cache of the digests of the files under `root_dir`, persisted to a file
+    in `root_dir` so that files are only hashed once, rather than once per
+    request (or once per server restart).
+
+    Entries are invalidated when a file's size or mtime changes.  New
+    digests are saved in the background, :data:`SAVE_DELAY` seconds after
+    the first of them, so that handlers don't wait for the file to be
+    rewritten once per request.
+    """
+    FILENAME = '.jujuresources-digests.json'
+    SAVE_DELAY = 5.0
+    hash_types = ('sha256',)
+
+    def __init__(self, root_dir):
+        self.root_dir = os.path.abspath(root_dir)
+        self.filename = os.path.join(self.root_dir, self.FILENAME)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        try:
+            with open(self.filename) as fp:
+                self._digests = json.load(fp)
+        except (IOError, ValueError):
+            self._digests = {}
+
+    def get(self, path, st=None, hash_types=None, save=True):
+        """
+        Return a dict mapping hash types to hex digests for the file at
+        `path`, hashing it only if the cached digests are stale or missing.
+        """
+        if st is None:
+            st = os.stat(path)
+        hash_types = set(hash_types or self.hash_types)
+        if not hash_types <= DIGEST_TYPES:
+            raise ValueError('Unsupported hash types: {}'.format(', '.join(sorted(hash_types - DIGEST_TYPES))))
+        key = os.path.relpath(os.path.abspath(path), self.root_dir)
+        with self._lock:
+            entry = self._digests.get(key)
+            if not entry or entry[0] != st.st_mtime or entry[1] != st.st_size:
+                entry = [st.st_mtime, st.st_size, {}]
+            else:
+                entry = [entry[0], entry[1], dict(entry[2])]  # saved entries aren't changed in place
+            missing = hash_types - set(entry[2])
+        if missing:
+            hashes = dict((hash_type, hashlib.new(hash_type)) for hash_type in missing)
+            with open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(64 * 1024), b''):
+                    for hash in hashes.values():
+                        hash.update(chunk)
+            with self._lock:
+                entry[2].update((hash_type, hash.hexdigest()) for hash_type, hash in hashes.items())
+                self._digests[key] = entry
+                if save and self._save_timer is None:
+                    self._save_timer = threading.Timer(self.SAVE_DELAY, self.save)
+                    self._save_timer.daemon = True
+                    self._save_timer.start()
+        return dict(entry[2])
+
+    def precompute(self, resources):
+        """
+        Hash any of the given resources which have been fetched and whose
+        digests aren't already cached.
+        """
+        for resource in resources:
+            if not os.path.isfile(resource.destination):
+                continue
+            hash_types = set(self.hash_types)
+            if resource.hash_type in DIGEST_TYPES:
+                hash_types.add(resource.hash_type)
+            self.get(resource.destination, hash_types=hash_types, save=False)
+        self.save()
+
+    def save(self):
+        """
+        Save the digests now, rather than in the background.
+        """
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            digests = dict(self._digests)
+        with self._save_lock:
+            tmp_filename = '{}.{}.tmp'.format(self.filename, os.getpid())
+            with open(tmp_filename, 'w') as fp:
+                json.dump(digests, fp)
+            os.rename(tmp_filename, self.filename)
+
+
+class CompressedCache(object):
+    """
+    Cache of compressed variants of the text-like files under `root_dir`
+    (index pages, YAML, JSON, etc), so that they can be sent with a
+    ``Content-Encoding`` without being recompressed for each request.
+
+    Each variant's mtime is set to that of its source file, so that it can
+    be regenerated when the source changes.
+    """
+    DIRNAME = '.jujuresources-compressed'
+    min_size = 256
+    text_extensions = ('.html', '.htm', '.txt', '.yaml', '.yml', '.json', '.xml',
+                       '.csv', '.md', '.rst', '.list', '.lst', '.js', '.css')
+
+    def __init__(self, root_dir):
+        self.root_dir = os.path.abspath(root_dir)
+        self.cache_dir = os.path.join(self.root_dir, self.DIRNAME)
+        self.encodings = ['zstd', 'gzip'] if zstandard else ['gzip']
+
+    def compressible(self, path, st):
+        if st.st_size < self.min_size:
+            return False
+        if path.lower().endswith(self.text_extensions):
+            return True
+        mime_type = mimetypes.guess_type(path)[0] or ''
+        return mime_type.startswith('text/') or mime_type.endswith(('+xml', '/json', '/xml', '/javascript'))
+
+    def get(self, path, st, encoding):
+        """
+        Return the path to the `encoding` compressed variant of the file at
+        `path`, creating it if it is missing or stale.
+        """
+        relpath = os.path.relpath(os.path.abspath(path), self.root_dir)
+        variant = os.path.join(self.cache_dir, '{}.{}'.format(relpath, encoding))
+        try:
+            if _same_mtime(os.stat(variant).st_mtime, st.st_mtime):
+                return variant
+        except OSError:
+            pass
+        if not os.path.isdir(os.path.dirname(variant)):
+            try:
+                os.makedirs(os.path.dirname(variant))
+            except OSError:
+                pass  # created by another request
+        tmp_variant = '{}.{}.{}.tmp'.format(variant, os.getpid(), threading.current_thread().ident)
+        with open(path, 'rb') as src, open(tmp_variant, 'wb') as dst:
+            if encoding == 'gzip':
+                with closing(gzip.GzipFile(fileobj=dst, mode='wb', mtime=0)) as gz:
+                    shutil.copyfileobj(src, gz)
+            else:
+                zstandard.ZstdCompressor().copy_stream(src, dst)
+        os.utime(tmp_variant, (st.st_atime, st.st_mtime))
+        os.rename(tmp_variant, variant)
+        return variant
+
+
+class ChunkIndexCache(object):
+    """
+    Cache of the chunk indexes (see :mod:`jujuresources.chunks`) of the
+    files under `root_dir`, so that clients with an older version of a
+    resource can fetch only the chunks which changed.
+
+    Like :class:`CompressedCache`, each index's mtime is set to that of its
+    source file, so that it can be regenerated when the source changes.
+    Indexes are built one at a time in a background thread, rather than by
+    the request which needs one, since reading a large file takes longer
+    than a client will wait; until then, the client fetches the whole file.
+    """
+    DIRNAME = '.jujuresources-chunks'
+
+    def __init__(self, root_dir):
+        self.root_dir = os.path.abspath(root_dir)
+        self.cache_dir = os.path.join(self.root_dir, self.DIRNAME)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._worker = None
+
+    def _index_path(self, path):
+        relpath = os.path.relpath(os.path.abspath(path), self.root_dir)
+        return os.path.join(self.cache_dir, relpath + chunks.SUFFIX + '.json')
+
+    def get(self, path, st):
+        """
+        Return the path to the chunk index of the file at `path`, or
+        ``None`` if it is missing or stale, in which case it is built in the
+        background.
+        """
+        index = self._index_path(path)
+        try:
+            if _same_mtime(os.stat(index).st_mtime, st.st_mtime):
+                return index
+        except OSError:
+            pass
+        self._queue(os.path.abspath(path))
+        return None
+
+    def precompute(self, resources):
+        """
+        Start building the indexes of any of the given resources which have
+        been fetched and whose indexes aren't already cached.
+        """
+        for resource in resources:
+            if os.path.isfile(resource.destination):
+                self.get(resource.destination, os.stat(resource.destination))
+
+    def build(self, path):
+        """
+        Build the chunk index of the file at `path` now, returning its path.
+        """
+        st = os.stat(path)
+        index = self._index_path(path)
+        if not os.path.isdir(os.path.dirname(index)):
+            try:
+                os.makedirs(os.path.dirname(index))
+            except OSError:
+                pass  # created by another thread
+        tmp_index = '{}.{}.{}.tmp'.format(index, os.getpid(), threading.current_thread().ident)
+        with open(tmp_index, 'w') as fp:
+            json.dump(chunks.build_index(path), fp)
+        os.utime(tmp_index, (st.st_atime, st.st_mtime))
+        os.rename(tmp_index, index)
+        return index
+
+    def _queue(self, path):
+        with self._lock:
+            if path in self._pending:
+                return
+            self._pending.append(path)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._build_pending)
+                self._worker.daemon = True
+                self._worker.start()
+
+    def _build_pending(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._worker = None
+                    return
+                path = self._pending[0]
+            try:
+                self.build(path)
+            except (IOError, OSError):
+                pass  # e.g., removed since it was requested
+            finally:
+                with self._lock:
+                    self._pending.remove(path)
+
+    def wait(self):
+        """
+        Wait until the indexes being built in the background are done.
+        """
+        with self._lock:
+            worker = self._worker
+        if worker is not None:
+            worker.join()
+
+
+class VerifiedFiles(object):
+    """
+    The files of the given resources which pass verification, so that a
+    unit can serve the resources it has fetched to its peers without ever
+    serving a partial or corrupt file.
+
+    The check is the same as :meth:`Resource.verify`, except that the
+    digests come from `digests`, a :class:`DigestCache`, so that each file
+    is only hashed once rather than once per request.
+    """
+    def __init__(self, resources, digests):
+        self.digests = digests
+        self._resources = {}
+        for resource in resources:
+            if isinstance(resource, PyPIResource):
+                resource.get_local_hash()
+            if resource.destination:
+                self._resources[os.path.abspath(resource.destination)] = resource
+
+    def __contains__(self, path):
+        """
+        Whether `path` is a verified resource file, or a hash sidecar
+        (e.g., ``foo.tgz.sha256``) or chunk index for one.
+        """
+        path = os.path.abspath(path)
+        base, suffix, hash_type = path.rpartition('.')
+        if path not in self._resources and (hash_type in DIGEST_TYPES or suffix + hash_type == chunks.SUFFIX):
+            path = base
+        resource = self._resources.get(path)
+        if resource is None or resource.hash_type not in DIGEST_TYPES:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        hash_type = resource.hash_type
+        return self.digests.get(path, st, hash_types=[hash_type])[hash_type] == resource.hash
+
+
+class MirrorRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Request handler for serving a directory of mirrored resources.
+
+    Regular files are sent with ``sendfile`` where the platform supports it,
+    single byte ``Range`` requests are honored so that clients can resume
+    or segment downloads, and ``ETag`` / ``Last-Modified`` validators are
+    sent so that clients can revalidate cached copies.
+
+    If the server has a :class:`DigestCache`, the file digests are also sent
+    in ``Digest`` and ``Repr-Digest`` headers, and hash sidecar files
+    (e.g., ``foo.tgz.sha256``) are served for any file, even if they don't
+    exist on disk.
+
+    If the server has a :class:`CompressedCache`, text-like files are sent
+    compressed to clients which accept it.  Digest headers are only sent
+    for uncompressed responses.
+
+    If the server has a :class:`ChunkIndexCache`, the chunk index of any
+    file (e.g., ``foo.tgz.chunks``) is served, even if it doesn't exist on
+    disk, once the cache has built it.
+
+    If the server has :class:`VerifiedFiles`, nothing else is served.
+    """
+    _byte_range = None
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if self._verified is not None and path not in self._verified:
+            self.send_error(404, 'File not found')
+            return None
+        if os.path.isdir(path):
+            index = os.path.join(path, 'index.html')
+            if not self.path.split('?', 1)[0].endswith('/') or not os.path.isfile(index):
+                return SimpleHTTPRequestHandler.send_head(self)  # redirect or listing
+            path = index
+        if not os.path.exists(path) and self._digests:
+            base, _, hash_type = path.rpartition('.')
+            if hash_type in DIGEST_TYPES and os.path.isfile(base):
+                return self._send_sidecar(base, hash_type)
+        if not os.path.exists(path) and self._chunks and path.endswith(chunks.SUFFIX):
+            base = path[:-len(chunks.SUFFIX)]
+            if os.path.isfile(base):
+                path = self._chunks.get(base, os.stat(base)) or path
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.send_error(404, 'File not found')
+            return None
+        try:
+            st = os.fstat(f.fileno())
+            etag = '"{:x}-{:x}"'.format(int(st.st_mtime * 1000000), st.st_size)
+            last_modified = self.date_time_string(st.st_mtime)
+            encoding = self._get_encoding(path, st)
+            if encoding:
+                etag = '{}-{}"'.format(etag[:-1], encoding)
+            if self._not_modified(etag, st.st_mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                f.close()
+                return None
+            digests = self._digests.get(path, st) if self._digests and not encoding else None
+            if encoding:
+                f.close()
+                f = open(self.server.compressed.get(path, st, encoding), 'rb')
+            size = os.fstat(f.fileno()).st_size
+            byte_range = self._get_range(size, etag, st.st_mtime)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                f.close()
+                return None
+            if byte_range:
+                start, length = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    start, start + length - 1, size))
+            else:
+                start, length = 0, size
+                self.send_response(200)
+            self.send_header('Content-Type', self.guess_type(path))
+            self.send_header('Content-Length', str(length))
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('ETag', etag)
+            self.send_header('Accept-Ranges', 'bytes')
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            if self._compressed and self._compressed.compressible(path, st):
+                self.send_header('Vary', 'Accept-Encoding')
+            if digests:
+                self._send_digest_headers(digests)
+            self.end_headers()
+            self._byte_range = (start, length)
+            return f
+        except Exception:
+            f.close()
+            raise
+
+    def copyfile(self, source, outputfile):
+        if self._byte_range is None:
+            # directory listings and index pages
+            return SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+        start, length = self._byte_range
+        self._byte_range = None
+        if not length:
+            return
+        outputfile.flush()
+        if hasattr(self.connection, 'sendfile'):
+            # uses os.sendfile when possible, and falls back to send() for SSL
+            self.connection.sendfile(source, start, length)
+            return
+        source.seek(start)
+        while length > 0:
+            chunk = source.read(min(length, 64 * 1024))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            length -= len(chunk)
+
+    @property
+    def _digests(self):
+        return getattr(self.server, 'digests', None)
+
+    @property
+    def _compressed(self):
+        return getattr(self.server, 'compressed', None)
+
+    @property
+    def _chunks(self):
+        return getattr(self.server, 'chunks', None)
+
+    @property
+    def _verified(self):
+        return getattr(self.server, 'verified', None)
+
+    def _get_encoding(self, path, st):
+        """
+        Choose a content-coding for the file from the ``Accept-Encoding``
+        request header, if the server has a :class:`CompressedCache` and the
+        file is worth compressing.
+        """
+        if not self._compressed or not self._compressed.compressible(path, st):
+            return None
+        accepted = {}
+        for item in (self.headers.get('Accept-Encoding') or '').split(','):
+            coding, _, params = item.strip().partition(';')
+            qvalue = re.search(r'q\s*=\s*([0-9.]+)', params)
+            try:
+                accepted[coding.strip().lower()] = float(qvalue.group(1)) if qvalue else 1.0
+            except ValueError:
+                continue
+        for encoding in self._compressed.encodings:
+            if accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+        return None
+
+    def _send_digest_headers(self, digests):
+        values = []
+        for hash_type, digest in sorted(digests.items()):
+            if hash_type in DIGEST_ALGORITHMS:
+                encoded = base64.b64encode(binascii.unhexlify(digest)).decode('ascii')
+                values.append((DIGEST_ALGORITHMS[hash_type], encoded))
+        if values:
+            self.send_header('Digest', ','.join('{}={}'.format(*v) for v in values))
+            repr_values = [v for v in values if v[0] in ('sha-256', 'sha-512')]
+            if repr_values:
+                self.send_header('Repr-Digest', ', '.join('{}=:{}:'.format(*v) for v in repr_values))
+
+    def _send_sidecar(self, path, hash_type):
+        body = (self._digests.get(path, hash_types=[hash_type])[hash_type] + '\n').encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        return BytesIO(body)
+
+    def _not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags
+        if_modified_since = self._parse_date(self.headers.get('If-Modified-Since'))
+        if if_modified_since is not None:
+            return int(mtime) <= if_modified_since
+        return False
+
+    def _get_range(self, size, etag, mtime):
+        """
+        Parse a single byte ``Range`` header, returning a tuple of
+        ``(start, length)``, ``None`` if the whole file should be sent,
+        or ``False`` if the range is not satisfiable.
+        """
+        range_header = self.headers.get('Range')
+        if not range_header:
+            return None
+        match = re.match(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$', range_header)
+        if not match or not any(match.groups()):
+            return None  # multiple or malformed ranges; send the whole file
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range.strip() != etag and self._parse_date(if_range) != int(mtime):
+            return None  # the client's copy is stale
+        first, last = match.groups()
+        if not first:
+            length = min(int(last), size)
+            return (size - length, length) if length else False
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start >= size or end < start:
+            return False
+        return (start, end - start + 1)
+
+    @staticmethod
+    def _parse_date(value):
+        if not value:
+            return None
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return mktime_tz(parsed)
+
+
+class MirrorServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server which handles each connection in its own thread, so that a
+    slow client downloading a large resource doesn't block the others.
+
+    At most `max_connections` requests are handled at once; further
+    connections wait in the listen backlog until a handler thread frees up.
+
+    If `verified` is given, only the :class:`VerifiedFiles` are served, for
+    fetching by peer units.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class=MirrorRequestHandler, max_connections=100,
+                 digests=None, compressed=None, verified=None, chunks=None):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.max_connections = max_connections
+        self.digests = digests
+        self.compressed = compressed
+        self.chunks = chunks
+        self.verified = verified
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            ThreadingMixIn.process_request(self, request, client_address)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self._slots.release()
@@ -0,0 +1,68 @@
+"""
+Timelines of fetching, verifying and installing resources, in the Chrome
+Trace Event format, which ``chrome://tracing`` and https://ui.perfetto.dev
+can display.
+
+Pass a :class:`Trace` to :func:`jujuresources.fetch`,
+:func:`~jujuresources.verify` or :func:`~jujuresources.install` (or use the
+``--trace`` CLI option) to record a slice for each phase of each resource,
+on the track of the thread it ran in: ``fetch``, ``first_byte``,
+``transfer``, ``hash``, ``verify``, ``install``, ``extract``, and the
+``pip`` and ``tar`` subprocesses.  These are the phases which
+:mod:`jujuresources.metrics` times.
+"""
+import json
+import os
+import threading
+
+
+class Trace(object):
+    """
+    Thread-safe collection of trace events.
+    """
+    def __init__(self):
+        self._events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, metric, start, end):
+        """
+        Add a slice for the phase timed as `metric` (e.g., ``fetch_seconds``)
+        of the resource called `name`, from `start` to `end` (as returned by
+        :func:`time.time`), in the current thread.
+        """
+        phase = metric[:-len('_seconds')] if metric.endswith('_seconds') else metric
+        thread = threading.current_thread()
+        event = {
+            'name': '{} {}'.format(phase, name),
+            'cat': phase,
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': thread.ident,
+            'args': {'resource': name},
+        }
+        with self._lock:
+            self._events.append(event)
+            self._threads.setdefault(thread.ident, thread.name)
+
+    def as_list(self):
+        """
+        Return the trace events, including the names of the threads.
+        """
+        pid = os.getpid()
+        with self._lock:
+            events = list(self._events)
+            threads = sorted(self._threads.items())
+        return [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                for tid, name in threads] + sorted(events, key=lambda event: event['ts'])
+
+    def write(self, filename):
+        """
+        Atomically write the trace to `filename`, as JSON.
+        """
+        tmp_file = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_file, 'w') as fp:
+            json.dump({'traceEvents': self.as_list(), 'displayTimeUnit': 'ms'}, fp)
+        os.rename(tmp_file, filename)
@@ -0,0 +1,84 @@
+"""
+Thin ``juju-resources`` entry point, which sends subcommands to a running
+``juju-resources daemon`` (see :mod:`jujuresources.daemon`) without
+importing :mod:`jujuresources`, and runs them itself otherwise.
+
+This lives outside of the package because importing any of its modules
+imports the package itself, which takes most of the time of a call.
+
+A request is a JSON object with the client's ``argv`` and ``cwd``,
+followed by EOF.  The response is a JSON object with the ``status``,
+``stdout`` and ``stderr`` of the subcommand, or an empty object if the
+daemon can't run it (e.g., it was started in a different directory).
+"""
+import json
+import os
+import socket
+import sys
+
+SOCKET_FILE = '.jujuresources.sock'
+
+# subcommands which the daemon runs.  Not fetch, which depends on the
+# caller's environment (e.g., proxies), and would keep other callers
+# waiting while it downloads
+SUBCOMMANDS = ['verify', 'resource_path', 'resource_spec', 'paths']
+
+# seconds to wait for the daemon, e.g. while it hashes resources for verify,
+# before running the subcommand in this process instead
+TIMEOUT = 300
+
+
+def default_socket():
+    """
+    Return the path of the daemon's socket: ``$JUJU_RESOURCES_SOCKET``, or
+    :data:`SOCKET_FILE` in the current directory.
+    """
+    return os.environ.get('JUJU_RESOURCES_SOCKET') or SOCKET_FILE
+
+
+def request(argv, socket_file=None):
+    """
+    Run the CLI subcommand `argv` in the daemon listening on `socket_file`,
+    returning its response, or ``None`` if there is no daemon there or it
+    can't run the subcommand.
+    """
+    socket_file = socket_file or default_socket()
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_file):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(TIMEOUT)
+    try:
+        sock.connect(socket_file)
+        sock.sendall(json.dumps({'argv': list(argv), 'cwd': os.getcwd()}).encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        data = b''.join(iter(lambda: sock.recv(64 * 1024), b''))
+    except socket.error:  # including socket.timeout
+        return None  # e.g., left behind by a daemon that was killed
+    finally:
+        sock.close()
+    try:
+        response = json.loads(data.decode('utf-8'))
+    except ValueError:
+        return None
+    return response if isinstance(response, dict) and 'status' in response else None
+
+
+def main(argv=None):
+    """
+    Run the ``juju-resources`` subcommand `argv` (default: ``sys.argv[1:]``)
+    in the daemon, if it can, or else in this process.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    command = next((arg for arg in argv if not arg.startswith('-')), None)
+    if command in SUBCOMMANDS and '--description' not in argv:
+        response = request(argv)
+        if response is not None:
+            sys.stdout.write(response['stdout'])
+            sys.stderr.write(response['stderr'])
+            sys.exit(response['status'])
+    from jujuresources.cli import resources
+    return resources(argv, use_daemon=False)
+
+
+if __name__ == '__main__':
+    main()
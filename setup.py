@@ -17,18 +17,24 @@ SETUP = {
     'packages': [
         "jujuresources",
     ],
+    'py_modules': [
+        "jujuresources_client",
+    ],
     'install_requires': [
         'pyaml',
     ],
     'entry_points': {
         'console_scripts': [
-            'juju-resources = jujuresources.cli:resources',
+            'juju-resources = jujuresources_client:main',
         ],
         'jujuresources.subcommands': [
             'fetch = jujuresources.cli:fetch',
             'verify = jujuresources.cli:verify',
             'serve = jujuresources.cli:serve',
+            'index = jujuresources.cli:index',
             'resource_path = jujuresources.cli:resource_path',
+            'paths = jujuresources.cli:paths',
+            'daemon = jujuresources.cli:daemon',
         ],
     },
     'license': "MIT License",
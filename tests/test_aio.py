@@ -0,0 +1,144 @@
+import mock
+import sys
+import unittest
+
+import jujuresources
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from jujuresources import aio
+else:
+    aio = None
+
+if not hasattr(unittest.TestCase, 'assertItemsEqual'):
+    # for Python 3.  assertCountEqual is a stupid name
+    unittest.TestCase.assertItemsEqual = unittest.TestCase.assertCountEqual
+
+
+@unittest.skipIf(aio is None, 'asyncio API requires Python 3.5+')
+class TestAsyncAPI(unittest.TestCase):
+    def setUp(self):
+        self.resources = jujuresources.backend.ResourceContainer('resources')
+        self.resources.add_required('valid', {
+            'url': 'valid',
+            'filename': 'valid',
+            'destination': 'res-defaults.yaml',
+            'hash': '4f08575d804517cea2265a7d43022771',
+            'hash_type': 'md5',
+        })
+        self.resources.add_required('py-valid', {
+            'pypi': 'py-valid',
+        })
+        self.resources.add_required('invalid', {
+            'url': 'invalid',
+            'filename': 'invalid',
+            'destination': 'res-defaults.yaml',
+            'hash': 'deadbeef',
+            'hash_type': 'md5',
+        })
+        self.resources.add_required('py-invalid', {
+            'pypi': 'py-invalid',
+        })
+        self.resources.add_optional('opt-invalid', {
+            'url': 'opt-invalid',
+            'filename': 'opt-invalid',
+            'destination': 'res-defaults.yaml',
+            'hash': 'deadbeef',
+            'hash_type': 'md5',
+        })
+        for resource in self.resources.all():
+            resource.fetch = mock.Mock()
+            resource.verify = mock.Mock(return_value='invalid' not in resource.name)
+            resource.install = mock.Mock(return_value='invalid' not in resource.name)
+            resource._prepare_download = mock.Mock(return_value=[
+                sys.executable, '-c', 'import sys; sys.exit({})'.format(int('invalid' in resource.name))])
+            resource._process_download = mock.Mock()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_invalid(self):
+        self.assertItemsEqual(self.run_async(aio._async_invalid(self.resources, None)),
+                              ['invalid', 'py-invalid'])
+        self.assertItemsEqual(self.run_async(aio._async_invalid(self.resources, jujuresources.ALL)),
+                              ['invalid', 'py-invalid', 'opt-invalid'])
+
+    @mock.patch('sys.stderr')
+    def test_fetch(self, mstderr):
+        reporthook = mock.Mock()
+        self.run_async(aio._async_fetch(self.resources, None, 'mirror', reporthook=reporthook))
+        self.resources['invalid'].fetch.assert_called_once_with('mirror')
+        assert not self.resources['valid'].fetch.called
+        assert not self.resources['opt-invalid'].fetch.called
+        # pypi resources use an async subprocess instead of fetch()
+        assert not self.resources['py-invalid'].fetch.called
+        # the mirror failed, so it fell back to PyPI itself
+        self.assertEqual(self.resources['py-invalid']._prepare_download.call_args_list,
+                         [mock.call('mirror'), mock.call(None)])
+        assert not self.resources['py-invalid']._process_download.called
+        assert not self.resources['py-valid']._prepare_download.called
+        self.assertItemsEqual(reporthook.call_args_list, [mock.call('invalid'), mock.call('py-invalid')])
+
+    def test_fetch_force(self):
+        self.run_async(aio._async_fetch(self.resources, ['valid', 'py-valid'], None, force=True))
+        self.resources['valid'].fetch.assert_called_once_with(None)
+        self.resources['py-valid']._process_download.assert_called_once_with(None)
+
+    def test_fetch_pip_serialized(self):
+        active = []
+        peak = []
+        names = ['py-valid']
+        for name in ('py-a', 'py-b'):
+            self.resources.add_required(name, {'pypi': name})
+            names.append(name)
+        for name in names:
+            resource = self.resources[name]
+
+            def prepare(index_url, name=name):
+                active.append(name)
+                peak.append(len(active))
+                return [sys.executable, '-c', 'import time; time.sleep(0.05)']
+
+            resource._prepare_download = mock.Mock(side_effect=prepare)
+            resource._process_download = mock.Mock(side_effect=lambda index_url, name=name: active.remove(name))
+        self.run_async(aio._async_fetch(self.resources, names, None, force=True))
+        self.assertEqual(peak, [1, 1, 1])
+
+    @mock.patch.object(jujuresources.backend.PyPIResource, '_install_group_cmd')
+    def test_install(self, minstall_group_cmd):
+        minstall_group_cmd.return_value = [sys.executable, '-c', 'pass']
+        assert not self.run_async(aio._async_install(self.resources, None, 'mirror', 'dest', True))
+        self.resources['valid'].install.assert_called_with('dest', True)
+        self.resources['invalid'].install.assert_called_with('dest', True)
+        assert not self.resources['opt-invalid'].install.called
+        self.assertItemsEqual(minstall_group_cmd.call_args[0][0],
+                              [self.resources['py-valid'], self.resources['py-invalid']])
+        assert self.run_async(aio._async_install(self.resources, ['valid', 'py-valid'], 'mirror', 'dest', True))
+        minstall_group_cmd.return_value = [sys.executable, '-c', 'import sys; sys.exit(1)']
+        assert not self.run_async(aio._async_install(self.resources, ['valid', 'py-valid'], 'mirror', 'dest', True))
+
+    @mock.patch.object(jujuresources, 'juju_log')
+    @mock.patch.object(jujuresources, '_load')
+    def test_async_fetch(self, mload, mjuju_log):
+        mload.return_value = self.resources
+        assert self.run_async(jujuresources.async_fetch('valid', resources_yaml='r.y'))
+        mload.assert_called_once_with('r.y', None)
+        mjuju_log.assert_called_once_with('All resources successfully fetched', level='INFO')
+        assert not self.run_async(jujuresources.async_fetch('invalid'))
+        mjuju_log.assert_called_with('Failed to fetch resource: invalid', level='WARNING')
+
+    @mock.patch.object(jujuresources, '_load')
+    def test_async_verify(self, mload):
+        mload.return_value = self.resources
+        assert self.run_async(jujuresources.async_verify('valid'))
+        assert not self.run_async(jujuresources.async_verify())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,13 @@
+import json
 import mock
 import os
+import shutil
+import threading
 import unittest
+from tempfile import mkdtemp
 
 import jujuresources
+from jujuresources.metrics import Metrics
 
 if not hasattr(unittest.TestCase, 'assertItemsEqual'):
     # for Python 3.  assertCountEqual is a stupid name
@@ -13,6 +18,14 @@ class TestAPI(unittest.TestCase):
     test_data = os.path.join(os.path.dirname(__file__), 'data')
 
     def setUp(self):
+        self.cache_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        patcher = mock.patch.object(jujuresources, 'CACHE_DIR', self.cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(jujuresources, 'resources_cache', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
         self.resources = jujuresources.backend.ResourceContainer('resources')
         self.resources.add_required('valid', {
             'url': 'valid',
@@ -83,6 +96,79 @@ class TestAPI(unittest.TestCase):
         self.assertItemsEqual(jujuresources._invalid(self.resources, None), ['invalid', 'py-invalid'])
         self.assertItemsEqual(jujuresources._invalid(self.resources, []), ['invalid', 'py-invalid'])
 
+    def test_load_cached(self):
+        resfile = os.path.join(self.cache_dir, 'resources.yaml')
+        shutil.copy(os.path.join(self.test_data, 'res-defaults.yaml'), resfile)
+        jujuresources._load(resfile)
+        cache_files = os.listdir(self.cache_dir)
+        self.assertEqual(len([f for f in cache_files if f.endswith('.json')]), 1)
+
+        # a new process reuses the parsed copy
+        jujuresources.resources_cache.clear()
+        with mock.patch.object(jujuresources, '_parse_yaml') as mload:
+            resources = jujuresources._load(resfile)
+            assert not mload.called
+        self.assertEqual(resources['foo'].url, 'http://foo.com/foo.tgz')
+
+        # and re-parses when the file changes
+        jujuresources.resources_cache.clear()
+        with open(resfile, 'a') as fp:
+            fp.write('    changed: {url: "http://changed.com/changed.tgz"}\n')
+        resources = jujuresources._load(resfile)
+        self.assertEqual(resources['changed'].url, 'http://changed.com/changed.tgz')
+        cache_file = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith('.json')][0]
+        with open(cache_file) as fp:
+            self.assertIn('changed', json.load(fp)['resdefs']['optional_resources'])
+
+    def test_load_file_url(self):
+        os.mkdir(os.path.join(self.cache_dir, 'my dir'))
+        resfile = os.path.join(self.cache_dir, 'my dir', 'resources.yaml')
+        shutil.copy(os.path.join(self.test_data, 'res-defaults.yaml'), resfile)
+        resources = jujuresources._load('file://' + resfile.replace(' ', '%20'))
+        self.assertEqual(resources['foo'].url, 'http://foo.com/foo.tgz')
+
+    @mock.patch('jujuresources.urlopen')
+    def test_load_remote_cached(self, murlopen):
+        url = 'http://example.com/resources.yaml'
+        with open(os.path.join(self.test_data, 'res-defaults.yaml'), 'rb') as fp:
+            data = fp.read()
+        res = mock.Mock(read=mock.Mock(side_effect=[data, b'']))
+        res.info.return_value = {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+        murlopen.return_value = res
+        resources = jujuresources._load(url)
+        self.assertEqual(resources['foo'].url, 'http://foo.com/foo.tgz')
+        self.assertEqual(murlopen.call_count, 1)
+
+        # within REVALIDATE_AFTER, the copy is used without asking
+        jujuresources.resources_cache.clear()
+        resources = jujuresources._load(url)
+        self.assertEqual(resources['foo'].url, 'http://foo.com/foo.tgz')
+        self.assertEqual(murlopen.call_count, 1)
+
+        # after that, it is revalidated
+        jujuresources.resources_cache.clear()
+        murlopen.side_effect = jujuresources.backend.HTTPError(url, 304, 'Not Modified', {}, None)
+        with mock.patch.object(jujuresources, 'REVALIDATE_AFTER', 0):
+            resources = jujuresources._load(url)
+        self.assertEqual(resources['foo'].url, 'http://foo.com/foo.tgz')
+        request = murlopen.call_args[0][0]
+        self.assertEqual(request.get_header('If-none-match'), '"v1"')
+        self.assertEqual(request.get_header('If-modified-since'), 'Mon, 01 Jan 2024 00:00:00 GMT')
+
+        # and used if the server can't be reached
+        jujuresources.resources_cache.clear()
+        murlopen.side_effect = jujuresources.backend.URLError('offline')
+        with mock.patch.object(jujuresources, 'REVALIDATE_AFTER', 0):
+            with mock.patch('sys.stderr'):
+                resources = jujuresources._load(url)
+        self.assertEqual(resources['foo'].url, 'http://foo.com/foo.tgz')
+
+        # but not if it's gone
+        jujuresources.resources_cache.clear()
+        murlopen.side_effect = jujuresources.backend.HTTPError(url, 404, 'Not Found', {}, None)
+        with mock.patch.object(jujuresources, 'REVALIDATE_AFTER', 0):
+            self.assertRaises(IOError, jujuresources._load, url)
+
     @mock.patch('jujuresources._invalid')
     def test_fetch(self, minvalid):
         minvalid.return_value = set(['invalid'])
@@ -113,6 +199,88 @@ class TestAPI(unittest.TestCase):
         ], any_order=True)
         self.assertNotIn(mock.call('valid'), reporthook.call_args_list)
 
+    @mock.patch.dict(os.environ, {'JUJU_CONTEXT_ID': 'unit/0-install-1'})
+    @mock.patch.object(jujuresources, 'config_cache', {})
+    @mock.patch('subprocess.check_output')
+    def test_config_get(self, mcheck_output):
+        mcheck_output.return_value = b'resources_mirror: http://mirror/\nretries: 3\n'
+        self.assertEqual(jujuresources.config_get('resources_mirror'), 'http://mirror/')
+        self.assertEqual(jujuresources.config_get('retries'), 3)
+        self.assertIsNone(jujuresources.config_get('missing'))
+        mcheck_output.assert_called_once_with(['config-get', '--format=yaml'])
+
+        # options are read again in the next hook, or when invalidated
+        os.environ['JUJU_CONTEXT_ID'] = 'unit/0-config-changed-2'
+        mcheck_output.return_value = b'resources_mirror: http://other/\n'
+        self.assertEqual(jujuresources.config_get('resources_mirror'), 'http://other/')
+        self.assertEqual(mcheck_output.call_count, 2)
+        jujuresources.invalidate_config()
+        jujuresources.config_get('resources_mirror')
+        self.assertEqual(mcheck_output.call_count, 3)
+
+    @mock.patch('subprocess.check_call')
+    def test_juju_log(self, mcheck_call):
+        buf = jujuresources._LogBuffer(interval=60)
+        with mock.patch.object(jujuresources, '_log_buffer', buf):
+            jujuresources.juju_log('Fetching foo', level='INFO')
+            jujuresources.juju_log('Fetching bar', level='INFO')
+            jujuresources.juju_log('Failed to fetch resource: bar', level='WARNING')
+            assert not mcheck_call.called
+            jujuresources.flush_log()
+        self.assertEqual(mcheck_call.call_args_list, [
+            mock.call(['juju-log', '-l', 'INFO', 'Fetching foo\nFetching bar']),
+            mock.call(['juju-log', '-l', 'WARNING', 'Failed to fetch resource: bar']),
+        ])
+
+    @mock.patch('subprocess.check_call')
+    def test_juju_log_background(self, mcheck_call):
+        buf = jujuresources._LogBuffer(interval=0.01)
+        sent = threading.Event()
+        mcheck_call.side_effect = lambda args: sent.set()
+        buf.add('INFO', 'Fetching foo')
+        assert sent.wait(5)
+        mcheck_call.assert_called_once_with(['juju-log', '-l', 'INFO', 'Fetching foo'])
+
+        # a full buffer is sent without waiting for the interval
+        sent.clear()
+        buf = jujuresources._LogBuffer(interval=60, max_messages=2)
+        buf.add('INFO', 'one')
+        buf.add('INFO', 'two')
+        assert sent.wait(5)
+        mcheck_call.assert_called_with(['juju-log', '-l', 'INFO', 'one\ntwo'])
+
+    @mock.patch('sys.stderr')
+    @mock.patch('subprocess.check_call')
+    def test_juju_log_stderr(self, mcheck_call, mstderr):
+        mcheck_call.side_effect = OSError('juju-log not found')
+        buf = jujuresources._LogBuffer(interval=60)
+        buf.add('INFO', 'one')
+        buf.flush()
+        buf.add('DEBUG', 'two')
+        buf.flush()
+        self.assertEqual(mcheck_call.call_count, 1)
+        self.assertEqual(mstderr.write.call_args_list, [mock.call('INFO: one\n'), mock.call('DEBUG: two\n')])
+
+    def test_fetch_events(self):
+        events = []
+        jujuresources._fetch(self.resources, None, 'mirror', events=events.append)
+        self.assertItemsEqual([(e.type, e.name) for e in events], [
+            ('verified', 'valid'), ('verified', 'py-valid'),
+            ('verified', 'invalid'), ('verified', 'py-invalid'),
+            ('fetch_start', 'invalid'), ('fetch_start', 'py-invalid'),
+        ])
+        self.assertIsNone(jujuresources.backend.EVENTS)
+
+    @mock.patch('jujuresources._invalid')
+    def test_fetch_required_first(self, minvalid):
+        scheduler = mock.Mock()
+        minvalid.return_value = set(['invalid', 'opt-invalid'])
+        jujuresources._fetch(self.resources, jujuresources.ALL, 'mirror', scheduler=scheduler)
+        jobs, mirror_url, reporthook, peers = scheduler.run.call_args[0]
+        self.assertItemsEqual([(priority, resource.name) for priority, resource in jobs],
+                              [(0, 'invalid'), (1, 'opt-invalid')])
+        self.assertEqual(mirror_url, 'mirror')
+
     @mock.patch.object(jujuresources, '_load')
     def test_resource_path(self, mload):
         mload.return_value = self.resources
@@ -137,6 +305,16 @@ class TestAPI(unittest.TestCase):
         minstall_group.return_value = True
         assert jujuresources._install(self.resources, ['valid', 'py-valid'], 'mirror', 'dest', True)
 
+    @mock.patch('jujuresources.backend.PyPIResource.install_group')
+    def test_metrics(self, minstall_group):
+        metrics = Metrics()
+        self.assertEqual(jujuresources._invalid(self.resources, None, metrics), set(['invalid', 'py-invalid']))
+        jujuresources._install(self.resources, ['valid'], 'mirror', 'dest', True, metrics)
+        recorded = metrics.as_dict()
+        self.assertItemsEqual(recorded, ['valid', 'py-valid', 'invalid', 'py-invalid'])
+        self.assertItemsEqual(recorded['valid'], ['verify_seconds', 'install_seconds'])
+        self.assertIsNone(jujuresources.backend.METRICS)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 
+from contextlib import closing
+import gzip
+from io import BytesIO
+import errno
 import mock
 import os
 import unittest
 import shutil
+import socket
+import ssl
 import subprocess
+import threading
+import time
 from tempfile import mkdtemp
 
 from jujuresources import backend
@@ -14,24 +22,66 @@ if not hasattr(unittest.TestCase, 'assertItemsEqual'):
     unittest.TestCase.assertItemsEqual = unittest.TestCase.assertCountEqual
 
 
+def gzip_compress(data):
+    out = BytesIO()
+    with closing(gzip.GzipFile(fileobj=out, mode='wb', mtime=0)) as gz:
+        gz.write(data)
+    return out.getvalue()
+
+
+class RequestFor(object):
+    """
+    Matches a URL, or a urllib Request for that URL, in mock call assertions.
+    """
+    def __init__(self, url):
+        self.url = url
+
+    def __eq__(self, other):
+        return getattr(other, 'get_full_url', lambda: other)() == self.url
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'RequestFor({!r})'.format(self.url)
+
+
 class TestResourceContainer(unittest.TestCase):
     @mock.patch.object(backend.Resource, 'get')
     def test_add_required(self, mget):
         rc = backend.ResourceContainer('od')
         rc.add_required('name', 'resource')
         self.assertIn('name', rc._required)
-        mget.assert_called_once_with('name', 'resource', 'od')
         self.assertIn('name', rc)
+        assert not mget.called
+        self.assertEqual(rc['name'], mget.return_value)
         self.assertEqual(rc['name'], mget.return_value)
+        mget.assert_called_once_with('name', 'resource', 'od')
 
     @mock.patch.object(backend.Resource, 'get')
     def test_add_optional(self, mget):
         rc = backend.ResourceContainer('od')
         rc.add_optional('name', 'resource')
         self.assertNotIn('name', rc._required)
-        mget.assert_called_once_with('name', 'resource', 'od')
         self.assertIn('name', rc)
+        assert not mget.called
+        self.assertEqual(rc['name'], mget.return_value)
         self.assertEqual(rc['name'], mget.return_value)
+        mget.assert_called_once_with('name', 'resource', 'od')
+
+    @mock.patch.object(backend.Resource, 'get')
+    def test_lazy(self, mget):
+        mget.side_effect = lambda name, definition, output_dir: definition
+        rc = backend.ResourceContainer('od')
+        rc.add_required('req', 'foo')
+        rc.add_optional('opt', 'bar')
+        self.assertEqual(len(rc), 2)
+        self.assertEqual(rc.get('opt'), 'bar')
+        mget.assert_called_once_with('opt', 'bar', 'od')
+        self.assertItemsEqual(rc.keys(), ['req', 'opt'])
+        self.assertItemsEqual(rc.items(), [('req', 'foo'), ('opt', 'bar')])
+        self.assertEqual(rc.get('missing'), None)
+        self.assertRaises(KeyError, lambda: rc['missing'])
 
     def test_all(self):
         rc = backend.ResourceContainer('od')
@@ -75,6 +125,12 @@ class TestResource(unittest.TestCase):
             backend.Resource.get('name', {'pypi': 'foo'}, 'od'),
             backend.PyPIResource)
 
+    def test_compact(self):
+        res1 = backend.Resource.get('res1', {'url': 'foo', 'hash_type': ''.join(['sha', '256'])}, 'od')
+        res2 = backend.Resource.get('res2', {'url': 'bar', 'hash_type': ''.join(['sha', '256'])}, 'od')
+        self.assertIs(res1.hash_type, res2.hash_type)
+        self.assertEqual(res1.__dict__, {})  # every attribute is in a slot
+
     def test_init(self):
         res = backend.Resource('name', {
             'file': 'path/fn',
@@ -117,6 +173,19 @@ class TestResource(unittest.TestCase):
         }, self.test_data)
         assert res.verify()
 
+    def test_verify_events(self):
+        res = backend.Resource('name', {
+            'file': 'res-defaults.yaml',
+            'hash': '4f08575d804517cea2265a7d43022771',
+            'hash_type': 'md5',
+        }, self.test_data)
+        events = []
+        with mock.patch.object(backend, 'EVENTS', events.append):
+            assert res.verify()
+        size = os.path.getsize(res.destination)
+        self.assertEqual([(e.type, e.name, e.data) for e in events],
+                         [('hash_progress', 'name', {'bytes': size, 'size': size})])
+
     def test_verify_invalid(self):
         res = backend.Resource('name', {
             'file': 'res-defaults.yaml',
@@ -175,6 +244,22 @@ class TestResource(unittest.TestCase):
         finally:
             shutil.rmtree(tmpdir)
 
+    def test_install_tgz_events(self):
+        res = backend.Resource('name', {
+            'file': 'test.tgz',
+            'hash': '347153cce7f15a6d3e47d34fbccb6afa',
+            'hash_type': 'md5',
+        }, self.test_data)
+        tmpdir = mkdtemp()
+        events = []
+        try:
+            with mock.patch.object(backend, 'EVENTS', events.append):
+                assert res.install(tmpdir, skip_top_level=True)
+        finally:
+            shutil.rmtree(tmpdir)
+        members = [e.data['member'] for e in events if e.type == 'extract_member']
+        self.assertItemsEqual(members, ['foo', 'bar', 'bar/qux'])
+
     @mock.patch('tarfile.is_tarfile', mock.Mock(return_value=False))
     def test_install_tgz_workaround(self):
         self.test_install_tgz()
@@ -274,6 +359,7 @@ class TestURLResource(unittest.TestCase):
             'hash_type': 'hash_type',
         }, 'od')
         mexists.return_value = True
+        murlopen.return_value.read.return_value = b''
         res.fetch()
         assert not mmakedirs.called
         mremove.assert_called_with('od/name/fn')
@@ -283,7 +369,8 @@ class TestURLResource(unittest.TestCase):
         mexists.return_value = False
         res.fetch('http://mirror.com/cache/')
         mmakedirs.assert_called_with('od/name')
-        murlopen.assert_called_with('http://mirror.com/cache/name/fn')
+        murlopen.assert_called_with(RequestFor('http://mirror.com/cache/name/fn'))
+        self.assertEqual(murlopen.call_args[0][0].get_header('Accept-encoding'), backend.ACCEPT_ENCODING)
         mopen.assert_called_with('od/name/fn', 'w+b')
 
     @mock.patch.object(os, 'remove')
@@ -297,6 +384,7 @@ class TestURLResource(unittest.TestCase):
             'hash_type': 'hash_type',
         }, 'od')
         mexists.return_value = True
+        murlopen.return_value.read.return_value = b''
         mopen = mock.mock_open(read_data='myhash')
         with mock.patch.object(backend, 'open', mopen, create=True):
             res.fetch()
@@ -316,11 +404,253 @@ class TestURLResource(unittest.TestCase):
         murlopen.reset_mock()
         with mock.patch.object(backend, 'open', mopen, create=True):
             res.fetch('http://mirror.com/cache/')
-        murlopen.assert_any_call('http://mirror.com/cache/name/fn')
+        murlopen.assert_any_call(RequestFor('http://mirror.com/cache/name/fn'))
         mopen.assert_any_call('od/name/fn', 'w+b')
         murlopen.assert_any_call('http://mirror.com/cache/name/fn.hash')
         mopen.assert_any_call('od/name/fn.hash', 'w+b')
 
+    @mock.patch.object(os, 'remove')
+    @mock.patch.object(os, 'makedirs')
+    @mock.patch.object(os.path, 'exists')
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_hash_url_digest_header(self, murlopen, mexists, mmakedirs, mremove):
+        definition = {
+            'url': 'http://example.com/path/fn',
+            'hash': 'http://example.com/path/fn.hash',
+            'hash_type': 'md5',
+        }
+        mexists.return_value = True
+        murlopen.return_value.info.return_value = {'Digest': 'sha-256=abc=,md5=rL0Y20zC+Fzt72VPzMSk2A=='}
+        murlopen.return_value.read.return_value = b''
+
+        # upstream digests aren't trusted; the hash URL is always fetched
+        res = backend.URLResource('name', definition, 'od')
+        with mock.patch.object(backend, 'open', mock.mock_open(), create=True):
+            res.fetch()
+        self.assertEqual(murlopen.call_args_list, [
+            mock.call('http://example.com/path/fn'),
+            mock.call('http://example.com/path/fn.hash'),
+        ])
+
+        # nor are those of mirrors, which hash whatever copy they have; the
+        # stored hash is fetched, and the digest only checked against it
+        for stored, warned in [('acbd18db4cc2f85cedef654fccc4a4d8', False), ('deadbeef', True)]:
+            murlopen.reset_mock()
+            res = backend.URLResource('name', definition, 'od')
+            with mock.patch.object(backend, 'open', mock.mock_open(read_data=stored + '\n'), create=True):
+                with mock.patch('sys.stderr') as mstderr:
+                    res.fetch('http://mirror.com/cache/')
+            self.assertEqual(murlopen.call_args_list, [
+                mock.call(RequestFor('http://mirror.com/cache/name/fn')),
+                mock.call('http://mirror.com/cache/name/fn.hash'),
+            ])
+            self.assertEqual(res.hash, stored)
+            self.assertEqual(mstderr.write.called, warned)
+
+    @mock.patch.object(os, 'remove')
+    @mock.patch.object(os, 'makedirs')
+    @mock.patch.object(os.path, 'exists')
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_compressed(self, murlopen, mexists, mmakedirs, mremove):
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': 'hash',
+            'hash_type': 'md5',
+        }, 'od')
+        mexists.return_value = True
+        murlopen.return_value.info.return_value = {'Content-Encoding': 'gzip'}
+        murlopen.return_value.read.side_effect = [gzip_compress(b'foo'), b'', gzip_compress(b'foo'), b'']
+        mopen = mock.mock_open()
+        with mock.patch.object(backend, 'open', mopen, create=True):
+            res.fetch('http://mirror.com/cache/')
+        mopen().write.assert_called_once_with(b'foo')
+
+        # encodings are left alone for upstream URLs
+        mopen = mock.mock_open()
+        with mock.patch.object(backend, 'open', mopen, create=True):
+            res.fetch()
+        murlopen.assert_called_with('http://example.com/path/fn')
+        mopen().write.assert_called_once_with(gzip_compress(b'foo'))
+
+    @mock.patch.object(os, 'remove')
+    @mock.patch.object(os, 'makedirs')
+    @mock.patch.object(os.path, 'exists')
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_events(self, murlopen, mexists, mmakedirs, mremove):
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': 'hash',
+            'hash_type': 'md5',
+        }, 'od')
+        mexists.return_value = True
+        murlopen.return_value.info.return_value = {'Content-Length': '6'}
+        murlopen.return_value.read.side_effect = [b'foo', b'bar', b'']
+        events = []
+        with mock.patch.object(backend, 'open', mock.mock_open(), create=True):
+            with mock.patch.object(backend, 'EVENTS', events.append):
+                res.fetch()
+        self.assertEqual([(e.type, e.name, e.data) for e in events], [
+            ('bytes', 'name', {'bytes': 3, 'total': 3, 'size': 6}),
+            ('bytes', 'name', {'bytes': 3, 'total': 6, 'size': 6}),
+        ])
+
+    @mock.patch.object(backend.time, 'sleep')
+    @mock.patch.object(os, 'remove')
+    @mock.patch.object(os, 'makedirs')
+    @mock.patch.object(os.path, 'exists')
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_failover(self, murlopen, mexists, mmakedirs, mremove, msleep):
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': 'hash',
+            'hash_type': 'md5',
+        }, 'od')
+        mexists.return_value = True
+        response = mock.MagicMock()
+        response.read.side_effect = [b'foo', b'']
+        murlopen.side_effect = [
+            backend.HTTPError('url', 503, 'Service Unavailable', {}, None),
+            backend.HTTPError('url', 503, 'Service Unavailable', {}, None),
+            backend.HTTPError('url', 404, 'Not Found', {}, None),
+            response,
+        ]
+        mopen = mock.mock_open()
+        with mock.patch.object(backend, 'open', mopen, create=True), mock.patch('sys.stderr'):
+            res.fetch('http://m1/, http://m2/')
+        # retries m1 with growing delays, then fails over to m2 without retrying the 404
+        self.assertEqual([c[0][0].get_full_url() for c in murlopen.call_args_list], [
+            'http://m1/name/fn',
+            'http://m1/name/fn',
+            'http://m1/name/fn',
+            'http://m2/name/fn',
+        ])
+        self.assertEqual(msleep.call_count, 2)
+        assert msleep.call_args_list[0][0][0] <= backend.RETRY_BACKOFF
+        assert msleep.call_args_list[1][0][0] <= 2 * backend.RETRY_BACKOFF
+        mopen().write.assert_called_once_with(b'foo')
+
+    @mock.patch.object(backend.time, 'sleep')
+    @mock.patch.object(os, 'remove')
+    @mock.patch.object(os, 'makedirs')
+    @mock.patch.object(os.path, 'exists')
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_failover_upstream(self, murlopen, mexists, mmakedirs, mremove, msleep):
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': 'hash',
+            'hash_type': 'md5',
+        }, 'od')
+        mexists.return_value = True
+        murlopen.side_effect = backend.URLError(socket.error(errno.ECONNREFUSED, 'Connection refused'))
+        mopen = mock.mock_open()
+        with mock.patch.object(backend, 'open', mopen, create=True), mock.patch('sys.stderr'):
+            res.fetch(['http://m1/'])
+        self.assertEqual(murlopen.call_count, 2 * (backend.RETRIES + 1))
+        murlopen.assert_called_with('http://example.com/path/fn')
+        self.assertEqual(msleep.call_count, 2 * backend.RETRIES)
+
+    @mock.patch.object(os, 'remove')
+    @mock.patch.object(os, 'makedirs')
+    @mock.patch.object(os.path, 'exists')
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_ranked(self, murlopen, mexists, mmakedirs, mremove):
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': 'hash',
+            'hash_type': 'md5',
+        }, 'od')
+        mexists.return_value = True
+        response = mock.MagicMock()
+        response.read.side_effect = [b'foo', b'']
+        murlopen.side_effect = [backend.HTTPError('url', 404, 'Not Found', {}, None), response]
+        ranking = mock.Mock()
+        ranking.rank.side_effect = lambda mirrors: list(reversed(mirrors))
+        mopen = mock.mock_open()
+        with mock.patch.object(backend, 'open', mopen, create=True), \
+                mock.patch.object(backend, 'RANKING', ranking), mock.patch('sys.stderr'):
+            res.fetch('http://m1/,http://m2/')
+        self.assertEqual([c[0][0].get_full_url() for c in murlopen.call_args_list],
+                         ['http://m2/name/fn', 'http://m1/name/fn'])
+        ranking.failed.assert_called_once_with('http://m2/')
+
+    @mock.patch.object(os, 'remove')
+    @mock.patch.object(os, 'makedirs')
+    @mock.patch.object(os.path, 'exists')
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_peers(self, murlopen, mexists, mmakedirs, mremove):
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': 'hash',
+            'hash_type': 'md5',
+        }, 'od')
+        mexists.return_value = True
+        murlopen.return_value.read.return_value = b''
+        res.verify = mock.Mock(side_effect=[False, True])
+        mopen = mock.mock_open()
+        with mock.patch.object(backend, 'open', mopen, create=True), \
+                mock.patch.object(backend, 'PEERS', ['http://p1/', 'http://p2/']):
+            res.fetch('http://mirror/')
+        self.assertItemsEqual([c[0][0].get_full_url() for c in murlopen.call_args_list],
+                              ['http://p1/name/fn', 'http://p2/name/fn'])
+
+        # peers are not used if their copies can't be verified
+        res.hash = 'http://example.com/path/fn.md5'
+        with mock.patch.object(backend, 'PEERS', ['http://p1/']):
+            self.assertFalse(res._fetch_from_peers())
+
+    def test_read_peers(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'peers')
+        with open(filename, 'w') as fp:
+            fp.write('# units\nhttp://p1/\n\n  http://p2/  \n')
+        self.assertEqual(backend.read_peers(filename), ['http://p1/', 'http://p2/'])
+        self.assertEqual(backend.read_peers(os.path.join(tmpdir, 'missing')), [])
+
+    def test_mirror_urls(self):
+        self.assertEqual(backend.mirror_urls(None), [])
+        self.assertEqual(backend.mirror_urls('http://m1/'), ['http://m1/'])
+        self.assertEqual(backend.mirror_urls('http://m1/, http://m2/,'), ['http://m1/', 'http://m2/'])
+        self.assertEqual(backend.mirror_urls(['http://m1/', 'http://m2/']), ['http://m1/', 'http://m2/'])
+
+    @mock.patch.object(backend.time, 'sleep')
+    def test_retry(self, msleep):
+        func = mock.Mock(side_effect=[backend.URLError(socket.timeout('timed out')), 'result'])
+        self.assertEqual(backend.retry(func, 'arg'), 'result')
+        func.assert_called_with('arg')
+        self.assertEqual(msleep.call_count, 1)
+
+        # permanent URL errors are not retried
+        for reason in [IOError(errno.ENOENT, 'No such file or directory'),
+                       ssl.SSLError(1, 'certificate verify failed'),
+                       socket.gaierror(socket.EAI_NONAME, 'Name or service not known')]:
+            func = mock.Mock(side_effect=backend.URLError(reason))
+            self.assertRaises(IOError, backend.retry, func)
+            self.assertEqual(func.call_count, 1)
+        self.assertEqual(msleep.call_count, 1)
+
+        # local errors are not retried
+        func = mock.Mock(side_effect=IOError('disk full'))
+        self.assertRaises(IOError, backend.retry, func)
+        self.assertEqual(func.call_count, 1)
+
+    def test_decode_content(self):
+        self.assertEqual(backend.decode_content(gzip_compress(b'foo'), 'gzip'), b'foo')
+        self.assertEqual(backend.decode_content(b'foo', 'identity'), b'foo')
+        self.assertEqual(backend.decode_content(b'foo', None), b'foo')
+
+    def test_parse_digest(self):
+        self.assertEqual(backend.parse_digest({
+            'Repr-Digest': 'sha-256=:LCa0a2j/xo/5m0U8HTBBNBNCLXBkg7+g+YpeiGJm564=:',
+        }, 'sha256'), '2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886266e7ae')
+        self.assertEqual(backend.parse_digest({
+            'Digest': 'SHA-256=LCa0a2j/xo/5m0U8HTBBNBNCLXBkg7+g+YpeiGJm564=, md5=rL0Y20zC+Fzt72VPzMSk2A==',
+        }, 'md5'), 'acbd18db4cc2f85cedef654fccc4a4d8')
+        self.assertIsNone(backend.parse_digest({'Digest': 'md5=rL0Y20zC+Fzt72VPzMSk2A=='}, 'sha256'))
+        self.assertIsNone(backend.parse_digest({'Digest': 'md5=rL0Y20zC+Fzt72VPzMSk2A=='}, 'nonce'))
+        self.assertIsNone(backend.parse_digest({'Digest': 'md5=!!'}, 'md5'))
+        self.assertIsNone(backend.parse_digest({}, 'md5'))
+
 
 class TestPyPIResource(unittest.TestCase):
     test_data = os.path.join(os.path.dirname(__file__), 'data')
@@ -427,6 +757,13 @@ class TestPyPIResource(unittest.TestCase):
             stderr=subprocess.STDOUT)
         assert not res.get_remote_hash.called
 
+        # fails over across the mirrors, then to PyPI itself
+        mcheck_output.reset_mock()
+        res.fetch('m1,m2')
+        self.assertEqual([c[0][0][-2:] for c in mcheck_output.call_args_list],
+                         [['-i', 'm1'], ['-i', 'm2'], ['--download', 'od/jujuresources']])
+        assert not res.get_remote_hash.called
+
     @mock.patch.object(os, 'listdir')
     @mock.patch.object(backend.URLResource, 'fetch')
     @mock.patch.object(os, 'makedirs')
@@ -463,14 +800,31 @@ class TestPyPIResource(unittest.TestCase):
         self.assertEqual(res.hash, '4f08575d804517cea2265a7d43022771')
         self.assertEqual(res.hash_type, 'md5')
 
-    @mock.patch('os.listdir')
-    def test_get_local_hash_missing(self, mlistdir):
-        res = backend.PyPIResource('name', {'pypi': 'jujuresources>=0.2'}, self.test_data)
-        res.filename = 'jujuresources-0.2.tar.gz'
-        mlistdir.return_value = ['jujuresources-0.2.tar.gz.md5']
-        res.get_local_hash()
-        self.assertEqual(res.hash, '')
-        self.assertEqual(res.hash_type, '')
+    def test_get_local_hash_missing(self):
+        tmpdir = mkdtemp()
+        try:
+            os.mkdir(os.path.join(tmpdir, 'jujuresources'))
+            shutil.copy(os.path.join(self.test_data, 'jujuresources', 'jujuresources-0.2.tar.gz.md5'),
+                        os.path.join(tmpdir, 'jujuresources'))
+            res = backend.PyPIResource('name', {'pypi': 'jujuresources>=0.2'}, tmpdir)
+            res.filename = 'jujuresources-0.2.tar.gz'
+            res.get_local_hash()
+            self.assertEqual(res.hash, '')
+            self.assertEqual(res.hash_type, '')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @mock.patch.object(backend, '_listfiles')
+    def test_get_local_hash_cached(self, mlistfiles):
+        mlistfiles.return_value = ['jujuresources-0.2.tar.gz', 'jujuresources-0.2.tar.gz.md5']
+        backend.PyPIResource._local_hash_cache.clear()
+        for i in range(2):
+            res = backend.PyPIResource('name', {'pypi': 'jujuresources>=0.2'}, self.test_data)
+            res.get_local_hash()
+            self.assertEqual(res.filename, 'jujuresources-0.2.tar.gz')
+            self.assertEqual(res.hash, '4f08575d804517cea2265a7d43022771')
+            self.assertEqual(res.hash_type, 'md5')
+        self.assertEqual(mlistfiles.call_count, 1)
 
     @mock.patch.object(backend, 'urlopen')
     def test_get_remote_hash(self, murlopen):
@@ -553,6 +907,24 @@ class TestPyPIResource(unittest.TestCase):
         self.assertItemsEqual(result, ['Foo', 'bar', 'baz-0'])
         self.assertIs(backend.PyPIResource._index, result)
 
+    @mock.patch.object(backend, 'urlopen')
+    def test_get_index_threads(self, murlopen):
+        def slow_index(url):
+            time.sleep(0.05)
+            return BytesIO(b'<a href="foo">foo</a>\n<a href="bar">bar</a>\n')
+
+        murlopen.side_effect = slow_index
+        backend.PyPIResource._index = None
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(backend.PyPIResource._get_index('url')))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [set(['foo', 'bar'])] * 4)
+        murlopen.assert_called_once_with('url')
+
     def test_get_index_cached(self):
         backend.PyPIResource._index = 'foo'
         self.assertEqual(backend.PyPIResource._get_index('url'), 'foo')
@@ -560,11 +932,56 @@ class TestPyPIResource(unittest.TestCase):
     @mock.patch.object(backend.PyPIResource, '_write_file')
     def test_build_pypi_indexes(self, mwrite_file):
         backend.PyPIResource.build_pypi_indexes(self.test_data)
-        self.assertEqual(mwrite_file.call_count, 1)
-        self.assertEqual(mwrite_file.call_args_list[0][0][0],
-                         os.path.join(self.test_data, 'jujuresources', 'index.html'))
+        written = dict(call[0] for call in mwrite_file.call_args_list)
+        self.assertItemsEqual(written.keys(), [
+            os.path.join(self.test_data, 'jujuresources', 'index.html'),
+            os.path.join(self.test_data, 'index.html'),
+            os.path.join(self.test_data, backend.PyPIResource.INDEX_MANIFEST),
+        ])
         self.assertIn('href="jujuresources-0.2.tar.gz#md5=4f08575d804517cea2265a7d43022771"',
-                      mwrite_file.call_args_list[0][0][1])
+                      written[os.path.join(self.test_data, 'jujuresources', 'index.html')])
+        self.assertIn('<a href="jujuresources/">jujuresources</a>',
+                      written[os.path.join(self.test_data, 'index.html')])
+
+    def test_build_pypi_indexes_multiple_files(self):
+        tmpdir = mkdtemp()
+        try:
+            pkg_dir = os.path.join(tmpdir, 'foo')
+            os.mkdir(pkg_dir)
+            for filename, text in [('foo-1.0.tar.gz', ''),
+                                   ('foo-1.0.tar.gz.md5', 'hash1\n'),
+                                   ('foo-1.1-py2.py3-none-any.whl', ''),
+                                   ('foo-1.1-py2.py3-none-any.whl.sha256', 'hash2\n'),
+                                   ('foo-1.2.zip', '')]:
+                with open(os.path.join(pkg_dir, filename), 'w') as fp:
+                    fp.write(text)
+            backend.PyPIResource.build_pypi_indexes(tmpdir)
+            with open(os.path.join(pkg_dir, 'index.html')) as fp:
+                index = fp.read()
+            self.assertIn('<a href="foo-1.0.tar.gz#md5=hash1" rel="internal">', index)
+            self.assertIn('<a href="foo-1.1-py2.py3-none-any.whl#sha256=hash2" rel="internal">', index)
+            self.assertIn('<a href="foo-1.2.zip" rel="internal">', index)
+            self.assertNotIn('.md5"', index)
+            self.assertNotIn('index.html', index)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_build_pypi_indexes_incremental(self):
+        tmpdir = mkdtemp()
+        try:
+            root_dir = os.path.join(tmpdir, 'mirror')
+            shutil.copytree(self.test_data, root_dir)
+            self.assertEqual(backend.PyPIResource.build_pypi_indexes(root_dir), ['jujuresources'])
+            assert os.path.isfile(os.path.join(root_dir, 'jujuresources', 'index.html'))
+            assert os.path.isfile(os.path.join(root_dir, 'index.html'))
+            self.assertEqual(backend.PyPIResource.build_pypi_indexes(root_dir), [])
+            self.assertEqual(backend.PyPIResource.build_pypi_indexes(root_dir, force=True),
+                             ['jujuresources'])
+            pkg_dir = os.path.join(root_dir, 'jujuresources')
+            os.utime(pkg_dir, (0, 0))
+            self.assertEqual(backend.PyPIResource.build_pypi_indexes(root_dir), ['jujuresources'])
+        finally:
+            shutil.rmtree(tmpdir)
 
     @mock.patch.object(subprocess, 'call')
     def test_install(self, mcall):
@@ -593,6 +1010,8 @@ class TestPyPIResource(unittest.TestCase):
         mcall.assert_called_with(['pip', 'install', 'foo>=0.1', 'od/bar'])
         backend.PyPIResource.install_group(resources, mirror_url='mirror')
         mcall.assert_called_with(['pip', 'install', 'foo>=0.1', 'od/bar', '-i', 'mirror'])
+        backend.PyPIResource.install_group(resources, mirror_url=['m1', 'm2'])
+        mcall.assert_called_with(['pip', 'install', 'foo>=0.1', 'od/bar', '-i', 'm1', '--extra-index-url', 'm2'])
 
 
 if __name__ == '__main__':
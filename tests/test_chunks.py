@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import unittest
+from io import BytesIO
+from tempfile import mkdtemp
+
+from jujuresources import chunks
+
+
+def random_bytes(size, seed=0):
+    rand = random.Random(seed)
+    return bytes(bytearray(rand.getrandbits(8) for i in range(size)))
+
+
+class TestChunks(unittest.TestCase):
+    sizes = dict(min_size=256, avg_size=1024, max_size=4096)
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.data = random_bytes(64 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, filename, data):
+        path = os.path.join(self.tmpdir, filename)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        return path
+
+    def test_iter_chunks(self):
+        parts = list(chunks.iter_chunks(BytesIO(self.data), **self.sizes))
+        self.assertEqual(b''.join(parts), self.data)
+        assert all(len(part) <= 4096 for part in parts)
+        assert all(len(part) > 256 for part in parts[:-1])
+        self.assertEqual(list(chunks.iter_chunks(BytesIO(b''), **self.sizes)), [])
+
+    def test_iter_chunks_insertion(self):
+        digests = lambda data: [hashlib.sha256(part).hexdigest()  # noqa
+                                for part in chunks.iter_chunks(BytesIO(data), **self.sizes)]
+        old = digests(self.data)
+        new = digests(self.data[:30000] + b'inserted' + self.data[30000:])
+        # only the chunks around the insertion change
+        self.assertLessEqual(len(set(new) - set(old)), 2)
+        self.assertGreater(len(new), 20)
+
+    def test_index(self):
+        path = self.write('foo.tgz', self.data)
+        index = chunks.build_index(path, **self.sizes)
+        self.assertEqual(index['size'], len(self.data))
+        self.assertEqual(index['avg_size'], 1024)
+        loaded = chunks.load_index(json.dumps(index).encode('utf-8'))
+        self.assertEqual(loaded['chunks'], [tuple(chunk) for chunk in index['chunks']])
+
+        index['size'] += 1
+        self.assertRaises(ValueError, chunks.load_index, json.dumps(index))
+        self.assertRaises(ValueError, chunks.load_index, '{"chunks": []}')
+        self.assertRaises(ValueError, chunks.load_index, 'garbage')
+
+    def test_local_chunks(self):
+        old = self.write('foo-1.0.tgz', self.data)
+        new = self.write('foo-1.1.tgz', self.data[:30000] + b'inserted' + self.data[30000:])
+        index = chunks.build_index(new, **self.sizes)
+        found = chunks.local_chunks([old, os.path.join(self.tmpdir, 'missing')], index)
+        self.assertGreaterEqual(len(found), len(index['chunks']) - 2)
+        for digest, (path, offset, length) in found.items():
+            self.assertEqual(hashlib.sha256(self.data[offset:offset + length]).hexdigest(), digest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,20 @@
+import json
 import mock
+import os
+import shutil
+import subprocess
+import sys
 import unittest
+from tempfile import mkdtemp
 
 import jujuresources.cli
 from jujuresources import ALL
 from jujuresources.backend import ResourceContainer
 
+if not hasattr(unittest.TestCase, 'assertItemsEqual'):
+    # for Python 3.  assertCountEqual is a stupid name
+    unittest.TestCase.assertItemsEqual = unittest.TestCase.assertCountEqual
+
 
 class TestCLI(unittest.TestCase):
     def setUp(self):
@@ -45,6 +55,7 @@ class TestCLI(unittest.TestCase):
             mep('resource_path', jujuresources.cli.resource_path),
             mep('resource_spec', jujuresources.cli.resource_spec),
             mep('serve', jujuresources.cli.serve),
+            mep('index', jujuresources.cli.index),
         ]
 
     def tearDown(self):
@@ -60,6 +71,42 @@ class TestCLI(unittest.TestCase):
         jujuresources.cli.resources(['--description'])
         self.assertEqual(mprint.call_args_list[0][0][0], 'Manage and mirror charm resources')
 
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli._load')
+    def test_resources_builtin(self, mload, mexit):
+        mload.return_value = self.resources
+        jujuresources.cli.resources(['resource_path', 'valid'])
+        assert not self._miep.called
+        mexit.assert_called_once_with(0)
+
+    @mock.patch('jujuresources.cli._exit')
+    def test_resources_plugin(self, mexit):
+        called = []
+
+        def plugin(opts):
+            """
+            Plugin subcommand.
+            """
+            called.append(opts)
+            return 3
+        ep = mock.Mock()
+        ep.name = 'plugin'
+        ep.load.return_value = plugin
+        self._miep.return_value.append(ep)
+        jujuresources.cli.resources(['plugin'])
+        self._miep.assert_called_once_with('jujuresources.subcommands')
+        self.assertEqual(len(called), 1)
+        mexit.assert_called_once_with(3)
+
+    def test_lazy_imports(self):
+        code = 'import sys, jujuresources.cli; print(" ".join(sys.modules))'
+        modules = subprocess.check_output([sys.executable, '-c', code]).decode('utf-8').split()
+        lazy = ['pkg_resources', 'yaml', 'jujuresources.server']
+        if sys.version_info >= (3, 7):
+            lazy.append('asyncio')  # imported by the standard library itself before 3.7
+        for module in lazy:
+            self.assertNotIn(module, modules)
+
     @mock.patch('jujuresources.cli._exit')
     @mock.patch('jujuresources.cli.verify')
     @mock.patch('jujuresources.cli._fetch')
@@ -69,8 +116,10 @@ class TestCLI(unittest.TestCase):
         mverify.return_value = -1
         jujuresources.cli.resources(['fetch'])
         mload.assert_called_once_with('resources.yaml', None)
-        mfetch.assert_called_once_with(self.resources, [], None, False, mock.ANY)
+        mfetch.assert_called_once_with(self.resources, [], None, False, mock.ANY, mock.ANY, [], None, None, None)
         self.assertIsNotNone(mfetch.call_args_list[0][0][4])
+        scheduler = mfetch.call_args_list[0][0][5]
+        self.assertEqual((scheduler.max_workers, scheduler.max_per_host, scheduler.rate_limit), (4, 2, None))
         mexit.assert_called_once_with(-1)
 
     @mock.patch('jujuresources.cli._exit')
@@ -81,11 +130,25 @@ class TestCLI(unittest.TestCase):
         mload.return_value = self.resources
         mverify.return_value = 1
         jujuresources.cli.resources(['fetch', '-r', 'r.y', '-d', 'od', '-u', 'url',
-                                     '-a', '-q', '-f'])
+                                     '-a', '-q', '-f', '-j', '8', '--per-host', '1',
+                                     '--rate-limit', '1024', '--peers', 'http://p1/,http://p2/'])
         mload.assert_called_once_with('r.y', 'od')
-        mfetch.assert_called_once_with(self.resources, ALL, 'url', True, None)
+        mfetch.assert_called_once_with(self.resources, ALL, 'url', True, None, mock.ANY,
+                                       ['http://p1/', 'http://p2/'], None, None, None)
+        scheduler = mfetch.call_args_list[0][0][5]
+        self.assertEqual((scheduler.max_workers, scheduler.max_per_host, scheduler.rate_limit), (8, 1, 1024))
         mexit.assert_called_once_with(1)
 
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli.verify')
+    @mock.patch('jujuresources.cli._fetch')
+    @mock.patch('jujuresources.cli._load')
+    @mock.patch.object(jujuresources.backend, 'DELTA', False)
+    def test_fetch_delta(self, mload, mfetch, mverify, mexit):
+        mload.return_value = self.resources
+        jujuresources.cli.resources(['fetch', '--delta'])
+        assert jujuresources.backend.DELTA
+
     @mock.patch('jujuresources.cli._exit')
     @mock.patch('jujuresources.cli.verify')
     @mock.patch('jujuresources.cli._fetch')
@@ -107,7 +170,7 @@ class TestCLI(unittest.TestCase):
         minvalid.return_value = ['invalid']
         jujuresources.cli.resources(['verify'])
         mload.assert_called_once_with('resources.yaml', None)
-        minvalid.assert_called_once_with(self.resources, [])
+        minvalid.assert_called_once_with(self.resources, [], None, None, None)
         mprint.assert_called_once_with('Invalid or missing resources: invalid')
         mexit.assert_called_once_with(1)
 
@@ -121,7 +184,7 @@ class TestCLI(unittest.TestCase):
         jujuresources.cli.resources(['verify', '-r', 'r.y', '-d', 'od',
                                      '-a', '-q'])
         mload.assert_called_once_with('r.y', 'od')
-        minvalid.assert_called_once_with(self.resources, ALL)
+        minvalid.assert_called_once_with(self.resources, ALL, None, None, None)
         assert not mprint.called
         mexit.assert_called_once_with(1)
 
@@ -133,10 +196,39 @@ class TestCLI(unittest.TestCase):
         mload.return_value = self.resources
         minvalid.return_value = []
         jujuresources.cli.resources(['verify', 'foo', 'bar'])
-        minvalid.assert_called_once_with(self.resources, ['foo', 'bar'])
+        minvalid.assert_called_once_with(self.resources, ['foo', 'bar'], None, None, None)
         mprint.assert_called_once_with('All resources successfully downloaded')
         mexit.assert_called_once_with(0)
 
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli.print')
+    @mock.patch('jujuresources.cli._load')
+    def test_verify_metrics(self, mload, mprint, mexit):
+        mload.return_value = self.resources
+        tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        jujuresources.cli.resources(['verify', '--metrics', os.path.join(tmpdir, 'm.json')])
+        with open(os.path.join(tmpdir, 'm.json')) as fp:
+            metrics = json.load(fp)
+        self.assertEqual(sorted(metrics), ['invalid', 'valid'])
+        self.assertIn('verify_seconds', metrics['valid'])
+        jujuresources.cli.resources(['verify', '--metrics', os.path.join(tmpdir, 'm.prom')])
+        with open(os.path.join(tmpdir, 'm.prom')) as fp:
+            self.assertIn('jujuresources_verify_seconds{resource="valid"}', fp.read())
+
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli.print')
+    @mock.patch('jujuresources.cli._load')
+    def test_verify_trace(self, mload, mprint, mexit):
+        mload.return_value = self.resources
+        tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        jujuresources.cli.resources(['verify', '--trace', os.path.join(tmpdir, 'trace.json')])
+        with open(os.path.join(tmpdir, 'trace.json')) as fp:
+            trace = json.load(fp)
+        slices = [event['name'] for event in trace['traceEvents'] if event['ph'] == 'X']
+        self.assertItemsEqual(slices, ['verify valid', 'verify invalid'])
+
     @mock.patch('jujuresources.cli._exit')
     @mock.patch('jujuresources.cli.print')
     @mock.patch('jujuresources.cli._load')
@@ -147,6 +239,67 @@ class TestCLI(unittest.TestCase):
         mprint.assert_called_once_with('res-defaults.yaml')
         mexit.assert_called_once_with(0)
 
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli.print')
+    @mock.patch('jujuresources.cli._load')
+    def test_paths(self, mload, mprint, mexit):
+        mload.return_value = self.resources
+        self.resources['valid'].verify = mock.Mock(return_value=True)
+        self.resources['invalid'].verify = mock.Mock(return_value=False)
+        self.resources['opt-invalid'].verify = mock.Mock(return_value=False)
+        jujuresources.cli.resources(['paths'])
+        mload.assert_called_once_with('resources.yaml', None)
+        info = json.loads(mprint.call_args[0][0])
+        self.assertItemsEqual(info.keys(), ['valid', 'invalid', 'opt-invalid'])
+        self.assertEqual(info['valid'], {
+            'path': 'res-defaults.yaml',
+            'spec': 'valid',
+            'verified': True,
+            'hash': '4f08575d804517cea2265a7d43022771',
+            'hash_type': 'md5',
+        })
+        self.assertFalse(info['invalid']['verified'])
+        mexit.assert_called_once_with(0)
+
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli.print')
+    @mock.patch('jujuresources.cli._load')
+    def test_paths_shell(self, mload, mprint, mexit):
+        mload.return_value = self.resources
+        self.resources['opt-invalid'].verify = mock.Mock(return_value=False)
+        self.resources['opt-invalid'].destination = "it's here"
+        jujuresources.cli.resources(['paths', '--shell', 'opt-invalid'])
+        self.assertEqual([c[0][0] for c in mprint.call_args_list], [
+            "RESOURCE_OPT_INVALID_PATH='it'\"'\"'s here'",
+            "RESOURCE_OPT_INVALID_SPEC=opt-invalid",
+            "RESOURCE_OPT_INVALID_HASH=deadbeef",
+            "RESOURCE_OPT_INVALID_HASH_TYPE=md5",
+            "RESOURCE_OPT_INVALID_VERIFIED=false",
+        ])
+        mexit.assert_called_once_with(0)
+
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli.print')
+    @mock.patch('jujuresources.cli.sys')
+    @mock.patch('jujuresources.cli._load')
+    def test_paths_shell_clash(self, mload, msys, mprint, mexit):
+        self.resources.add_required('opt.invalid', {'url': 'opt.invalid'})
+        mload.return_value = self.resources
+        jujuresources.cli.resources(['paths', '--shell', 'valid', 'opt-invalid', 'opt.invalid'])
+        msys.stderr.write.assert_called_once_with(
+            'Resource names map to the same shell variables: opt-invalid and opt.invalid\n')
+        assert not mprint.called
+        mexit.assert_called_once_with(1)
+
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli.sys')
+    @mock.patch('jujuresources.cli._load')
+    def test_paths_invalid_resource(self, mload, msys, mexit):
+        mload.return_value = self.resources
+        jujuresources.cli.resources(['paths', 'valid', 'foo'])
+        msys.stderr.write.assert_called_once_with('Invalid resource name: foo\n')
+        mexit.assert_called_once_with(1)
+
     @mock.patch('jujuresources.cli._exit')
     @mock.patch('jujuresources.cli.sys')
     @mock.patch('jujuresources.cli._load')
@@ -159,26 +312,42 @@ class TestCLI(unittest.TestCase):
 
     @mock.patch('jujuresources.cli._exit')
     @mock.patch('jujuresources.cli.print')
-    @mock.patch('jujuresources.cli.HTTPServer')
+    @mock.patch('jujuresources.server.ChunkIndexCache')
+    @mock.patch('jujuresources.server.CompressedCache')
+    @mock.patch('jujuresources.server.DigestCache')
+    @mock.patch('jujuresources.server.MirrorServer')
     @mock.patch('jujuresources.cli.backend')
     @mock.patch('jujuresources.cli.os')
     @mock.patch('jujuresources.cli._load')
-    def test_serve(self, mload, mos, mbackend, mHTTPServer, mprint, mexit):
+    def test_serve(self, mload, mos, mbackend, mMirrorServer, mDigestCache, mCompressedCache,
+                   mChunkIndexCache, mprint, mexit):
         mload.return_value = self.resources
         mos.path.exists.return_value = True
-        jujuresources.cli.resources(['serve', '-H', 'host', '-p', '9999'])
+        jujuresources.cli.resources(['serve', '-H', 'host', '-p', '9999', '-c', '10'])
         mos.chdir.assert_called_once_with('resources')
         mbackend.PyPIResource.build_pypi_indexes.assert_called_with('resources')
-        self.assertIs(mHTTPServer.allow_reuse_address, True)
-        mHTTPServer.assert_called_once_with(('host', 9999), jujuresources.cli.SimpleHTTPRequestHandler)
+        mDigestCache.assert_called_once_with('resources')
+        self.assertItemsEqual(mDigestCache.return_value.precompute.call_args[0][0], self.resources.all())
+        mCompressedCache.assert_called_once_with('.')
+        mChunkIndexCache.assert_called_once_with('resources')
+        self.assertItemsEqual(mChunkIndexCache.return_value.precompute.call_args[0][0], self.resources.all())
+        mMirrorServer.assert_called_once_with(('host', 9999), max_connections=10,
+                                              digests=mDigestCache.return_value,
+                                              compressed=mCompressedCache.return_value,
+                                              verified=None, chunks=mChunkIndexCache.return_value)
+        mMirrorServer.return_value.serve_forever.assert_called_once_with()
 
     @mock.patch('jujuresources.cli._exit')
     @mock.patch('jujuresources.cli.print')
-    @mock.patch('jujuresources.cli.HTTPServer')
+    @mock.patch('jujuresources.server.ChunkIndexCache')
+    @mock.patch('jujuresources.server.CompressedCache')
+    @mock.patch('jujuresources.server.DigestCache')
+    @mock.patch('jujuresources.server.MirrorServer')
     @mock.patch('jujuresources.cli.backend')
     @mock.patch('jujuresources.cli.os')
     @mock.patch('jujuresources.cli._load')
-    def test_serve_dir(self, mload, mos, mbackend, mHTTPServer, mprint, mexit):
+    def test_serve_dir(self, mload, mos, mbackend, mMirrorServer, mDigestCache, mCompressedCache,
+                       mChunkIndexCache, mprint, mexit):
         mload.return_value = ResourceContainer('od')
         mos.path.exists.return_value = True
         jujuresources.cli.resources(['serve', '-d', 'od'])
@@ -186,8 +355,29 @@ class TestCLI(unittest.TestCase):
         mos.path.exists.assert_called_once_with('od')
         mbackend.PyPIResource.build_pypi_indexes.assert_called_with('od')
         mos.chdir.assert_called_once_with('od')
-        self.assertIs(mHTTPServer.allow_reuse_address, True)
-        mHTTPServer.assert_called_once_with(('', 8080), jujuresources.cli.SimpleHTTPRequestHandler)
+        mDigestCache.assert_called_once_with('od')
+        mMirrorServer.assert_called_once_with(('', 8080), max_connections=100,
+                                              digests=mDigestCache.return_value,
+                                              compressed=mCompressedCache.return_value,
+                                              verified=None, chunks=mChunkIndexCache.return_value)
+
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli.print')
+    @mock.patch('jujuresources.server.VerifiedFiles')
+    @mock.patch('jujuresources.server.CompressedCache')
+    @mock.patch('jujuresources.server.DigestCache')
+    @mock.patch('jujuresources.server.MirrorServer')
+    @mock.patch('jujuresources.cli.backend')
+    @mock.patch('jujuresources.cli.os')
+    @mock.patch('jujuresources.cli._load')
+    def test_serve_peer(self, mload, mos, mbackend, mMirrorServer, mDigestCache, mCompressedCache,
+                        mVerifiedFiles, mprint, mexit):
+        mload.return_value = self.resources
+        mos.path.exists.return_value = True
+        jujuresources.cli.resources(['serve', '--peer'])
+        self.assertItemsEqual(mVerifiedFiles.call_args[0][0], self.resources.all())
+        self.assertEqual(mVerifiedFiles.call_args[0][1], mDigestCache.return_value)
+        self.assertEqual(mMirrorServer.call_args[1]['verified'], mVerifiedFiles.return_value)
 
     @mock.patch('jujuresources.cli._exit')
     @mock.patch('jujuresources.cli.sys')
@@ -200,6 +390,32 @@ class TestCLI(unittest.TestCase):
         msys.stderr.write.assert_called_once_with("Resources dir 'od' not found.  Did you fetch?\n")
         mexit.assert_called_once_with(1)
 
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli.print')
+    @mock.patch('jujuresources.cli.backend')
+    @mock.patch('jujuresources.cli.os')
+    @mock.patch('jujuresources.cli._load')
+    def test_index(self, mload, mos, mbackend, mprint, mexit):
+        mload.return_value = ResourceContainer('od')
+        mos.path.exists.return_value = True
+        mbackend.PyPIResource.build_pypi_indexes.return_value = ['foo']
+        jujuresources.cli.resources(['index', '-d', 'od', '-f'])
+        mload.assert_called_once_with('resources.yaml', 'od')
+        mbackend.PyPIResource.build_pypi_indexes.assert_called_once_with('od', True)
+        mprint.assert_called_once_with('Updated 1 package index')
+        mexit.assert_called_once_with(0)
+
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli.sys')
+    @mock.patch('jujuresources.cli.os')
+    @mock.patch('jujuresources.cli._load')
+    def test_index_no_fetch(self, mload, mos, msys, mexit):
+        mload.return_value = ResourceContainer('od')
+        mos.path.exists.return_value = False
+        jujuresources.cli.resources(['index', '-d', 'od'])
+        msys.stderr.write.assert_called_once_with("Resources dir 'od' not found.  Did you fetch?\n")
+        mexit.assert_called_once_with(1)
+
     @mock.patch('jujuresources.cli._exit')
     @mock.patch('jujuresources.cli.print')
     @mock.patch('jujuresources.cli._install')
@@ -209,7 +425,7 @@ class TestCLI(unittest.TestCase):
         minstall.return_value = True
         jujuresources.cli.resources(['install'])
         mload.assert_called_once_with('resources.yaml', None)
-        minstall.assert_called_once_with(self.resources, [], None, None, False)
+        minstall.assert_called_once_with(self.resources, [], None, None, False, None, None, None)
         mprint.assert_called_with('All resources successfully installed')
         mexit.assert_called_with(0)
 
@@ -224,7 +440,7 @@ class TestCLI(unittest.TestCase):
         minvalid.return_value = ['foo', 'bar']
         jujuresources.cli.resources(['install'])
         mload.assert_called_once_with('resources.yaml', None)
-        minstall.assert_called_once_with(self.resources, [], None, None, False)
+        minstall.assert_called_once_with(self.resources, [], None, None, False, None, None, None)
         mprint.assert_called_with('Unable to install some resources: foo, bar')
         mexit.assert_called_with(1)
 
@@ -238,7 +454,7 @@ class TestCLI(unittest.TestCase):
         jujuresources.cli.resources(['install', '-r', 'r.y', '-d', 'od', '-u', 'url',
                                      '-D', 'dst', '-s', '-q', '-a'])
         mload.assert_called_once_with('r.y', 'od')
-        minstall.assert_called_once_with(self.resources, ALL, 'url', 'dst', True)
+        minstall.assert_called_once_with(self.resources, ALL, 'url', 'dst', True, None, None, None)
         assert not mprint.called
         mexit.assert_called_with(1)
 
@@ -0,0 +1,138 @@
+import hashlib
+import mock
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import unittest
+from tempfile import mkdtemp
+
+import jujuresources
+import jujuresources.cli
+from jujuresources import backend
+from jujuresources import daemon
+
+RESOURCES_YAML = """\
+resources:
+  foo:
+    url: http://example.com/foo.tgz
+    hash: {}
+    hash_type: sha256
+"""
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires Unix sockets')
+class TestResourceDaemon(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = mkdtemp()
+        os.chdir(self.tmpdir)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(os.chdir, self.cwd)
+        for name, value in (('CACHE_DIR', os.path.join(self.tmpdir, 'cache')), ('resources_cache', {})):
+            patcher = mock.patch.object(jujuresources, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        os.makedirs(os.path.join('resources', 'foo'))
+        with open(os.path.join('resources', 'foo', 'foo.tgz'), 'wb') as fp:
+            fp.write(b'foo')
+        with open('resources.yaml', 'w') as fp:
+            fp.write(RESOURCES_YAML.format(hashlib.sha256(b'foo').hexdigest()))
+        self.socket_file = os.path.join(self.tmpdir, 'daemon.sock')
+
+    def start(self, **kwargs):
+        server = daemon.ResourceDaemon(self.socket_file, **kwargs)
+        server.timeout = 0.05
+        thread = threading.Thread(target=server.serve)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.stop)
+        return server
+
+    def test_resource_path(self):
+        self.start()
+        response = daemon.request(['resource_path', 'foo'], self.socket_file)
+        self.assertEqual(response, {'status': 0, 'stdout': 'resources/foo/foo.tgz\n', 'stderr': ''})
+        response = daemon.request(['resource_path', 'bar'], self.socket_file)
+        self.assertEqual(response, {'status': 1, 'stdout': '', 'stderr': 'Invalid resource name: bar\n'})
+        response = daemon.request(['resource_path'], self.socket_file)
+        self.assertEqual(response['status'], 2)  # usage error
+
+    def test_reload(self):
+        self.start()
+        daemon.request(['resource_path', 'foo'], self.socket_file)
+        with open('resources.yaml', 'a') as fp:
+            fp.write('  bar:\n    url: http://example.com/bar.tgz\n')
+        response = daemon.request(['resource_path', 'bar'], self.socket_file)
+        self.assertEqual(response['stdout'], 'resources/bar/bar.tgz\n')
+
+    def test_verify_cached(self):
+        self.start()
+        with mock.patch.object(backend.URLResource, '_check_hash', return_value=True) as mcheck:
+            for i in range(3):
+                response = daemon.request(['verify'], self.socket_file)
+                self.assertEqual(response['status'], 0)
+            self.assertEqual(mcheck.call_count, 1)
+            with open(os.path.join('resources', 'foo', 'foo.tgz'), 'wb') as fp:
+                fp.write(b'changed')
+            daemon.request(['verify'], self.socket_file)
+            self.assertEqual(mcheck.call_count, 2)
+
+    def test_not_handled(self):
+        self.start()
+        self.assertIsNone(daemon.request(['install'], self.socket_file))
+        self.assertIsNone(daemon.request(['fetch'], self.socket_file))
+        os.mkdir('sub')
+        os.chdir('sub')
+        self.assertIsNone(daemon.request(['resource_path', 'foo'], self.socket_file))
+
+    def test_no_daemon(self):
+        self.assertIsNone(daemon.request(['resource_path', 'foo'], self.socket_file))
+        open(self.socket_file, 'w').close()  # left behind by a killed daemon
+        self.assertIsNone(daemon.request(['resource_path', 'foo'], self.socket_file))
+        server = self.start()
+        self.assertEqual(daemon.request(['resource_path', 'foo'], self.socket_file)['status'], 0)
+        self.assertRaises(IOError, daemon.ResourceDaemon, self.socket_file)
+        server.stop()
+
+    @mock.patch.object(daemon.DaemonRequestHandler, 'timeout', 0.1)
+    def test_stalled_client(self):
+        self.start()
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(stalled.close)
+        stalled.connect(self.socket_file)  # never sends its request
+        self.assertEqual(daemon.request(['resource_path', 'foo'], self.socket_file)['status'], 0)
+
+    def test_idle_timeout(self):
+        server = daemon.ResourceDaemon(self.socket_file, idle_timeout=0.1)
+        server.timeout = 0.05
+        server.serve()
+        assert not os.path.exists(self.socket_file)
+        self.assertIsNone(backend.VERIFIED)
+
+    def test_client(self):
+        self.start()
+        script = ('import sys, jujuresources_client\n'
+                  'try:\n'
+                  '    jujuresources_client.main(["resource_path", "foo"])\n'
+                  'except SystemExit as e:\n'
+                  '    assert "jujuresources" not in sys.modules\n'
+                  '    raise\n')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root, JUJU_RESOURCES_SOCKET=self.socket_file)
+        output = subprocess.check_output([sys.executable, '-c', script], env=env)
+        self.assertEqual(output, b'resources/foo/foo.tgz\n')
+
+    @mock.patch('sys.stdout')
+    def test_cli(self, mstdout):
+        self.start()
+        with mock.patch.dict(os.environ, {'JUJU_RESOURCES_SOCKET': self.socket_file}):
+            with mock.patch.object(daemon, 'request', wraps=daemon.request) as mrequest:
+                with self.assertRaises(SystemExit) as cm:
+                    jujuresources.cli.resources(['resource_path', 'foo'])
+        mrequest.assert_called_once_with(['resource_path', 'foo'])
+        mstdout.write.assert_called_once_with('resources/foo/foo.tgz\n')
+        self.assertEqual(cm.exception.code, 0)
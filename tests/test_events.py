@@ -0,0 +1,18 @@
+import mock
+import unittest
+
+from jujuresources import events
+
+
+class TestEvents(unittest.TestCase):
+    def test_from_reporthook(self):
+        reporthook = mock.Mock()
+        hook = events.from_reporthook(reporthook)
+        hook(events.Event(events.FETCH_START, 'foo', 0, {'mirror_url': None}))
+        hook(events.Event(events.BYTES, 'foo', 1, {'bytes': 3, 'total': 3, 'size': None}))
+        hook(events.Event(events.VERIFIED, 'foo', 2, {'valid': True}))
+        reporthook.assert_called_once_with('foo')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from jujuresources.metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.add('foo', 'transfer_bytes', 1000)
+        self.metrics.add('foo', 'transfer_seconds', 1.5)
+        self.metrics.add('foo', 'transfer_seconds', 0.5)
+        self.metrics.add('b"a\\r', 'hash_seconds', 0.25)
+
+    def test_as_dict(self):
+        self.assertEqual(self.metrics.as_dict(), {
+            'foo': {'transfer_bytes': 1000, 'transfer_seconds': 2.0, 'transfer_bytes_per_second': 500.0},
+            'b"a\\r': {'hash_seconds': 0.25},
+        })
+
+    def test_timer(self):
+        with self.metrics.timer('bar', 'pip_seconds'):
+            pass
+        with self.assertRaises(ValueError):
+            with self.metrics.timer('bar', 'pip_seconds'):
+                raise ValueError()
+        self.assertGreaterEqual(self.metrics.as_dict()['bar']['pip_seconds'], 0)
+
+    def test_to_prometheus(self):
+        lines = self.metrics.to_prometheus().splitlines()
+        self.assertEqual(lines[:3], [
+            '# HELP jujuresources_hash_seconds Time spent hashing the resource',
+            '# TYPE jujuresources_hash_seconds gauge',
+            'jujuresources_hash_seconds{resource="b\\"a\\\\r"} 0.25',
+        ])
+        self.assertIn('jujuresources_transfer_bytes{resource="foo"} 1000.0', lines)
+        self.assertIn('jujuresources_transfer_bytes_per_second{resource="foo"} 500.0', lines)
+
+    def test_write(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.metrics.write(os.path.join(tmpdir, 'metrics.json'))
+        self.metrics.write(os.path.join(tmpdir, 'metrics.prom'))
+        self.metrics.write(os.path.join(tmpdir, 'metrics.txt'), 'prometheus')
+        self.assertRaises(ValueError, self.metrics.write, os.path.join(tmpdir, 'metrics'), 'xml')
+        self.assertEqual(sorted(os.listdir(tmpdir)), ['metrics.json', 'metrics.prom', 'metrics.txt'])
+        with open(os.path.join(tmpdir, 'metrics.json')) as fp:
+            self.assertEqual(json.load(fp), self.metrics.as_dict())
+        with open(os.path.join(tmpdir, 'metrics.prom')) as fp:
+            self.assertEqual(fp.read(), self.metrics.to_prometheus())
+
+
+if __name__ == '__main__':
+    unittest.main()
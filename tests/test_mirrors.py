@@ -0,0 +1,93 @@
+import json
+import mock
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from jujuresources import mirrors
+
+if not hasattr(unittest.TestCase, 'assertItemsEqual'):
+    # for Python 3.  assertCountEqual is a stupid name
+    unittest.TestCase.assertItemsEqual = unittest.TestCase.assertCountEqual
+
+
+class TestMirrorRanking(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.cache_file = os.path.join(self.tmpdir, mirrors.MirrorRanking.CACHE_FILE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_rank(self):
+        ranking = mirrors.MirrorRanking()
+        scores = {'http://slow/': 2.0, 'http://fast/': 0.5, 'http://down/': None}
+        ranking.probe = mock.Mock(side_effect=lambda mirror: scores[mirror])
+        self.assertEqual(ranking.rank(['http://down/', 'http://slow/', 'http://fast/']),
+                         ['http://fast/', 'http://slow/', 'http://down/'])
+        self.assertEqual(ranking.probe.call_count, 3)
+
+        # rankings are reused until they expire
+        self.assertEqual(ranking.rank(['http://slow/', 'http://fast/']), ['http://fast/', 'http://slow/'])
+        self.assertEqual(ranking.probe.call_count, 3)
+
+        # failed mirrors are probed again, and ranked by the result
+        ranking.failed('http://fast/')
+        self.assertEqual(ranking.score('http://fast/'), float('inf'))
+        scores['http://fast/'] = None
+        self.assertEqual(ranking.rank(['http://slow/', 'http://fast/']), ['http://slow/', 'http://fast/'])
+        self.assertEqual(ranking.probe.call_count, 4)
+        ranking.probe.assert_called_with('http://fast/')
+
+        ranking.ttl = -1
+        scores['http://fast/'] = 0.5
+        self.assertEqual(ranking.rank(['http://slow/', 'http://fast/']), ['http://fast/', 'http://slow/'])
+        self.assertEqual(ranking.probe.call_count, 6)
+
+    def test_rank_single(self):
+        ranking = mirrors.MirrorRanking()
+        ranking.probe = mock.Mock()
+        self.assertEqual(ranking.rank(['http://m1/']), ['http://m1/'])
+        self.assertEqual(ranking.rank([]), [])
+        assert not ranking.probe.called
+
+    def test_cache_file(self):
+        ranking = mirrors.MirrorRanking(self.cache_file)
+        ranking.probe = mock.Mock(side_effect=[2.0, 1.0])
+        self.assertEqual(ranking.rank(['http://m1/', 'http://m2/']), ['http://m2/', 'http://m1/'])
+        with open(self.cache_file) as fp:
+            self.assertItemsEqual(json.load(fp).keys(), ['http://m1/', 'http://m2/'])
+
+        ranking = mirrors.MirrorRanking(self.cache_file)
+        ranking.probe = mock.Mock()
+        self.assertEqual(ranking.rank(['http://m1/', 'http://m2/']), ['http://m2/', 'http://m1/'])
+        assert not ranking.probe.called
+
+        with open(self.cache_file, 'w') as fp:
+            fp.write('garbage')
+        self.assertEqual(mirrors.MirrorRanking(self.cache_file)._scores, {})
+
+    @mock.patch.object(mirrors.time, 'time')
+    @mock.patch.object(mirrors, 'urlopen')
+    def test_probe(self, murlopen, mtime):
+        mtime.side_effect = [10.0, 10.1, 10.2, 10.3, 20.0]
+        murlopen.return_value.read.return_value = b'x' * 1024
+        ranking = mirrors.MirrorRanking(probe_path='/index.html', sample_size=1024)
+        self.assertAlmostEqual(ranking.probe('http://m1/'), 0.1 + 1024 * 0.1)
+        head, get = [c[0][0] for c in murlopen.call_args_list]
+        self.assertEqual(head.get_method(), 'HEAD')
+        self.assertEqual(head.get_full_url(), 'http://m1/index.html')
+        self.assertEqual(get.get_header('Range'), 'bytes=0-1023')
+
+        # a sample shorter than sample_size is mostly noise
+        mtime.side_effect = [10.0, 10.1, 10.2, 10.3, 20.0]
+        murlopen.return_value.read.return_value = b'x' * 100
+        self.assertAlmostEqual(ranking.probe('http://m1/'), 0.1)
+
+        murlopen.side_effect = IOError('connection refused')
+        self.assertIsNone(ranking.probe('http://m1/'))
+
+
+if __name__ == '__main__':
+    unittest.main()
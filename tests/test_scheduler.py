@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import mock
+import threading
+import time
+import unittest
+
+from jujuresources import backend
+from jujuresources import scheduler
+
+
+class TestTokenBucket(unittest.TestCase):
+    @mock.patch.object(scheduler.time, 'sleep')
+    @mock.patch.object(scheduler.time, 'time')
+    def test_consume(self, mtime, msleep):
+        mtime.return_value = 100.0
+        bucket = scheduler.TokenBucket(1000)
+        bucket.consume(600)
+        assert not msleep.called
+        bucket.consume(600)
+        msleep.assert_called_once_with(0.2)
+
+        # refills over time, but never beyond the burst size
+        msleep.reset_mock()
+        mtime.return_value = 110.0
+        bucket.consume(1000)
+        assert not msleep.called
+
+
+class TestFetchScheduler(unittest.TestCase):
+    def resource(self, name, url):
+        return backend.URLResource(name, {'url': url}, 'od')
+
+    def test_host(self):
+        res = self.resource('foo', 'http://example.com/foo.tgz')
+        self.assertEqual(scheduler.FetchScheduler.host(res, None), 'example.com')
+        self.assertEqual(scheduler.FetchScheduler.host(res, 'http://mirror:8080/'), 'mirror:8080')
+        res = backend.PyPIResource('bar', {'pypi': 'bar'}, 'od')
+        self.assertEqual(scheduler.FetchScheduler.host(res, None), 'pypi')
+        self.assertEqual(scheduler.FetchScheduler.host(res, 'http://mirror:8080/'), 'pypi')
+        res = backend.PyPIResource('baz', {'pypi': 'http://example.com/baz.tgz'}, 'od')
+        self.assertEqual(scheduler.FetchScheduler.host(res, None), 'example.com')
+
+    def test_run_priority(self):
+        fetched = []
+        jobs = []
+        for priority, name in [(1, 'opt'), (0, 'req1'), (0, 'req2')]:
+            res = self.resource(name, 'http://example.com/' + name)
+            res.fetch = mock.Mock(side_effect=lambda url, name=name: fetched.append((name, url)))
+            jobs.append((priority, res))
+        reporthook = mock.Mock()
+        scheduler.FetchScheduler(max_workers=1).run(jobs, 'mirror', reporthook)
+        self.assertEqual(fetched, [('req1', 'mirror'), ('req2', 'mirror'), ('opt', 'mirror')])
+        self.assertEqual(reporthook.call_args_list, [mock.call('req1'), mock.call('req2'), mock.call('opt')])
+
+    def test_run_per_host(self):
+        lock = threading.Lock()
+        active = {}
+        peak = {}
+
+        def fetch(host):
+            with lock:
+                active[host] = active.get(host, 0) + 1
+                peak[host] = max(peak.get(host, 0), active[host])
+            time.sleep(0.02)
+            with lock:
+                active[host] -= 1
+
+        jobs = []
+        for i in range(4):
+            for host in ('a.com', 'b.com'):
+                res = self.resource('%s%d' % (host, i), 'http://%s/%d' % (host, i))
+                res.fetch = mock.Mock(side_effect=lambda url, host=host: fetch(host))
+                jobs.append((0, res))
+        scheduler.FetchScheduler(max_workers=4, max_per_host=1).run(jobs, None)
+        self.assertEqual(peak, {'a.com': 1, 'b.com': 1})
+        for priority, res in jobs:
+            res.fetch.assert_called_once_with(None)
+
+    def test_run_pip_serialized(self):
+        lock = threading.Lock()
+        active = []
+        peak = []
+
+        def fetch(url):
+            with lock:
+                active.append(url)
+                peak.append(len(active))
+            time.sleep(0.02)
+            with lock:
+                active.remove(url)
+
+        jobs = []
+        for name in ('foo', 'bar', 'baz'):
+            res = backend.PyPIResource(name, {'pypi': name}, 'od')
+            res.fetch = mock.Mock(side_effect=fetch)
+            jobs.append((0, res))
+        scheduler.FetchScheduler(max_workers=4, max_per_host=2).run(jobs, 'http://mirror/')
+        self.assertEqual(peak, [1, 1, 1])
+
+    def test_run_rate_limit(self):
+        throttles = []
+        res = self.resource('foo', 'http://example.com/foo')
+        res.fetch = mock.Mock(side_effect=lambda url: throttles.append(backend.THROTTLE))
+        scheduler.FetchScheduler(rate_limit=1024).run([(0, res)], None)
+        self.assertEqual(throttles[0].rate, 1024)
+        self.assertIsNone(backend.THROTTLE)
+
+    def test_run_ranking(self):
+        rankings = []
+        res = self.resource('foo', 'http://example.com/foo')
+        res.fetch = mock.Mock(side_effect=lambda url: rankings.append(backend.RANKING))
+        ranking = mock.Mock()
+        ranking.rank.side_effect = lambda mirrors: list(reversed(mirrors))
+        scheduler.FetchScheduler(ranking=ranking).run([(0, res)], 'http://m1/,http://m2/')
+        self.assertEqual(rankings, [ranking])
+        self.assertIsNone(backend.RANKING)
+
+        # fetches are grouped by the best mirror
+        self.assertEqual(scheduler.FetchScheduler.host(res, 'http://m1/,http://m2/'), 'm1')
+        with mock.patch.object(backend, 'RANKING', ranking):
+            self.assertEqual(scheduler.FetchScheduler.host(res, 'http://m1/,http://m2/'), 'm2')
+
+    def test_run_error(self):
+        res = self.resource('foo', 'http://example.com/foo')
+        res.fetch = mock.Mock(side_effect=ValueError('boom'))
+        other = self.resource('bar', 'http://example.com/bar')
+        other.fetch = mock.Mock()
+        self.assertRaises(ValueError, scheduler.FetchScheduler().run, [(0, res), (1, other)], None)
+        other.fetch.assert_called_once_with(None)
+
+    def test_run_events(self):
+        res = self.resource('foo', 'http://example.com/foo')
+        error = ValueError('boom')
+        res.fetch = mock.Mock(side_effect=error)
+        events = []
+        with mock.patch.object(backend, 'EVENTS', events.append):
+            self.assertRaises(ValueError, scheduler.FetchScheduler().run, [(0, res)], 'http://mirror/')
+        self.assertEqual([(e.type, e.name, e.data) for e in events], [
+            ('fetch_start', 'foo', {'mirror_url': 'http://mirror/'}),
+            ('failed', 'foo', {'error': error, 'url': None}),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,433 @@
+import hashlib
+import json
+import mock
+import os
+import random
+import shutil
+import socket
+import threading
+import time
+import unittest
+from contextlib import closing
+from tempfile import mkdtemp
+
+try:
+    from urllib.request import urlopen, Request  # Python 3
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, Request, HTTPError  # Python 2
+
+from jujuresources import backend
+from jujuresources import chunks
+from jujuresources import server
+from jujuresources.metrics import Metrics
+
+if not hasattr(unittest.TestCase, 'assertItemsEqual'):
+    # for Python 3.  assertCountEqual is a stupid name
+    unittest.TestCase.assertItemsEqual = unittest.TestCase.assertCountEqual
+
+
+class QuietHandler(server.MirrorRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class TestMirrorServer(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = mkdtemp()
+        with open(os.path.join(self.tmpdir, 'foo.txt'), 'w') as fp:
+            fp.write('foo')
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def start(self, **kwargs):
+        httpd = server.MirrorServer(('127.0.0.1', 0), QuietHandler, **kwargs)
+        thread = threading.Thread(target=httpd.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        return httpd
+
+    def url(self, httpd, path):
+        return 'http://127.0.0.1:{}/{}'.format(httpd.server_address[1], path)
+
+    def test_concurrent(self):
+        httpd = self.start()
+        # a stalled client must not block other requests
+        with closing(socket.create_connection(httpd.server_address)):
+            with closing(urlopen(self.url(httpd, 'foo.txt'), timeout=5)) as fp:
+                self.assertEqual(fp.read(), b'foo')
+
+    def test_max_connections(self):
+        httpd = self.start(max_connections=1)
+        self.assertEqual(httpd.max_connections, 1)
+        with closing(socket.create_connection(httpd.server_address)):
+            self.assertRaises(socket.timeout, lambda: urlopen(self.url(httpd, 'foo.txt'), timeout=0.5).read())
+        with closing(urlopen(self.url(httpd, 'foo.txt'), timeout=5)) as fp:
+            self.assertEqual(fp.read(), b'foo')
+
+    def get(self, httpd, path, **headers):
+        try:
+            with closing(urlopen(Request(self.url(httpd, path), headers=headers), timeout=5)) as fp:
+                return fp.getcode(), fp.info(), fp.read()
+        except HTTPError as e:
+            return e.code, e.info(), e.read()
+
+    def test_headers(self):
+        httpd = self.start()
+        code, headers, body = self.get(httpd, 'foo.txt')
+        self.assertEqual(code, 200)
+        self.assertEqual(body, b'foo')
+        self.assertEqual(headers['Content-Length'], '3')
+        self.assertEqual(headers['Accept-Ranges'], 'bytes')
+        assert headers['ETag']
+        assert headers['Last-Modified']
+
+    def test_not_found(self):
+        httpd = self.start()
+        code, headers, body = self.get(httpd, 'nonce.txt')
+        self.assertEqual(code, 404)
+
+    def test_range(self):
+        httpd = self.start()
+        code, headers, body = self.get(httpd, 'foo.txt', Range='bytes=1-')
+        self.assertEqual(code, 206)
+        self.assertEqual(body, b'oo')
+        self.assertEqual(headers['Content-Range'], 'bytes 1-2/3')
+        code, headers, body = self.get(httpd, 'foo.txt', Range='bytes=0-0')
+        self.assertEqual((code, body), (206, b'f'))
+        code, headers, body = self.get(httpd, 'foo.txt', Range='bytes=-2')
+        self.assertEqual((code, body), (206, b'oo'))
+        code, headers, body = self.get(httpd, 'foo.txt', Range='bytes=5-')
+        self.assertEqual(code, 416)
+        self.assertEqual(headers['Content-Range'], 'bytes */3')
+        code, headers, body = self.get(httpd, 'foo.txt', Range='bytes=0-0,2-2')
+        self.assertEqual((code, body), (200, b'foo'))
+
+    def test_if_range(self):
+        httpd = self.start()
+        code, headers, body = self.get(httpd, 'foo.txt')
+        code, headers, body = self.get(httpd, 'foo.txt', Range='bytes=1-', **{'If-Range': headers['ETag']})
+        self.assertEqual((code, body), (206, b'oo'))
+        code, headers, body = self.get(httpd, 'foo.txt', Range='bytes=1-', **{'If-Range': '"stale"'})
+        self.assertEqual((code, body), (200, b'foo'))
+
+    def test_revalidate(self):
+        httpd = self.start()
+        code, headers, body = self.get(httpd, 'foo.txt')
+        code, _, body = self.get(httpd, 'foo.txt', **{'If-None-Match': headers['ETag']})
+        self.assertEqual((code, body), (304, b''))
+        code, _, body = self.get(httpd, 'foo.txt', **{'If-Modified-Since': headers['Last-Modified']})
+        self.assertEqual((code, body), (304, b''))
+        code, _, body = self.get(httpd, 'foo.txt', **{'If-None-Match': '"stale"'})
+        self.assertEqual((code, body), (200, b'foo'))
+
+    def test_digest_headers(self):
+        httpd = self.start(digests=server.DigestCache(self.tmpdir))
+        code, headers, body = self.get(httpd, 'foo.txt')
+        self.assertEqual(headers['Digest'], 'sha-256=LCa0a2j/xo/5m0U8HTBBNBNCLXBkg7+g+YpeiGJm564=')
+        self.assertEqual(headers['Repr-Digest'], 'sha-256=:LCa0a2j/xo/5m0U8HTBBNBNCLXBkg7+g+YpeiGJm564=:')
+
+    def test_sidecar(self):
+        httpd = self.start(digests=server.DigestCache(self.tmpdir))
+        code, headers, body = self.get(httpd, 'foo.txt.md5')
+        self.assertEqual((code, body), (200, b'acbd18db4cc2f85cedef654fccc4a4d8\n'))
+        code, headers, body = self.get(httpd, 'bar.txt.md5')
+        self.assertEqual(code, 404)
+        code, headers, body = self.get(httpd, 'foo.txt.shake_128')  # needs a digest length
+        self.assertEqual(code, 404)
+        code, headers, body = self.get(httpd, 'foo.txt')
+        self.assertIn('md5=rL0Y20zC+Fzt72VPzMSk2A==', headers['Digest'])
+
+    def test_verified_only(self):
+        os.mkdir('res')
+        with open(os.path.join('res', 'bad.txt'), 'w') as fp:
+            fp.write('corrupt')
+        resources = [
+            backend.URLResource('res', {
+                'url': 'http://example.com/foo.txt',
+                'hash': 'acbd18db4cc2f85cedef654fccc4a4d8',
+                'hash_type': 'md5',
+            }, self.tmpdir),
+            backend.URLResource('res', {
+                'url': 'http://example.com/bad.txt',
+                'hash': 'acbd18db4cc2f85cedef654fccc4a4d8',
+                'hash_type': 'md5',
+            }, self.tmpdir),
+        ]
+        shutil.copy('foo.txt', os.path.join('res', 'foo.txt'))
+        digests = server.DigestCache(self.tmpdir)
+        chunk_indexes = server.ChunkIndexCache(self.tmpdir)
+        chunk_indexes.precompute(resources)
+        chunk_indexes.wait()
+        httpd = self.start(digests=digests, verified=server.VerifiedFiles(resources, digests),
+                           chunks=chunk_indexes)
+        self.assertEqual(self.get(httpd, 'res/foo.txt')[::2], (200, b'foo'))
+        self.assertEqual(self.get(httpd, 'res/foo.txt.chunks')[0], 200)
+        self.assertEqual(self.get(httpd, 'res/bad.txt.chunks')[0], 404)
+        self.assertEqual(self.get(httpd, 'res/foo.txt.md5')[::2], (200, b'acbd18db4cc2f85cedef654fccc4a4d8\n'))
+        self.assertEqual(self.get(httpd, 'res/bad.txt')[0], 404)
+        self.assertEqual(self.get(httpd, 'foo.txt')[0], 404)
+        self.assertEqual(self.get(httpd, 'res/')[0], 404)
+
+    def test_peers(self):
+        # several units on loopback, serving whatever they have verified
+        resource_def = {
+            'url': 'http://upstream.invalid/foo.txt',
+            'hash': 'acbd18db4cc2f85cedef654fccc4a4d8',
+            'hash_type': 'md5',
+        }
+        peers = []
+        for name, content in [('empty', None), ('corrupt', 'bar'), ('good', 'foo')]:
+            unit_dir = os.path.join(self.tmpdir, name)
+            os.makedirs(os.path.join(unit_dir, 'res'))
+            if content:
+                with open(os.path.join(unit_dir, 'res', 'foo.txt'), 'w') as fp:
+                    fp.write(content)
+            resources = [backend.URLResource('res', resource_def, unit_dir)]
+            digests = server.DigestCache(unit_dir)
+            httpd = self.start(digests=digests, verified=server.VerifiedFiles(resources, digests))
+            # the servers share the test's cwd, so each unit's dir is under the root
+            peers.append(self.url(httpd, name + '/'))
+
+        resource = backend.URLResource('res', resource_def, os.path.join(self.tmpdir, 'new'))
+        with mock.patch.object(backend, 'PEERS', peers), mock.patch('sys.stderr'):
+            resource.fetch()
+        assert resource.verify()
+
+    def test_chunk_index(self):
+        with open('foo.bin', 'wb') as fp:
+            fp.write(os.urandom(100 * 1024))
+        chunk_indexes = server.ChunkIndexCache(self.tmpdir)
+        httpd = self.start(chunks=chunk_indexes)
+        self.assertEqual(self.get(httpd, 'foo.bin.chunks')[0], 404)  # built in the background
+        chunk_indexes.wait()
+        code, headers, body = self.get(httpd, 'foo.bin.chunks')
+        self.assertEqual(code, 200)
+        self.assertEqual(headers['Content-Type'], 'application/json')
+        self.assertEqual(chunks.load_index(body)['size'], 100 * 1024)
+        self.assertEqual(self.get(httpd, 'bar.bin.chunks')[0], 404)
+
+    def test_delta_fetch(self):
+        requests = []
+
+        class RecordingHandler(QuietHandler):
+            def send_head(self):
+                requests.append((self.path, self.headers.get('Range')))
+                return QuietHandler.send_head(self)
+
+        rnd = random.Random(0)  # random data chunks unpredictably, which would make this flaky
+        old = bytes(bytearray(rnd.getrandbits(8) for _ in range(1024 * 1024)))
+        new = old[:500000] + b'changed' + old[500000:]
+        os.makedirs(os.path.join('mirror', 'res'))
+        with open(os.path.join('mirror', 'res', 'foo-1.1.bin'), 'wb') as fp:
+            fp.write(new)
+        os.makedirs(os.path.join('unit', 'res'))
+        with open(os.path.join('unit', 'res', 'foo-1.0.bin'), 'wb') as fp:
+            fp.write(old)
+        chunk_indexes = server.ChunkIndexCache(self.tmpdir)
+        chunk_indexes.build(os.path.join('mirror', 'res', 'foo-1.1.bin'))
+        httpd = server.MirrorServer(('127.0.0.1', 0), RecordingHandler, chunks=chunk_indexes)
+        thread = threading.Thread(target=httpd.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+
+        resource = backend.URLResource('res', {
+            'url': 'http://upstream.invalid/foo-1.1.bin',
+            'hash': hashlib.sha256(new).hexdigest(),
+            'hash_type': 'sha256',
+        }, 'unit')
+        recorded = Metrics()
+        with mock.patch.object(backend, 'DELTA', True), mock.patch.object(backend, 'METRICS', recorded):
+            resource.fetch(self.url(httpd, 'mirror/'))
+        assert resource.verify()
+        self.assertEqual(requests[0], ('/mirror/res/foo-1.1.bin.chunks', None))
+        ranges = [r for path, r in requests[1:]]
+        self.assertEqual([path for path, r in requests[1:]], ['/mirror/res/foo-1.1.bin'] * len(ranges))
+        assert ranges and all(ranges)
+        fetched = sum(int(end) - int(start) + 1 for start, end in
+                      (r.split('=')[1].split('-') for r in ranges))
+        self.assertLess(fetched, len(new) // 4)
+        metrics = recorded.as_dict()['res']
+        self.assertEqual(metrics['transfer_bytes'], fetched)
+        self.assertIn('first_byte_seconds', metrics)
+        self.assertIn('transfer_seconds', metrics)
+
+    def test_compressed(self):
+        text = 'resources:\n' + ''.join('    res{0}: {{url: http://example.com/{0}}}\n'.format(i) for i in range(50))
+        with open(os.path.join(self.tmpdir, 'bundle.yaml'), 'w') as fp:
+            fp.write(text)
+        httpd = self.start(digests=server.DigestCache(self.tmpdir), compressed=server.CompressedCache(self.tmpdir))
+        code, headers, body = self.get(httpd, 'bundle.yaml', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(code, 200)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertIsNone(headers.get('Digest'))
+        self.assertLess(len(body), len(text))
+        self.assertEqual(backend.decode_content(body, 'gzip'), text.encode('ascii'))
+        etag = headers['ETag']
+
+        code, headers, body = self.get(httpd, 'bundle.yaml', **{'Accept-Encoding': 'gzip;q=0'})
+        self.assertEqual((code, body), (200, text.encode('ascii')))
+        self.assertIsNone(headers.get('Content-Encoding'))
+        self.assertNotEqual(headers['ETag'], etag)
+        assert headers['Digest']
+
+        code, headers, body = self.get(httpd, 'foo.txt', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual((code, body), (200, b'foo'))  # too small to bother
+
+    def test_compressed_index(self):
+        os.mkdir(os.path.join(self.tmpdir, 'pkg'))
+        with open(os.path.join(self.tmpdir, 'pkg', 'index.html'), 'w') as fp:
+            fp.write('<html>{}</html>'.format('<a href="foo">foo</a>' * 50))
+        httpd = self.start(compressed=server.CompressedCache(self.tmpdir))
+        code, headers, body = self.get(httpd, 'pkg/', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertIn(b'<a href="foo">', backend.decode_content(body, 'gzip'))
+
+
+class TestCompressedCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'foo.json')
+        with open(self.filename, 'w') as fp:
+            fp.write('{}' * 200)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_compressible(self):
+        compressed = server.CompressedCache(self.tmpdir)
+        st = os.stat(self.filename)
+        assert compressed.compressible('foo.json', st)
+        assert compressed.compressible('foo.YAML', st)
+        assert not compressed.compressible('foo.tgz', st)
+        assert not compressed.compressible('foo.json', mock.Mock(st_size=10))
+
+    def test_get(self):
+        compressed = server.CompressedCache(self.tmpdir)
+        variant = compressed.get(self.filename, os.stat(self.filename), 'gzip')
+        self.assertEqual(variant, os.path.join(self.tmpdir, compressed.DIRNAME, 'foo.json.gzip'))
+        with open(variant, 'rb') as fp:
+            self.assertEqual(backend.decode_content(fp.read(), 'gzip'), b'{}' * 200)
+        with mock.patch.object(server.gzip, 'GzipFile') as mgzip:
+            compressed.get(self.filename, os.stat(self.filename), 'gzip')
+            assert not mgzip.called
+        with open(self.filename, 'w') as fp:
+            fp.write('[]' * 200)
+        os.utime(self.filename, (0, 0))
+        with open(compressed.get(self.filename, os.stat(self.filename), 'gzip'), 'rb') as fp:
+            self.assertEqual(backend.decode_content(fp.read(), 'gzip'), b'[]' * 200)
+
+    def test_get_precise_mtime(self):
+        compressed = server.CompressedCache(self.tmpdir)
+        st = mock.Mock(st_size=400, st_atime=0, st_mtime=1500000000.1234567)
+        variant = compressed.get(self.filename, st, 'gzip')
+        os.utime(variant, (0, 1500000000.123456))  # as set by Python 2
+        with mock.patch.object(server.gzip, 'GzipFile') as mgzip:
+            compressed.get(self.filename, st, 'gzip')
+            assert not mgzip.called
+
+
+class TestChunkIndexCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'foo.bin')
+        with open(self.filename, 'wb') as fp:
+            fp.write(os.urandom(100 * 1024))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get(self):
+        chunk_indexes = server.ChunkIndexCache(self.tmpdir)
+        with mock.patch.object(server.chunks, 'build_index', wraps=chunks.build_index) as mbuild_index:
+            self.assertIsNone(chunk_indexes.get(self.filename, os.stat(self.filename)))
+            self.assertIsNone(chunk_indexes.get(self.filename, os.stat(self.filename)))
+            chunk_indexes.wait()
+            index = chunk_indexes.get(self.filename, os.stat(self.filename))
+            self.assertEqual(index, os.path.join(self.tmpdir, chunk_indexes.DIRNAME, 'foo.bin.chunks.json'))
+            os.utime(index, (0, int(os.stat(self.filename).st_mtime * 1e6) / 1e6))  # as set by Python 2
+            self.assertEqual(chunk_indexes.get(self.filename, os.stat(self.filename)), index)
+            self.assertEqual(mbuild_index.call_count, 1)
+            with open(index) as fp:
+                self.assertEqual(json.load(fp)['size'], 100 * 1024)
+            os.utime(self.filename, (0, 0))
+            self.assertIsNone(chunk_indexes.get(self.filename, os.stat(self.filename)))
+            chunk_indexes.wait()
+            self.assertEqual(mbuild_index.call_count, 2)
+
+
+class TestDigestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'foo.txt')
+        with open(self.filename, 'w') as fp:
+            fp.write('foo')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get(self):
+        digests = server.DigestCache(self.tmpdir)
+        self.assertEqual(digests.get(self.filename), {
+            'sha256': '2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886266e7ae',
+        })
+        self.assertEqual(digests.get(self.filename, hash_types=['md5'])['md5'],
+                         'acbd18db4cc2f85cedef654fccc4a4d8')
+        digests.save()
+        with mock.patch.object(server.hashlib, 'new') as mnew:
+            digests = server.DigestCache(self.tmpdir)  # reload from disk
+            self.assertEqual(len(digests.get(self.filename, hash_types=['md5', 'sha256'])), 2)
+            assert not mnew.called
+
+    @mock.patch.object(server.DigestCache, 'SAVE_DELAY', 0.05)
+    def test_get_saves_later(self):
+        saved = os.path.join(self.tmpdir, server.DigestCache.FILENAME)
+        digests = server.DigestCache(self.tmpdir)
+        with mock.patch.object(server.json, 'dump', wraps=server.json.dump) as mdump:
+            digests.get(self.filename)
+            digests.get(self.filename, hash_types=['md5'])
+            assert not os.path.exists(saved)
+            for i in range(100):
+                if os.path.exists(saved):
+                    break
+                time.sleep(0.01)
+        self.assertEqual(mdump.call_count, 1)  # both new digests at once
+        with open(saved) as fp:
+            self.assertItemsEqual(json.load(fp)['foo.txt'][2].keys(), ['md5', 'sha256'])
+
+    def test_get_unsupported(self):
+        digests = server.DigestCache(self.tmpdir)
+        self.assertRaises(ValueError, digests.get, self.filename, hash_types=['shake_128'])
+        self.assertIn('sha256', server.DIGEST_TYPES)
+        self.assertNotIn('shake_128', server.DIGEST_TYPES)
+
+    def test_get_stale(self):
+        digests = server.DigestCache(self.tmpdir)
+        digests.get(self.filename)
+        with open(self.filename, 'w') as fp:
+            fp.write('bar!')
+        self.assertEqual(digests.get(self.filename)['sha256'],
+                         server.hashlib.sha256(b'bar!').hexdigest())
+
+    def test_precompute(self):
+        resource = backend.Resource('foo', {'file': 'foo.txt', 'hash_type': 'md5'}, self.tmpdir)
+        missing = backend.Resource('bar', {'file': 'bar.txt', 'hash_type': 'md5'}, self.tmpdir)
+        digests = server.DigestCache(self.tmpdir)
+        digests.precompute([resource, missing])
+        with open(os.path.join(self.tmpdir, server.DigestCache.FILENAME)) as fp:
+            saved = json.load(fp)
+        self.assertEqual(list(saved.keys()), ['foo.txt'])
+        self.assertItemsEqual(saved['foo.txt'][2].keys(), ['md5', 'sha256'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import json
+import os
+import shutil
+import threading
+import unittest
+from tempfile import mkdtemp
+
+from jujuresources.trace import Trace
+
+
+class TestTrace(unittest.TestCase):
+    def test_add(self):
+        trace = Trace()
+        trace.add('foo', 'transfer_seconds', 2.5, 3.0)
+        thread = threading.Thread(target=trace.add, args=('foo', 'fetch_seconds', 2.0, 3.5), name='worker')
+        thread.start()
+        thread.join()
+        events = trace.as_list()
+        self.assertEqual(sorted(event['args']['name'] for event in events if event['ph'] == 'M'),
+                         sorted([threading.current_thread().name, 'worker']))
+        slices = [event for event in events if event['ph'] == 'X']
+        self.assertEqual([(event['name'], event['cat'], event['ts'], event['dur']) for event in slices], [
+            ('fetch foo', 'fetch', 2000000, 1500000),
+            ('transfer foo', 'transfer', 2500000, 500000),
+        ])
+        self.assertEqual(slices[0]['tid'], thread.ident)
+        self.assertEqual(slices[1]['tid'], threading.current_thread().ident)
+
+    def test_write(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        trace = Trace()
+        trace.add('foo', 'pip_seconds', 1.0, 2.0)
+        trace.write(os.path.join(tmpdir, 'trace.json'))
+        self.assertEqual(os.listdir(tmpdir), ['trace.json'])
+        with open(os.path.join(tmpdir, 'trace.json')) as fp:
+            self.assertEqual(json.load(fp), {'traceEvents': trace.as_list(), 'displayTimeUnit': 'ms'})
+
+
+if __name__ == '__main__':
+    unittest.main()